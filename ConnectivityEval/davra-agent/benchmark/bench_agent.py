@@ -0,0 +1,71 @@
+# Runs the Davra Agent for the benchmark suite, as its own process:
+#   python bench_agent.py <sandboxDir>
+# The agent is started from <sandboxDir>, with its config, state files and logs there instead of /usr/bin/davra
+# and /var/log, and with the fake RSC (bench_rsc) in place of the PLC. <sandboxDir>/bench.json holds rscLatency.
+# On SIGTERM it writes the duration of every heartbeat and PLC metrics tick, and the scheduler stats,
+# to <sandboxDir>/agentStats.json and exits.
+#
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarkDir))
+sys.path.insert(0, benchmarkDir)
+import bench_rsc
+
+
+sandboxDir = os.path.abspath(sys.argv[1])
+with open(os.path.join(sandboxDir, 'bench.json')) as benchFile:
+    benchSettings = json.load(benchFile)
+bench_rsc.installFakeRsc(float(benchSettings.get('rscLatency', 0)))
+
+import davra_lib as comDavra
+comDavra.installationDir = sandboxDir
+comDavra.agentConfigFile = os.path.join(sandboxDir, 'config.json')
+comDavra.logDir = sandboxDir
+comDavra.serverStateCacheFile = os.path.join(sandboxDir, 'serverState.json')
+comDavra.definedMetricsFile = os.path.join(sandboxDir, 'definedMetrics.json')
+comDavra.loadConfiguration()
+os.chdir(sandboxDir)
+os.environ.setdefault('PLC_USER', 'bench')
+os.environ.setdefault('PLC_PASS', 'bench')
+import davra_agent
+
+
+# Seconds taken by each run of the timed agent functions
+tickDurations = { 'heartbeat': [], 'plcMetrics': [] }
+tickDurationsLock = threading.Lock()
+
+
+def getTimedFunction(tickName, functionToTime):
+    def timedFunction(*args, **kwargs):
+        startTime = time.perf_counter()
+        try:
+            return functionToTime(*args, **kwargs)
+        finally:
+            with tickDurationsLock:
+                tickDurations[tickName].append(time.perf_counter() - startTime)
+    return timedFunction
+
+
+# The agent's task table looks these up when main() schedules them, so wrapping them here times every tick
+davra_agent.sendHeartbeatMetricsToServer = getTimedFunction('heartbeat', davra_agent.sendHeartbeatMetricsToServer)
+davra_agent.sendPLCMetricsToServer = getTimedFunction('plcMetrics', davra_agent.sendPLCMetricsToServer)
+
+
+def writeStatsAndExit(signalNumber, frame):
+    with tickDurationsLock:
+        stats = {
+            'tickDurations': { name: list(durations) for name, durations in tickDurations.items() },
+            'scheduler': davra_agent.scheduler.getStats()
+        }
+    comDavra.writeJsonFileAtomically(os.path.join(sandboxDir, 'agentStats.json'), stats)
+    os._exit(0)
+
+
+signal.signal(signal.SIGTERM, writeStatsAndExit)
+davra_agent.main()
@@ -0,0 +1,80 @@
+# One simulated Device App for the load generator, as its own process like a real co-located app:
+#   python bench_app.py --name app3 --broker-port 1883 --rate 20 --duration 10 --start-at <epoch seconds>
+# Connects to the agent through davra_sdk, registers its capabilities, then from --start-at sends --rate
+# messages per second for --duration seconds. Each datum is named bench.load.<name> and its value is the
+# send time (epoch milliseconds), so the stub server can tell delivery, loss and latency per app.
+# Prints { name, messages, datums, sendSeconds, lagSeconds } as JSON on stdout when done.
+#
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import davra_sdk as davraSdk
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Simulated Device App for the Davra Agent load generator')
+    parser.add_argument('--name', required=True)
+    parser.add_argument('--broker-host', default='127.0.0.1')
+    parser.add_argument('--broker-port', type=int, default=1883)
+    parser.add_argument('--rate', type=float, default=10, help='messages per second')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--start-at', type=float, default=0, help='epoch seconds to start sending at')
+    parser.add_argument('--shape', default='single', choices=['single', 'multi'], \
+        help='single: sendMetricValue per message, multi: sendMultiMetricValues with --metrics-per-message')
+    parser.add_argument('--metrics-per-message', type=int, default=10)
+    parser.add_argument('--capabilities', type=int, default=1, help='capabilities to register with registerCapability')
+    return parser.parse_args()
+
+
+def doNothing(msg):
+    return
+
+
+def sendMessage(args, metricName):
+    sendTime = round(time.time() * 1000.0, 3)
+    if(args.shape == 'single'):
+        davraSdk.sendMetricValue(metricName, sendTime)
+        return 1
+    davraSdk.sendMultiMetricValues([{ metricName: sendTime } for index in range(args.metrics_per_message)])
+    return args.metrics_per_message
+
+
+if __name__ == "__main__":
+    args = parseArguments()
+    resultsOutput = sys.stdout
+    # The SDK logs every message it sends, keep that out of the results
+    sys.stdout = open(os.devnull, 'w')
+    davraSdk.mqttBrokerAgentHost = args.broker_host
+    davraSdk.mqttBrokerAgentPort = args.broker_port
+    davraSdk.connectToAgent(args.name)
+    for index in range(args.capabilities):
+        davraSdk.registerCapability('bench-' + args.name + '-' + str(index), { 'functionParameters': {}, \
+            'functionLabel': 'Benchmark capability ' + str(index), 'functionDescription': 'Does nothing' }, doNothing)
+    time.sleep(max(0.0, args.start_at - time.time()))
+    metricName = 'bench.load.' + args.name
+    (messages, datums) = (0, 0)
+    interval = 1.0 / args.rate
+    startTime = time.monotonic()
+    nextSendTime = startTime
+    while nextSendTime - startTime < args.duration:
+        time.sleep(max(0.0, nextSendTime - time.monotonic()))
+        datums += sendMessage(args, metricName)
+        messages += 1
+        nextSendTime += interval
+    sendSeconds = time.monotonic() - startTime
+    # Let the mqtt client thread publish what is still queued
+    time.sleep(1)
+    resultsOutput.write(json.dumps({
+        'name': args.name,
+        'messages': messages,
+        'datums': datums,
+        'sendSeconds': round(sendSeconds, 3),
+        # How far behind its schedule the app fell, eg when publishing itself could not keep up
+        'lagSeconds': round(max(0.0, sendSeconds - args.duration), 3)
+    }) + "\n")
+    resultsOutput.flush()
+    os._exit(0)
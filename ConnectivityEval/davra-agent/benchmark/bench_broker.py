@@ -0,0 +1,200 @@
+# MQTT broker for the benchmark suite
+# Uses a local mosquitto when one is installed, as on the device. Otherwise falls back to a minimal
+# in-process MQTT 3.1.1 broker: QoS 0 delivery (QoS 1 publishes are acknowledged and delivered at QoS 0),
+# topic filters with + and #, no retained messages, sessions or authentication.
+#
+import shutil
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+
+
+def getFreePort():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def encodeRemainingLength(length):
+    encoded = bytearray()
+    while True:
+        digit = length % 128
+        length = length // 128
+        encoded.append(digit | 0x80 if length > 0 else digit)
+        if(length == 0):
+            return bytes(encoded)
+
+
+def isTopicMatch(topicFilter, topic):
+    filterLevels = topicFilter.split('/')
+    topicLevels = topic.split('/')
+    for index, level in enumerate(filterLevels):
+        if(level == '#'):
+            return True
+        if(index >= len(topicLevels) or (level != '+' and level != topicLevels[index])):
+            return False
+    return len(filterLevels) == len(topicLevels)
+
+
+class BrokerConnectionHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sendLock = threading.Lock()
+        self.topicFilters = set()
+
+    def send(self, packet):
+        with self.sendLock:
+            self.request.sendall(packet)
+
+    def receiveExactly(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if(not chunk):
+                raise ConnectionError('client disconnected')
+            data.extend(chunk)
+        return bytes(data)
+
+    def receivePacket(self):
+        header = self.receiveExactly(1)[0]
+        (length, multiplier) = (0, 1)
+        while True:
+            digit = self.receiveExactly(1)[0]
+            length += (digit & 0x7F) * multiplier
+            multiplier *= 128
+            if(digit & 0x80 == 0):
+                break
+        return (header, self.receiveExactly(length) if length > 0 else b'')
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            while True:
+                (header, body) = self.receivePacket()
+                packetType = header >> 4
+                if(packetType == 1):
+                    # CONNECT: accept anyone
+                    broker.addClient(self)
+                    self.send(b'\x20\x02\x00\x00')
+                elif(packetType == 3):
+                    self.handlePublish(header, body)
+                elif(packetType == 8):
+                    # SUBSCRIBE: grant QoS 0 for each filter
+                    packetId = body[0:2]
+                    (position, grantedCount) = (2, 0)
+                    while position < len(body):
+                        filterLength = int.from_bytes(body[position:position + 2], 'big')
+                        self.topicFilters.add(body[position + 2:position + 2 + filterLength].decode('utf8'))
+                        position += 2 + filterLength + 1
+                        grantedCount += 1
+                    self.send(b'\x90' + encodeRemainingLength(2 + grantedCount) + packetId + b'\x00' * grantedCount)
+                elif(packetType == 10):
+                    # UNSUBSCRIBE
+                    packetId = body[0:2]
+                    position = 2
+                    while position < len(body):
+                        filterLength = int.from_bytes(body[position:position + 2], 'big')
+                        self.topicFilters.discard(body[position + 2:position + 2 + filterLength].decode('utf8'))
+                        position += 2 + filterLength
+                    self.send(b'\xb0\x02' + packetId)
+                elif(packetType == 12):
+                    # PINGREQ
+                    self.send(b'\xd0\x00')
+                elif(packetType == 14):
+                    # DISCONNECT
+                    return
+        except (ConnectionError, OSError):
+            return
+        finally:
+            broker.removeClient(self)
+
+    def handlePublish(self, header, body):
+        qos = (header >> 1) & 0x03
+        topicLength = int.from_bytes(body[0:2], 'big')
+        topic = body[2:2 + topicLength].decode('utf8')
+        position = 2 + topicLength
+        if(qos > 0):
+            packetId = body[position:position + 2]
+            position += 2
+            # PUBACK for QoS 1, PUBREC for QoS 2 (the client's PUBREL then goes unanswered)
+            self.send((b'\x40\x02' if qos == 1 else b'\x50\x02') + packetId)
+        self.server.broker.publish(topic, body[position:])
+
+
+class ThreadingBrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MiniBroker(object):
+    def __init__(self, port):
+        self.port = port
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.server = ThreadingBrokerServer(('127.0.0.1', port), BrokerConnectionHandler)
+        self.server.broker = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mini-broker', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def addClient(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def removeClient(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    # Deliver to every subscriber at QoS 0, including the publisher if it subscribed
+    def publish(self, topic, payload):
+        encodedTopic = topic.encode('utf8')
+        variablePart = len(encodedTopic).to_bytes(2, 'big') + encodedTopic + payload
+        packet = b'\x30' + encodeRemainingLength(len(variablePart)) + variablePart
+        with self.lock:
+            subscribers = [client for client in self.clients \
+                if any(isTopicMatch(topicFilter, topic) for topicFilter in list(client.topicFilters))]
+        for client in subscribers:
+            try:
+                client.send(packet)
+            except OSError:
+                pass
+
+
+class MosquittoBroker(object):
+    def __init__(self, port):
+        self.port = port
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen([shutil.which('mosquitto'), '-p', str(self.port)], \
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Wait until it accepts connections
+        for attempt in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('mosquitto did not start on port ' + str(self.port))
+
+    def stop(self):
+        if(self.process is not None):
+            self.process.terminate()
+            self.process.wait(timeout=10)
+
+
+# Start a broker on a free port. kind is 'auto', 'mosquitto' or 'inprocess'.
+# Returns (broker, kindUsed); the broker has .port and .stop()
+def startBroker(kind = 'auto'):
+    port = getFreePort()
+    if(kind == 'mosquitto' or (kind == 'auto' and shutil.which('mosquitto'))):
+        return (MosquittoBroker(port).start(), 'mosquitto')
+    return (MiniBroker(port).start(), 'inprocess')
@@ -0,0 +1,198 @@
+# Fake PLCnext RSC for the benchmark suite
+# installFakeRsc() puts stand-ins for the parts of PyPlcnextRsc the agent uses into sys.modules,
+# so the agent runs without a controller. Every RSC call on a FakeDevice takes callLatency seconds.
+# Only for benchmark processes: it replaces PyPlcnextRsc for the whole process.
+#
+import enum
+import random
+import sys
+import time
+import types
+
+
+# Seconds each RSC call takes, set by installFakeRsc
+callLatency = 0.0
+
+
+class RscType(enum.Enum):
+    Void = 0
+    Bool = 2
+    Char = 3
+    Int8 = 4
+    Uint8 = 5
+    Int16 = 6
+    Uint16 = 7
+    Int32 = 8
+    Uint32 = 9
+    Int64 = 10
+    Uint64 = 11
+    Real32 = 12
+    Real64 = 13
+    Utf8String = 19
+    String = 20
+    AnsiString = 21
+    Utf16String = 22
+
+
+class RscVariant(object):
+    def __init__(self, value, rscType = RscType.Void):
+        self.value = value
+        self.rscType = rscType
+
+    def GetValue(self):
+        return self.value
+
+    def GetType(self):
+        return self.rscType
+
+
+class ExtraConfigure(object):
+    def __init__(self):
+        self.timeout = 10
+        self.useTls = True
+        self.keepAlive_ms = 0
+
+
+class FakeDevice(object):
+    def __init__(self, ip, port = 41100, config = None, secureInfoSupplier = None):
+        self.ip = ip
+        self.connected = False
+
+    def connect(self):
+        time.sleep(callLatency)
+        self.connected = True
+
+    def dispose(self):
+        self.connected = False
+
+
+def simulateCall(device):
+    if(device.connected is False):
+        raise IOError('RSC device not connected')
+    time.sleep(callLatency)
+
+
+class IDeviceStatusService(object):
+    def __init__(self, device):
+        self.device = device
+
+    def GetItems(self, identifiers):
+        simulateCall(self.device)
+        return [RscVariant(round(random.uniform(0, 100), 1), RscType.Real32) for identifier in identifiers]
+
+
+class IDeviceInfoService(object):
+    def __init__(self, device):
+        self.device = device
+
+    def GetItems(self, identifiers):
+        simulateCall(self.device)
+        return [RscVariant('bench-' + identifier.rsplit('.', 1)[-1], RscType.Utf8String) for identifier in identifiers]
+
+
+class DataAccessError(enum.IntEnum):
+    NONE = 0
+    NotExists = 1
+
+
+class ReadItem(object):
+    def __init__(self, value):
+        self.Error = DataAccessError.NONE
+        self.Value = value
+
+
+class WriteItem(object):
+    def __init__(self, portName, value):
+        self.PortName = portName
+        self.Value = value
+
+
+class IDataAccessService(object):
+    def __init__(self, device):
+        self.device = device
+
+    def Read(self, portNames):
+        simulateCall(self.device)
+        return [ReadItem(RscVariant(0.0, RscType.Real64)) for portName in portNames]
+
+    def Write(self, writeItems):
+        simulateCall(self.device)
+        return [DataAccessError.NONE for writeItem in writeItems]
+
+
+class PlcInfoId(enum.Enum):
+    ProjectName = 1
+
+
+class IPlcInfoService(object):
+    def __init__(self, device):
+        self.device = device
+
+    def GetInfo(self, infoId):
+        simulateCall(self.device)
+        return RscVariant('BenchProject', RscType.Utf8String)
+
+
+class Traits(enum.IntFlag):
+    NONE = 0
+    Crc32 = 8
+
+
+class FileSystemError(enum.IntEnum):
+    NONE = 0
+    NotFound = 2
+
+
+class IDirectoryService(object):
+    def __init__(self, device):
+        self.device = device
+
+    # The fake controller has no program meta files
+    def EnumerateFileSystemTraitsEntries(self, path, pattern, traits, recursive):
+        simulateCall(self.device)
+        return []
+
+
+class IFileService(object):
+    def __init__(self, device):
+        self.device = device
+
+    def Read(self, traits, path):
+        simulateCall(self.device)
+        return (None, [], FileSystemError.NotFound)
+
+
+# The modules the agent imports from PyPlcnextRsc and what each provides
+fakeModules = {
+    'PyPlcnextRsc': { 'Device': FakeDevice, 'ExtraConfigure': ExtraConfigure, 'RscVariant': RscVariant, 'RscType': RscType },
+    'PyPlcnextRsc.Arp': {},
+    'PyPlcnextRsc.Arp.Device': {},
+    'PyPlcnextRsc.Arp.Device.Interface': {},
+    'PyPlcnextRsc.Arp.Device.Interface.Services': { 'IDeviceInfoService': IDeviceInfoService, \
+        'IDeviceStatusService': IDeviceStatusService },
+    'PyPlcnextRsc.Arp.Plc': {},
+    'PyPlcnextRsc.Arp.Plc.Gds': {},
+    'PyPlcnextRsc.Arp.Plc.Gds.Services': { 'IDataAccessService': IDataAccessService, 'WriteItem': WriteItem, \
+        'DataAccessError': DataAccessError },
+    'PyPlcnextRsc.Arp.Plc.Domain': {},
+    'PyPlcnextRsc.Arp.Plc.Domain.Services': { 'IPlcInfoService': IPlcInfoService, 'PlcInfoId': PlcInfoId },
+    'PyPlcnextRsc.Arp.System': {},
+    'PyPlcnextRsc.Arp.System.Commons': {},
+    'PyPlcnextRsc.Arp.System.Commons.Services': {},
+    'PyPlcnextRsc.Arp.System.Commons.Services.Io': { 'IDirectoryService': IDirectoryService, \
+        'IFileService': IFileService, 'Traits': Traits, 'FileSystemError': FileSystemError }
+}
+
+
+# Replace PyPlcnextRsc in this process. Call before importing any agent module.
+def installFakeRsc(latency = 0.0):
+    global callLatency
+    callLatency = latency
+    for moduleName, attributes in fakeModules.items():
+        module = types.ModuleType(moduleName)
+        module.__path__ = []
+        module.__dict__.update(attributes)
+        sys.modules[moduleName] = module
+        if('.' in moduleName):
+            (parentName, childName) = moduleName.rsplit('.', 1)
+            setattr(sys.modules[parentName], childName, module)
@@ -0,0 +1,194 @@
+# Stub Davra server for the benchmark suite
+# Answers the API calls the agent makes (/api/v1/iotdata, /api/v1/logs, /api/v1/jobs, /api/v1/devices)
+# from memory, over HTTPS if given a certificate. Every response can be delayed by latency seconds
+# (plus up to latencyJitter) and a fraction failureRate of them fail with a 503, to see how the agent copes.
+#
+import json
+import random
+import ssl
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Create a self-signed certificate for 127.0.0.1, used by the stub server and as the device certificate
+def createSelfSignedCert(certFile, keyFile):
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', \
+        '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1', \
+        '-keyout', keyFile, '-out', certFile], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections open, as the agent's pooled session expects of the real server
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, so without this each response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handleRequest('GET')
+
+    def do_PUT(self):
+        self.handleRequest('PUT')
+
+    def do_POST(self):
+        self.handleRequest('POST')
+
+    def do_PATCH(self):
+        self.handleRequest('PATCH')
+
+    def handleRequest(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length > 0 else b''
+        arrivalTime = time.monotonic()
+        (statusCode, response) = self.server.stub.respond(method, self.path.split('?')[0], body, arrivalTime)
+        content = json.dumps(response).encode('utf8')
+        self.send_response(statusCode)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class StubServer(object):
+    # onIotData(items, arrivalTime) is called for every accepted PUT /api/v1/iotdata, arrivalTime being monotonic
+    # port 0 picks a free port
+    def __init__(self, deviceUuid, latency = 0.0, latencyJitter = 0.0, failureRate = 0.0, \
+        certFile = None, keyFile = None, onIotData = None, port = 0):
+        self.deviceUuid = deviceUuid
+        self.latency = latency
+        self.latencyJitter = latencyJitter
+        self.failureRate = failureRate
+        self.onIotData = onIotData
+        self.lock = threading.Lock()
+        self.device = { 'UUID': deviceUuid, 'labels': {}, 'customAttributes': {}, 'capabilities': {} }
+        self.requestCounts = {}
+        self.failedCounts = {}
+        self.datumCount = 0
+        self.eventCount = 0
+        self.logCount = 0
+        # Monotonic time each event name was first received
+        self.firstEventTimes = {}
+        self.httpServer = ThreadingHTTPServer(('127.0.0.1', port), StubRequestHandler)
+        self.httpServer.daemon_threads = True
+        self.httpServer.stub = self
+        self.scheme = 'http'
+        if(certFile is not None):
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certFile, keyFile)
+            self.httpServer.socket = context.wrap_socket(self.httpServer.socket, server_side=True)
+            self.scheme = 'https'
+        self.thread = threading.Thread(target=self.httpServer.serve_forever, name='stub-server', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+    def getUrl(self):
+        return self.scheme + '://127.0.0.1:' + str(self.httpServer.server_address[1])
+
+    # Which API the path belongs to, for the request counts
+    def getEndpoint(self, method, path):
+        parts = [part for part in path.split('/') if part]
+        if(len(parts) >= 3 and parts[0] == 'api'):
+            endpoint = '/'.join(parts[:3])
+            if(parts[2] == 'iotdata' and len(parts) > 3):
+                endpoint += '/' + parts[3]
+            if(parts[2] == 'devices' and parts[-1] == 'attributes'):
+                endpoint += '/attributes'
+        else:
+            endpoint = path
+        return method + ' /' + endpoint.strip('/')
+
+    def respond(self, method, path, body, arrivalTime):
+        endpoint = self.getEndpoint(method, path)
+        with self.lock:
+            self.requestCounts[endpoint] = self.requestCounts.get(endpoint, 0) + 1
+        delay = self.latency + (random.uniform(0, self.latencyJitter) if self.latencyJitter > 0 else 0)
+        if(delay > 0):
+            time.sleep(delay)
+        if(self.failureRate > 0 and random.random() < self.failureRate):
+            with self.lock:
+                self.failedCounts[endpoint] = self.failedCounts.get(endpoint, 0) + 1
+            return (503, { 'message': 'injected failure' })
+        try:
+            payload = json.loads(body) if body else None
+        except ValueError:
+            return (400, { 'message': 'invalid json' })
+        if(endpoint == 'PUT /api/v1/iotdata'):
+            self.receiveIotData(payload if type(payload) == list else [payload], arrivalTime)
+            return (200, {})
+        if(endpoint == 'PUT /api/v1/logs'):
+            with self.lock:
+                self.logCount += 1
+            return (200, {})
+        if(endpoint == 'PUT /api/v1/jobs'):
+            # No pending jobs
+            return (200, [])
+        if(endpoint == 'GET /api/v1/devices'):
+            with self.lock:
+                return (200, { 'totalRecords': 1, 'records': [json.loads(json.dumps(self.device))] })
+        if(endpoint == 'PUT /api/v1/devices'):
+            with self.lock:
+                for key, value in (payload or {}).items():
+                    self.device[key] = value
+            return (200, {})
+        if(endpoint == 'PATCH /api/v1/devices/attributes'):
+            with self.lock:
+                self.device['customAttributes'].update(payload or {})
+            return (200, {})
+        # Anything else (eg metric definitions, the reachability check) is accepted
+        return (200, {})
+
+    def receiveIotData(self, items, arrivalTime):
+        with self.lock:
+            for item in items:
+                if(item.get('msg_type') == 'event'):
+                    self.eventCount += 1
+                    self.firstEventTimes.setdefault(item.get('name'), arrivalTime)
+                else:
+                    self.datumCount += 1
+        if(self.onIotData is not None):
+            self.onIotData(items, arrivalTime)
+
+    # The labels and custom attributes of the device record, or replace them (eg to make them drift)
+    def getDeviceState(self):
+        with self.lock:
+            return json.loads(json.dumps({ 'labels': self.device['labels'], 'customAttributes': self.device['customAttributes'] }))
+
+    def setDeviceState(self, labels, customAttributes):
+        with self.lock:
+            self.device['labels'] = labels
+            self.device['customAttributes'] = customAttributes
+
+    # Forget which events arrived, so waitForEvent waits for the next one (eg after restarting the agent)
+    def forgetEvents(self):
+        with self.lock:
+            self.firstEventTimes = {}
+
+    # Wait up to timeout seconds for the first event called eventName. Returns its arrival time or None
+    def waitForEvent(self, eventName, timeout):
+        endTime = time.monotonic() + timeout
+        while time.monotonic() < endTime:
+            with self.lock:
+                if(eventName in self.firstEventTimes):
+                    return self.firstEventTimes[eventName]
+            time.sleep(0.01)
+        return None
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'requests': dict(sorted(self.requestCounts.items())),
+                'injectedFailures': dict(sorted(self.failedCounts.items())),
+                'datums': self.datumCount,
+                'events': self.eventCount,
+                'logs': self.logCount
+            }
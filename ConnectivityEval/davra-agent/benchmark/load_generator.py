@@ -0,0 +1,252 @@
+# Many-app load generator for the Davra Agent
+# Runs N simulated Device Apps (bench_app.py, one process each, using davra_sdk connectToAgent,
+# registerCapability and sendMetricValue / sendMultiMetricValues) against one agent, and records at the
+# stub Davra server how much of what they sent was delivered, lost, and how late.
+# A ramp test raises the load step by step (more apps, or a higher rate per app) and stops at the first
+# step which saturates the agent: more than --max-loss of the datums lost, or a p99 delivery latency over
+# --max-p99-ms, ie the agent's MQTT callbacks backed up. The results are JSON on stdout (and --output).
+#
+#   python benchmark/load_generator.py --ramp apps --start-apps 1 --max-apps 64 --rate 10
+#   python benchmark/load_generator.py --ramp rate --start-apps 4 --rate 5 --max-rate 400 --shape multi
+#
+# By default the agent, broker and stub server are started as in run_benchmark.py. With --attach an agent
+# already running is used instead: give its broker with --broker-host/--broker-port and point its server
+# config at the stub server started on --server-port.
+#
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarkDir))
+sys.path.insert(0, benchmarkDir)
+import bench_broker
+import bench_server
+import run_benchmark as benchRun
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Many-app load generator for the Davra Agent')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--ramp', default='apps', choices=['apps', 'rate', 'none'], \
+        help='raise the number of apps or the rate per app each step, or run a single step')
+    parser.add_argument('--start-apps', type=int, default=1)
+    parser.add_argument('--max-apps', type=int, default=64)
+    parser.add_argument('--rate', type=float, default=10, help='messages per second per app (the first step)')
+    parser.add_argument('--max-rate', type=float, default=1000)
+    parser.add_argument('--ramp-factor', type=float, default=2, help='how much the load grows each step')
+    parser.add_argument('--step-seconds', type=float, default=10)
+    parser.add_argument('--shape', default='single', choices=['single', 'multi'])
+    parser.add_argument('--metrics-per-message', type=int, default=10)
+    parser.add_argument('--capabilities', type=int, default=1, help='capabilities each app registers')
+    parser.add_argument('--max-loss', type=float, default=0.01, help='fraction of datums lost that saturates a step')
+    parser.add_argument('--max-p99-ms', type=float, default=1000, help='p99 delivery latency that saturates a step')
+    parser.add_argument('--drain-timeout', type=float, default=15, help='seconds to wait after a step for stragglers')
+    parser.add_argument('--http', action='store_true', help='run the stub server over plain HTTP instead of HTTPS')
+    parser.add_argument('--broker', default='auto', choices=['auto', 'mosquitto', 'inprocess'])
+    parser.add_argument('--server-latency-ms', type=float, default=0)
+    parser.add_argument('--server-failure-rate', type=float, default=0)
+    parser.add_argument('--rsc-latency-ms', type=float, default=5)
+    parser.add_argument('--heartbeat-interval', type=float, default=60)
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--agent-config', help='json file of extra agent config, eg { "telemetryRules": [...] }')
+    parser.add_argument('--attach', action='store_true', help='use an agent which is already running')
+    parser.add_argument('--broker-host', default='127.0.0.1')
+    parser.add_argument('--broker-port', type=int, default=1883)
+    parser.add_argument('--server-port', type=int, default=0)
+    return parser.parse_args()
+
+
+# Counts the load datums of each app as the stub server receives them, with their delivery latency
+class LoadRecorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # { metricName: [count, lastArrival, [latencySeconds]] }
+        self.received = {}
+
+    def onIotData(self, items, arrivalTime):
+        arrivalEpoch = time.time()
+        with self.lock:
+            for item in items:
+                name = item.get('name') or ''
+                if(not name.startswith('bench.load.')):
+                    continue
+                entry = self.received.setdefault(name, [0, 0.0, []])
+                entry[0] += 1
+                entry[1] = arrivalEpoch
+                try:
+                    entry[2].append(arrivalEpoch - float(item.get('value')) / 1000.0)
+                except (TypeError, ValueError):
+                    pass
+
+    def getReceived(self, metricNames):
+        with self.lock:
+            return [self.received.get(name, [0, 0.0, []]) for name in metricNames]
+
+
+# The (apps, ratePerApp) of each step of the ramp
+def getRampSteps(args):
+    steps = []
+    (apps, rate) = (args.start_apps, args.rate)
+    while apps <= args.max_apps and rate <= args.max_rate:
+        steps.append((apps, rate))
+        if(args.ramp == 'none'):
+            break
+        if(args.ramp == 'apps'):
+            apps = max(apps + 1, int(round(apps * args.ramp_factor)))
+        else:
+            rate = rate * args.ramp_factor
+    return steps
+
+
+def startApp(args, brokerHost, brokerPort, appName, rate, startAt):
+    return subprocess.Popen([sys.executable, os.path.join(benchmarkDir, 'bench_app.py'), '--name', appName, \
+        '--broker-host', brokerHost, '--broker-port', str(brokerPort), '--rate', str(rate), \
+        '--duration', str(args.step_seconds), '--start-at', str(startAt), '--shape', args.shape, \
+        '--metrics-per-message', str(args.metrics_per_message), '--capabilities', str(args.capabilities)], \
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+
+def runStep(args, recorder, brokerHost, brokerPort, stepNumber, apps, rate):
+    appNames = ['s' + str(stepNumber) + 'a' + str(index) for index in range(apps)]
+    # Give every app time to start and connect, so they all begin sending together
+    startAt = time.time() + 3 + 0.1 * apps
+    processes = [startApp(args, brokerHost, brokerPort, appName, rate, startAt) for appName in appNames]
+    appResults = []
+    for process in processes:
+        try:
+            (output, errors) = process.communicate(timeout=startAt - time.time() + args.step_seconds + 60)
+            appResults.append(json.loads(output.strip().splitlines()[-1]))
+        except Exception:
+            process.kill()
+            appResults.append(None)
+    sent = sum(result['datums'] for result in appResults if result is not None)
+    metricNames = ['bench.load.' + appName for appName in appNames]
+    # Wait for whatever is still on its way through the agent
+    drainEnd = time.monotonic() + args.drain_timeout
+    while time.monotonic() < drainEnd and sum(entry[0] for entry in recorder.getReceived(metricNames)) < sent:
+        time.sleep(0.1)
+    received = recorder.getReceived(metricNames)
+    delivered = sum(entry[0] for entry in received)
+    latencies = [latency for entry in received for latency in entry[2]]
+    lastArrival = max([entry[1] for entry in received] + [startAt])
+    lost = max(0, sent - delivered)
+    stepResult = {
+        'step': stepNumber,
+        'apps': apps,
+        'appsFailed': appResults.count(None),
+        'ratePerApp': rate,
+        'offeredDatumsPerSecond': round(apps * rate * (args.metrics_per_message if args.shape == 'multi' else 1), 1),
+        'sent': sent,
+        'delivered': delivered,
+        'lost': lost,
+        'lossRate': round(lost / sent, 4) if sent > 0 else 0.0,
+        'deliveredDatumsPerSecond': round(delivered / max(args.step_seconds, lastArrival - startAt), 1),
+        'latencyMs': benchRun.summariseMilliseconds(latencies),
+        'maxAppLagSeconds': max([result['lagSeconds'] for result in appResults if result is not None] + [0.0])
+    }
+    reasons = []
+    if(stepResult['appsFailed'] > 0):
+        reasons.append(str(stepResult['appsFailed']) + ' app(s) failed')
+    if(stepResult['lossRate'] > args.max_loss):
+        reasons.append('loss ' + str(stepResult['lossRate']) + ' > ' + str(args.max_loss))
+    if(stepResult['latencyMs'].get('p99') is not None and stepResult['latencyMs']['p99'] > args.max_p99_ms):
+        reasons.append('p99 ' + str(stepResult['latencyMs']['p99']) + 'ms > ' + str(args.max_p99_ms) + 'ms')
+    stepResult['saturated'] = len(reasons) > 0
+    stepResult['saturationReasons'] = reasons
+    return stepResult
+
+
+def runRamp(args, results, recorder, brokerHost, brokerPort):
+    results['steps'] = []
+    for stepNumber, (apps, rate) in enumerate(getRampSteps(args)):
+        sys.stderr.write('Step ' + str(stepNumber) + ': ' + str(apps) + ' app(s) at ' + str(rate) + ' msg/s each\n')
+        stepResult = runStep(args, recorder, brokerHost, brokerPort, stepNumber, apps, rate)
+        results['steps'].append(stepResult)
+        sys.stderr.write(json.dumps(stepResult) + '\n')
+        if(stepResult['saturated']):
+            break
+    healthySteps = [step for step in results['steps'] if not step['saturated']]
+    saturatedSteps = [step for step in results['steps'] if step['saturated']]
+    results['saturation'] = {
+        'reached': len(saturatedSteps) > 0,
+        # The highest load the agent sustained, and the first it did not
+        'lastHealthyStep': healthySteps[-1]['step'] if healthySteps else None,
+        'maxSustainedApps': healthySteps[-1]['apps'] if healthySteps else None,
+        'maxSustainedDatumsPerSecond': healthySteps[-1]['deliveredDatumsPerSecond'] if healthySteps else None,
+        'firstSaturatedStep': saturatedSteps[0]['step'] if saturatedSteps else None
+    }
+
+
+def runLoad(args, results):
+    workDir = tempfile.mkdtemp(prefix='davra-load-certs-')
+    (certFile, keyFile) = (None, None)
+    if(not args.http):
+        (certFile, keyFile) = (os.path.join(workDir, 'server.crt'), os.path.join(workDir, 'server.key'))
+        bench_server.createSelfSignedCert(certFile, keyFile)
+    recorder = LoadRecorder()
+    server = bench_server.StubServer(benchRun.deviceUuid, args.server_latency_ms / 1000.0, 0.0, args.server_failure_rate, \
+        certFile, keyFile, recorder.onIotData, args.server_port).start()
+    (broker, agentProcess, sandboxDir) = (None, None, None)
+    try:
+        if(args.attach):
+            (brokerHost, brokerPort) = (args.broker_host, args.broker_port)
+            results['settings']['serverUrl'] = server.getUrl()
+            if(certFile is not None):
+                results['settings']['serverCaFile'] = certFile
+        else:
+            (broker, brokerKind) = bench_broker.startBroker(args.broker)
+            results['settings']['brokerUsed'] = brokerKind
+            (brokerHost, brokerPort) = ('127.0.0.1', broker.port)
+            sandboxDir = benchRun.createSandbox(args, server.getUrl(), broker.port, certFile, keyFile)
+            agentProcess = benchRun.startAgent(sandboxDir, certFile)
+            if(server.waitForEvent('davra.agent.started', args.startup_timeout) is None):
+                raise RuntimeError('The agent did not start, see ' + os.path.join(sandboxDir, 'agent.out'))
+        runRamp(args, results, recorder, brokerHost, brokerPort)
+    finally:
+        if(agentProcess is not None):
+            agentStats = benchRun.stopAgent(agentProcess, sandboxDir)
+            if(agentStats is not None):
+                results['agentScheduler'] = agentStats['scheduler']
+        results['server'] = server.getStats()
+        if(broker is not None):
+            broker.stop()
+        server.stop()
+        if(sandboxDir is not None):
+            shutil.rmtree(sandboxDir, ignore_errors=True)
+        if(not args.attach):
+            shutil.rmtree(workDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = parseArguments()
+    resultsOutput = sys.stdout
+    sys.stdout = sys.stderr
+    results = {
+        'benchmark': 'davra-agent-load',
+        'timestamp': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': { key: value for key, value in vars(args).items() if key != 'output' }
+    }
+    exitCode = 0
+    try:
+        runLoad(args, results)
+    except Exception as e:
+        results['error'] = str(e)
+        exitCode = 1
+    resultsJson = json.dumps(results, indent=4)
+    if(args.output):
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(resultsJson + "\n")
+    resultsOutput.write(resultsJson + "\n")
+    resultsOutput.flush()
+    os._exit(exitCode)
@@ -0,0 +1,499 @@
+# Offline benchmark of the Davra Agent
+# Runs the real agent (bench_agent.py) against a stub Davra server (bench_server.py), a local MQTT broker
+# (bench_broker.py) and a fake PLC (bench_rsc.py), drives it from a Device App through davra_sdk, and reports:
+#   startup            seconds from launching the agent to its davra.agent.started event and first heartbeat
+#   appToServerLatency milliseconds from davra_sdk.sendIotData in the app to the datum reaching the server
+#   throughput         datums per second from apps, through the agent's sendIotDataToServer, to the server
+#   heartbeatTick      milliseconds per heartbeat and per PLC metrics tick inside the agent
+#   agentMemory        the agent's RSS after startup and after the throughput run, and its peak. The run fails
+#                      (exit code 1) when the peak is above --max-rss-mb, as a memory footprint regression check
+#   serverStateDrift   whether the agent, restarted with its server state cache in place, sends its labels and
+#                      attributes again once they are removed from the device record. The run fails if it does not
+#   gatewayOutage      a second agent in gateway mode (--gateway-endpoints fake PLCs) while every server request
+#                      fails for --outage-seconds: the peak of its uplink queue and of its RSS, and whether the queue
+#                      drains once the server is back. The run fails if the queue goes above uplinkMaxQueuedBytes,
+#                      the RSS above --gateway-max-rss-mb, or the queue does not drain
+# The results are written as JSON to stdout (and to --output), everything else goes to stderr.
+# Needs openssl for the HTTPS stub server (or use --http) and paho-mqtt, requests as the agent does.
+#
+#   python benchmark/run_benchmark.py --output results.json --server-latency-ms 20 --server-failure-rate 0.01
+#
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+agentDir = os.path.dirname(benchmarkDir)
+sys.path.insert(0, agentDir)
+sys.path.insert(0, benchmarkDir)
+import bench_broker
+import bench_server
+
+
+deviceUuid = 'bench-device-0000-0000-000000000000'
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the Davra Agent')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--http', action='store_true', help='run the stub server over plain HTTP instead of HTTPS')
+    parser.add_argument('--broker', default='auto', choices=['auto', 'mosquitto', 'inprocess'])
+    parser.add_argument('--server-latency-ms', type=float, default=0, help='delay added to every server response')
+    parser.add_argument('--server-latency-jitter-ms', type=float, default=0, help='random extra delay, up to this')
+    parser.add_argument('--server-failure-rate', type=float, default=0, help='fraction of requests answered with 503')
+    parser.add_argument('--rsc-latency-ms', type=float, default=5, help='duration of every fake RSC call')
+    parser.add_argument('--heartbeat-interval', type=float, default=1, help='agent heartbeat and PLC metrics interval')
+    parser.add_argument('--latency-samples', type=int, default=200)
+    parser.add_argument('--latency-rate', type=float, default=20, help='latency datums sent per second')
+    parser.add_argument('--throughput-seconds', type=float, default=10)
+    parser.add_argument('--batch-size', type=int, default=50, help='datums per sendIotData in the throughput run')
+    parser.add_argument('--max-in-flight', type=int, default=1000, \
+        help='datums sent but not yet at the server before the throughput run waits')
+    parser.add_argument('--trace-sample-rate', type=float, default=0, \
+        help='fraction of app messages traced, giving davra_trace_stage_seconds in agentMetrics')
+    # The agent peaks at about 35MB here (Python 3.11, Linux x86_64), the default leaves room for other platforms
+    parser.add_argument('--max-rss-mb', type=float, default=50, \
+        help='fail if the agent\'s peak RSS under load is above this many megabytes (0 to only report it)')
+    parser.add_argument('--drain-timeout', type=float, default=30, help='seconds to wait for datums still in flight')
+    parser.add_argument('--gateway-endpoints', type=int, default=50, help='fake PLCs in the gateway outage run')
+    parser.add_argument('--gateway-interval', type=float, default=0.1, help='seconds between acquisitions of each fake PLC')
+    parser.add_argument('--outage-seconds', type=float, default=30, \
+        help='how long the server fails every request in the gateway outage run (0 skips that run)')
+    parser.add_argument('--gateway-max-rss-mb', type=float, default=60, \
+        help='fail the gateway outage run if the agent\'s peak RSS is above this, in MB (0 only reports it)')
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--agent-config', help='json file of extra agent config, eg { "telemetryRules": [...] }')
+    parser.add_argument('--keep-sandbox', action='store_true', help='keep the agent sandbox (config, logs) afterwards')
+    return parser.parse_args()
+
+
+# Nearest-rank percentile of an already sorted list
+def getPercentile(sortedValues, fraction):
+    if(len(sortedValues) == 0):
+        return None
+    return sortedValues[min(len(sortedValues) - 1, max(0, int(round(fraction * len(sortedValues) + 0.5)) - 1))]
+
+
+# { count, p50, p90, p99, max, mean } of a list of seconds, in milliseconds
+def summariseMilliseconds(durations):
+    values = sorted(duration * 1000.0 for duration in durations)
+    if(len(values) == 0):
+        return { 'count': 0 }
+    return {
+        'count': len(values),
+        'p50': round(getPercentile(values, 0.50), 3),
+        'p90': round(getPercentile(values, 0.90), 3),
+        'p99': round(getPercentile(values, 0.99), 3),
+        'max': round(values[-1], 3),
+        'mean': round(sum(values) / len(values), 3)
+    }
+
+
+# Collects the benchmark datums as the stub server receives them
+class DatumRecorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencyArrivals = {}
+        self.throughputCount = 0
+        self.lastThroughputArrival = None
+
+    def onIotData(self, items, arrivalTime):
+        with self.lock:
+            for item in items:
+                if(item.get('name') == 'bench.latency'):
+                    self.latencyArrivals.setdefault(item.get('value'), arrivalTime)
+                elif(item.get('name') == 'bench.throughput'):
+                    self.throughputCount += 1
+                    self.lastThroughputArrival = arrivalTime
+
+    def waitFor(self, condition, timeout):
+        endTime = time.monotonic() + timeout
+        while time.monotonic() < endTime:
+            with self.lock:
+                if(condition()):
+                    return True
+            time.sleep(0.05)
+        return False
+
+
+# extraConfig is merged into the agent config last, eg for gateway mode
+def createSandbox(args, serverUrl, brokerPort, certFile, keyFile, extraConfig = None):
+    sandboxDir = tempfile.mkdtemp(prefix='davra-bench-')
+    os.makedirs(os.path.join(sandboxDir, 'certs'))
+    if(certFile is not None):
+        shutil.copy(certFile, os.path.join(sandboxDir, 'certs', 'device2.crt'))
+        shutil.copy(keyFile, os.path.join(sandboxDir, 'certs', 'device2.key'))
+    else:
+        bench_server.createSelfSignedCert(os.path.join(sandboxDir, 'certs', 'device2.crt'), \
+            os.path.join(sandboxDir, 'certs', 'device2.key'))
+    config = {
+        'server': serverUrl,
+        'UUID': deviceUuid,
+        'heartbeatInterval': args.heartbeat_interval,
+        'hostMetricsInterval': args.heartbeat_interval,
+        'scriptMaxTime': 600,
+        'agentRepository': 'TBD',
+        'mqttBrokerAgentHost': '127.0.0.1',
+        'mqttBrokerAgentPort': brokerPort,
+        # No Davra server broker to connect to
+        'mqttBrokerServerHost': '',
+        'mqttBrokerServerPort': 0,
+        # Start every task at once, so startup is measured rather than the fleet spread
+        'startupRamp': 0,
+        'scheduleJitter': 0,
+        'statsPort': bench_broker.getFreePort()
+    }
+    if(getattr(args, 'agent_config', None)):
+        with open(args.agent_config) as agentConfigFile:
+            config.update(json.load(agentConfigFile))
+    config.update(extraConfig or {})
+    with open(os.path.join(sandboxDir, 'config.json'), 'w') as configFile:
+        json.dump(config, configFile, indent=4)
+    with open(os.path.join(sandboxDir, 'bench.json'), 'w') as benchFile:
+        json.dump({ 'rscLatency': args.rsc_latency_ms / 1000.0 }, benchFile)
+    return sandboxDir
+
+
+# The agent's own instrumentation, from its localhost stats endpoint
+def getAgentMetrics(sandboxDir):
+    try:
+        with open(os.path.join(sandboxDir, 'config.json')) as configFile:
+            statsPort = json.load(configFile)['statsPort']
+        with urllib.request.urlopen('http://127.0.0.1:' + str(statsPort) + '/stats', timeout=10) as response:
+            stats = json.loads(response.read())
+        return { 'histograms': stats['histograms'], 'counters': stats['counters'], 'gauges': stats['gauges'], \
+            'watchdog': stats.get('watchdog') }
+    except Exception as e:
+        return { 'error': str(e) }
+
+
+# The resident memory of a process, now and at its peak, in megabytes (Linux only, otherwise None)
+def getProcessMemory(pid):
+    try:
+        with open('/proc/' + str(pid) + '/status') as statusFile:
+            fields = dict(line.split(':', 1) for line in statusFile if ':' in line)
+        return { 'rssMb': round(int(fields['VmRSS'].split()[0]) / 1024.0, 1), \
+            'peakRssMb': round(int(fields['VmHWM'].split()[0]) / 1024.0, 1) }
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def checkAgentMemory(args, results, agentProcess):
+    memory = getProcessMemory(agentProcess.pid)
+    if(memory is None):
+        return
+    results['agentMemory']['afterLoadMb'] = memory['rssMb']
+    results['agentMemory']['peakMb'] = memory['peakRssMb']
+    if(args.max_rss_mb > 0):
+        results['agentMemory']['maxRssMb'] = args.max_rss_mb
+        results['agentMemory']['withinLimit'] = memory['peakRssMb'] <= args.max_rss_mb
+
+
+# Wait until each of the agent's scheduled tasks in taskNames has run at least once
+def waitForTaskRuns(sandboxDir, taskNames, timeout):
+    with open(os.path.join(sandboxDir, 'config.json')) as configFile:
+        statsPort = json.load(configFile)['statsPort']
+    endTime = time.monotonic() + timeout
+    while time.monotonic() < endTime:
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:' + str(statsPort) + '/stats', timeout=10) as response:
+                schedulerStats = json.loads(response.read())['scheduler']
+            if(all(schedulerStats.get(name, {}).get('runCount', 0) > 0 for name in taskNames)):
+                return True
+        except Exception:
+            pass
+        time.sleep(0.1)
+    return False
+
+
+def startAgent(sandboxDir, caFile):
+    environment = dict(os.environ)
+    environment['PYTHONUNBUFFERED'] = '1'
+    if(caFile is not None):
+        # Trust the stub server's self-signed certificate
+        environment['REQUESTS_CA_BUNDLE'] = caFile
+    agentOutput = open(os.path.join(sandboxDir, 'agent.out'), 'w')
+    return subprocess.Popen([sys.executable, os.path.join(benchmarkDir, 'bench_agent.py'), sandboxDir], \
+        cwd=sandboxDir, env=environment, stdout=agentOutput, stderr=subprocess.STDOUT)
+
+
+def stopAgent(agentProcess, sandboxDir):
+    if(agentProcess.poll() is None):
+        agentProcess.terminate()
+        try:
+            agentProcess.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            agentProcess.kill()
+            agentProcess.wait()
+    try:
+        with open(os.path.join(sandboxDir, 'agentStats.json')) as statsFile:
+            return json.load(statsFile)
+    except Exception:
+        return None
+
+
+def collectAgentResults(results, agentProcess, sandboxDir):
+    if(agentProcess.poll() is None):
+        results['agentMetrics'] = getAgentMetrics(sandboxDir)
+    agentStats = stopAgent(agentProcess, sandboxDir)
+    if(agentStats is not None):
+        results['heartbeatTickMs'] = summariseMilliseconds(agentStats['tickDurations']['heartbeat'])
+        results['plcMetricsTickMs'] = summariseMilliseconds(agentStats['tickDurations']['plcMetrics'])
+        results['agentScheduler'] = agentStats['scheduler']
+
+
+# Restart the agent in the same sandbox, so its server state cache says the server already has its labels and
+# attributes, then remove them from the device record and time how long verifyServerState takes to restore them
+def runServerStateCheck(args, server, sandboxDir, caFile, results):
+    expectedState = server.getDeviceState()
+    configPath = os.path.join(sandboxDir, 'config.json')
+    with open(configPath) as configFile:
+        config = json.load(configFile)
+    config['serverStateVerifyInterval'] = 2
+    with open(configPath, 'w') as configFile:
+        json.dump(config, configFile, indent=4)
+    server.forgetEvents()
+    agentProcess = startAgent(sandboxDir, caFile)
+    try:
+        if(server.waitForEvent('davra.agent.started', args.startup_timeout) is None):
+            raise RuntimeError('The agent did not restart, see ' + os.path.join(sandboxDir, 'agent.out'))
+        # The startup runs set the labels and attributes (all cache hits) and find nothing drifted yet
+        waitForTaskRuns(sandboxDir, ['verifyServerState', 'plcHealth'], args.startup_timeout)
+        server.setDeviceState({}, {})
+        driftTime = time.monotonic()
+        restored = False
+        while time.monotonic() - driftTime < args.drain_timeout:
+            if(server.getDeviceState() == expectedState):
+                restored = True
+                break
+            time.sleep(0.1)
+        results['serverStateDrift'] = {
+            'labels': len(expectedState['labels']),
+            'attributes': len(expectedState['customAttributes']),
+            'restored': restored,
+            'seconds': round(time.monotonic() - driftTime, 3) if restored else None
+        }
+    finally:
+        stopAgent(agentProcess, sandboxDir)
+
+
+# Run an agent in gateway mode, polling gateway_endpoints fake PLCs, and fail every server request for
+# outage_seconds, so the uplink queue fills up to its byte cap. Its size is read from the agent's stats endpoint
+# during the outage, then the server is brought back and the queue should drain
+def runGatewayOutageCheck(args, server, brokerPort, certFile, keyFile, results):
+    maxQueuedBytes = 8000000
+    sandboxDir = createSandbox(args, server.getUrl(), brokerPort, certFile, keyFile, {
+        'plcEndpoints': [{ 'name': 'bench-plc-' + str(index), 'host': '127.0.0.1', \
+            'UUID': 'bench-plc-' + str(index).zfill(4) + '-0000-0000-000000000000', 'interval': args.gateway_interval } \
+            for index in range(args.gateway_endpoints)],
+        # The byte cap is the one under test, so the count cap is out of its way
+        'uplinkMaxQueued': 10000000,
+        'uplinkMaxQueuedBytes': maxQueuedBytes,
+        'statsPort': bench_broker.getFreePort()
+    })
+    with open(os.path.join(sandboxDir, 'config.json')) as configFile:
+        statsPort = json.load(configFile)['statsPort']
+    def getUplinkStats():
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:' + str(statsPort) + '/stats', timeout=10) as response:
+                return json.loads(response.read()).get('uplink')
+        except Exception:
+            return None
+    server.forgetEvents()
+    agentProcess = startAgent(sandboxDir, certFile)
+    outage = { 'endpoints': args.gateway_endpoints, 'outageSeconds': args.outage_seconds, 'maxQueuedBytes': maxQueuedBytes }
+    results['gatewayOutage'] = outage
+    try:
+        if(server.waitForEvent('davra.agent.started', args.startup_timeout) is None):
+            raise RuntimeError('The gateway agent did not start, see ' + os.path.join(sandboxDir, 'agent.out'))
+        (peakQueued, peakQueuedBytes, uplinkStats) = (0, 0, None)
+        server.failureRate = 1.0
+        try:
+            outageStart = time.monotonic()
+            while time.monotonic() - outageStart < args.outage_seconds:
+                uplinkStats = getUplinkStats() or uplinkStats
+                if(uplinkStats is not None):
+                    peakQueued = max(peakQueued, uplinkStats['queued'])
+                    peakQueuedBytes = max(peakQueuedBytes, uplinkStats['queuedBytes'])
+                time.sleep(0.5)
+        finally:
+            server.failureRate = args.server_failure_rate
+        memory = getProcessMemory(agentProcess.pid)
+        outage.update({
+            'peakQueued': peakQueued,
+            'peakQueuedBytes': peakQueuedBytes,
+            # Above 0 when the cap was reached (and the oldest data dropped), so the run covered it
+            'dropped': uplinkStats['dropped'] if uplinkStats is not None else None,
+            'withinCap': peakQueuedBytes <= maxQueuedBytes,
+            'peakRssMb': memory['peakRssMb'] if memory is not None else None
+        })
+        if(memory is not None and args.gateway_max_rss_mb > 0):
+            outage['maxRssMb'] = args.gateway_max_rss_mb
+            outage['withinRssLimit'] = memory['peakRssMb'] <= args.gateway_max_rss_mb
+        # Acquisitions carry on, so the queue is never empty for long: it has drained once as much has been
+        # sent as was queued when the outage ended
+        (drainStart, outage['drained']) = (time.monotonic(), False)
+        backlogStats = getUplinkStats() or uplinkStats
+        while backlogStats is not None and time.monotonic() - drainStart < args.drain_timeout:
+            uplinkStats = getUplinkStats()
+            if(uplinkStats is not None and uplinkStats['sent'] - backlogStats['sent'] >= backlogStats['queued']):
+                outage['drained'] = True
+                outage['drainSeconds'] = round(time.monotonic() - drainStart, 3)
+                break
+            time.sleep(0.5)
+    finally:
+        stopAgent(agentProcess, sandboxDir)
+        if(args.keep_sandbox):
+            outage['sandbox'] = sandboxDir
+        else:
+            shutil.rmtree(sandboxDir, ignore_errors=True)
+
+
+# Send latency datums one at a time at a steady rate. Returns { sequence: sendTime }
+def runLatencyPhase(davraSdk, args):
+    sendTimes = {}
+    interval = 1.0 / args.latency_rate
+    nextSendTime = time.monotonic()
+    for sequence in range(args.latency_samples):
+        time.sleep(max(0.0, nextSendTime - time.monotonic()))
+        sendTimes[sequence] = time.monotonic()
+        davraSdk.sendIotData({ 'name': 'bench.latency', 'value': sequence, 'msg_type': 'datum' })
+        nextSendTime += interval
+    return sendTimes
+
+
+# Send batches as fast as the agent forwards them for throughput_seconds, keeping at most max_in_flight
+# datums between the app and the server so the agent is measured rather than the MQTT client's queue.
+# Returns (datumsSent, startTime)
+def runThroughputPhase(davraSdk, recorder, args):
+    datumsSent = 0
+    startTime = time.monotonic()
+    while time.monotonic() - startTime < args.throughput_seconds:
+        if(datumsSent - recorder.throughputCount >= args.max_in_flight):
+            time.sleep(0.001)
+            continue
+        davraSdk.sendIotData([{ 'name': 'bench.throughput', 'value': datumsSent + index, 'msg_type': 'datum' } \
+            for index in range(args.batch_size)])
+        datumsSent += args.batch_size
+    return (datumsSent, startTime)
+
+
+# Fills in results as it goes, so whatever was measured is kept if a later phase fails
+def runBenchmark(args, results):
+    workDir = tempfile.mkdtemp(prefix='davra-bench-certs-')
+    (certFile, keyFile) = (None, None)
+    if(not args.http):
+        (certFile, keyFile) = (os.path.join(workDir, 'server.crt'), os.path.join(workDir, 'server.key'))
+        bench_server.createSelfSignedCert(certFile, keyFile)
+    recorder = DatumRecorder()
+    server = bench_server.StubServer(deviceUuid, args.server_latency_ms / 1000.0, args.server_latency_jitter_ms / 1000.0, \
+        args.server_failure_rate, certFile, keyFile, recorder.onIotData).start()
+    (broker, brokerKind) = bench_broker.startBroker(args.broker)
+    results['settings']['brokerUsed'] = brokerKind
+    sandboxDir = createSandbox(args, server.getUrl(), broker.port, certFile, keyFile)
+    agentProcess = None
+    try:
+        launchTime = time.monotonic()
+        agentProcess = startAgent(sandboxDir, certFile)
+        startedTime = server.waitForEvent('davra.agent.started', args.startup_timeout)
+        heartbeatTime = server.waitForEvent('davra.agent.heartbeat', args.startup_timeout)
+        results['startup'] = {
+            'agentStartedSeconds': round(startedTime - launchTime, 3) if startedTime is not None else None,
+            'firstHeartbeatSeconds': round(heartbeatTime - launchTime, 3) if heartbeatTime is not None else None
+        }
+        if(startedTime is None or agentProcess.poll() is not None):
+            raise RuntimeError('The agent did not start, see ' + os.path.join(sandboxDir, 'agent.out'))
+        results['agentMemory'] = { 'afterStartupMb': (getProcessMemory(agentProcess.pid) or {}).get('rssMb') }
+
+        # The Device App side, in this process
+        import davra_sdk as davraSdk
+        davraSdk.mqttBrokerAgentHost = '127.0.0.1'
+        davraSdk.mqttBrokerAgentPort = broker.port
+        davraSdk.traceSampleRate = args.trace_sample_rate
+        davraSdk.connectToAgent('davra-benchmark')
+
+        sendTimes = runLatencyPhase(davraSdk, args)
+        recorder.waitFor(lambda: len(recorder.latencyArrivals) >= len(sendTimes), args.drain_timeout)
+        with recorder.lock:
+            latencies = [recorder.latencyArrivals[sequence] - sendTime for sequence, sendTime in sendTimes.items() \
+                if sequence in recorder.latencyArrivals]
+        results['appToServerLatencyMs'] = summariseMilliseconds(latencies)
+        results['appToServerLatencyMs']['lost'] = len(sendTimes) - len(latencies)
+
+        (datumsSent, throughputStart) = runThroughputPhase(davraSdk, recorder, args)
+        recorder.waitFor(lambda: recorder.throughputCount >= datumsSent, args.drain_timeout)
+        with recorder.lock:
+            (datumsReceived, lastArrival) = (recorder.throughputCount, recorder.lastThroughputArrival)
+        elapsed = (lastArrival - throughputStart) if lastArrival is not None else None
+        results['throughput'] = {
+            'batchSize': args.batch_size,
+            'datumsSent': datumsSent,
+            'datumsReceived': datumsReceived,
+            'lost': datumsSent - datumsReceived,
+            'seconds': round(elapsed, 3) if elapsed is not None else None,
+            'datumsPerSecond': round(datumsReceived / elapsed, 1) if elapsed else 0.0
+        }
+        checkAgentMemory(args, results, agentProcess)
+        collectAgentResults(results, agentProcess, sandboxDir)
+        agentProcess = None
+        runServerStateCheck(args, server, sandboxDir, certFile, results)
+        if(args.outage_seconds > 0 and args.gateway_endpoints > 0):
+            runGatewayOutageCheck(args, server, broker.port, certFile, keyFile, results)
+    finally:
+        if(agentProcess is not None):
+            collectAgentResults(results, agentProcess, sandboxDir)
+        results['server'] = server.getStats()
+        broker.stop()
+        server.stop()
+        shutil.rmtree(workDir, ignore_errors=True)
+        if(args.keep_sandbox):
+            results['sandbox'] = sandboxDir
+        else:
+            shutil.rmtree(sandboxDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = parseArguments()
+    # Only the results go to stdout, so they can be piped into other tools
+    resultsOutput = sys.stdout
+    sys.stdout = sys.stderr
+    results = {
+        'benchmark': 'davra-agent',
+        'timestamp': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': { key: value for key, value in vars(args).items() if key not in ['output', 'keep_sandbox'] }
+    }
+    exitCode = 0
+    try:
+        runBenchmark(args, results)
+    except Exception as e:
+        results['error'] = str(e)
+        exitCode = 1
+    if(results.get('agentMemory', {}).get('withinLimit') is False):
+        sys.stderr.write('The agent\'s peak RSS ' + str(results['agentMemory']['peakMb']) + 'MB is above --max-rss-mb\n')
+        exitCode = 1
+    if(results.get('serverStateDrift', {}).get('restored') is False):
+        sys.stderr.write('The agent did not send its drifted labels and attributes again after a restart\n')
+        exitCode = 1
+    gatewayOutage = results.get('gatewayOutage', {})
+    if(gatewayOutage.get('withinCap') is False or gatewayOutage.get('withinRssLimit') is False \
+        or gatewayOutage.get('drained') is False):
+        sys.stderr.write('The gateway agent\'s uplink queue was not bounded or did not drain during the outage run\n')
+        exitCode = 1
+    resultsJson = json.dumps(results, indent=4)
+    if(args.output):
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(resultsJson + "\n")
+    resultsOutput.write(resultsJson + "\n")
+    resultsOutput.flush()
+    os._exit(exitCode)
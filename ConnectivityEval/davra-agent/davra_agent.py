@@ -11,10 +11,26 @@ from requests.auth import HTTPBasicAuth
 import json 
 from pprint import pprint
 import datetime
+import threading
+import collections
 import paho.mqtt.client as mqtt
 import davra_lib as comDavra
-from PyPlcnextRsc import Device
-from PyPlcnextRsc.Arp.Device.Interface.Services import IDeviceInfoService, IDeviceStatusService
+import davra_delta as davraDelta
+import davra_sysinfo
+import davra_scheduler as davraScheduler
+import davra_catalogue as davraCatalogue
+import davra_plc as davraPlc
+import davra_uplink as davraUplink
+import davra_gateway as davraGateway
+import davra_metrics as davraMetrics
+import davra_profiler as davraProfiler
+import davra_watchdog as davraWatchdog
+import davra_history as davraHistory
+import davra_rules as davraRules
+import davra_anomaly as davraAnomaly
+import fcntl, termios, struct
+from PyPlcnextRsc import RscVariant, RscType
+from PyPlcnextRsc.Arp.Plc.Gds.Services import IDataAccessService, WriteItem, DataAccessError
 # If you add new libraries to the agent, update requirements.txt
 
 
@@ -40,6 +56,8 @@ currentFunctionJson = currentFunctionDir + "/currentFunction.json"
 flagIsFunctionRunning = False
 flagIsScriptRunning = False
 flagIsJobRunning = False
+# The supervised RSC session with the local PLC (None in gateway mode)
+plcSession = None
 
 
 def sendHeartbeatMetricsToServer():
@@ -59,107 +77,164 @@ def sendHeartbeatMetricsToServer():
     return
 
 
+# Host metrics (cpu, ram, disk, network, load, uptime) are sampled every hostMetricsInterval seconds
+# and aggregated locally until they go up in the same batch as the PLC metrics
+def getHostMetricsInterval():
+    return int(comDavra.conf.get('hostMetricsInterval', 60))
+
+
+def sampleHostMetrics():
+    davra_sysinfo.sampleHostMetrics(comDavra.conf.get('hostMetricsDiskPath', '/'))
+
+
+# Turn the host metrics aggregated since the last upload into datums for the server
+def getHostMetricsForServer():
+    dataToSend = []
+    for metricName, (count, mean, minimum, maximum) in davra_sysinfo.drainHostMetrics().items():
+        dataToSend.append({
+            "UUID": comDavra.conf['UUID'],
+            "name": metricName,
+            # Uptime only ever grows, so the latest reading is the useful one
+            "value": maximum if metricName == 'uptime' else mean,
+            "msg_type": "datum",
+        })
+    return dataToSend
+
+
 def secureInfoSupplier():
     return (os.environ["PLC_USER"], os.environ["PLC_PASS"])
 
 
+# Returns True once the server has the PLC system info
 def sendPLCSystemInfoToServer(device):
     try:
-        device_info_service = IDeviceInfoService(device)
-        info_items = [
-            "General.ArticleName",
-            "General.ArticleNumber",
-            "General.SerialNumber",
-            "General.Firmware.Version",
-            "General.Hardware.Version",
-            "Interfaces.Ethernet.1.0.Mac"
-        ]
-        for identifier, result in zip(info_items, device_info_service.GetItems(info_items)):
-            print(identifier.rjust(40) + " : " + str(result.GetValue()))
-
-        # Get individual device info items
-        article_name = device_info_service.GetItems(["General.ArticleName"])[0].GetValue()
-        article_number = device_info_service.GetItems(["General.ArticleNumber"])[0].GetValue()
-        serial_number = device_info_service.GetItems(["General.SerialNumber"])[0].GetValue()
-        firmware_version = device_info_service.GetItems(["General.Firmware.Version"])[0].GetValue()
-        hardware_version = device_info_service.GetItems(["General.Hardware.Version"])[0].GetValue()
-        mac_address = device_info_service.GetItems(["Interfaces.Ethernet.1.0.Mac"])[0].GetValue()
-
-        # Update the device labels to reflect the PLC system info
-        comDavra.updateDeviceAttributeOnServer("articleName", article_name)
-        comDavra.updateDeviceAttributeOnServer("articleNumber", article_number)
-        comDavra.updateDeviceAttributeOnServer("serialNumber", serial_number)
-        comDavra.updateDeviceAttributeOnServer("firmwareVersion", firmware_version)
-        comDavra.updateDeviceAttributeOnServer("hardwareVersion", hardware_version)
-        comDavra.updateDeviceAttributeOnServer("macAddress", mac_address)
+        # Update the device attributes to reflect the PLC system info
+        # Only values the server does not already have are sent, in a single PATCH
+        return comDavra.updateDeviceAttributesOnServer(davraPlc.readPLCSystemInfo(device)).status_code == 200
 
     except Exception as e:
         comDavra.logError(f"Failed to fetch PLC info: {str(e)}")
     
-    return
+    return False
 
 
-def sendPLCMetricsToServer(device):
-    try:
-        device_status_service = IDeviceStatusService(device)
-        status_items = [
-            "Status.Cpu.0.Load.Percent",
-            "Status.Memory.Usage.Percent",
-            "Status.ProgramMemoryIEC.Usage.Percent",
-            "Status.DataMemoryIEC.Usage.Percent",
-            "Status.Board.Temperature.Centigrade",
-            "Status.Board.Humidity"
-        ]
-        for identifier, result in zip(status_items, device_status_service.GetItems(status_items)):
-            print(identifier.rjust(40) + " : " + str(result.GetValue()))
-
-        # Get individual device info items
-        cpu_load = device_status_service.GetItems(["Status.Cpu.0.Load.Percent"])[0].GetValue()
-        memory_usage = device_status_service.GetItems(["Status.Memory.Usage.Percent"])[0].GetValue()
-        program_memory_usage = device_status_service.GetItems(["Status.ProgramMemoryIEC.Usage.Percent"])[0].GetValue()
-        data_memory_usage = device_status_service.GetItems(["Status.DataMemoryIEC.Usage.Percent"])[0].GetValue()
-        board_temperature = device_status_service.GetItems(["Status.Board.Temperature.Centigrade"])[0].GetValue()
-        board_humidity = device_status_service.GetItems(["Status.Board.Humidity"])[0].GetValue()
-
-        dataToSend = [{ 
-            "UUID": comDavra.conf['UUID'],
-            "name": "plcnext.cpu_load",
-            "value": cpu_load,
-            "msg_type": "datum",
-        }, { 
-            "UUID": comDavra.conf['UUID'],
-            "name": "plcnext.memory_usage",
-            "value": memory_usage,
-            "msg_type": "datum",
-        }, { 
-            "UUID": comDavra.conf['UUID'],
-            "name": "plcnext.program_memory_usage",
-            "value": program_memory_usage,
-            "msg_type": "datum",
-        }, { 
-            "UUID": comDavra.conf['UUID'],
-            "name": "plcnext.data_memory_usage",
-            "value": data_memory_usage,
-            "msg_type": "datum",
-        }, { 
-            "UUID": comDavra.conf['UUID'],
-            "name": "plcnext.board_temperature",
-            "value": board_temperature,
-            "msg_type": "datum",
-        }, { 
-            "UUID": comDavra.conf['UUID'],
-            "name": "plcnext.board_humidity",
-            "value": board_humidity,
-            "msg_type": "datum",
-        }]
+# Send the PLC status and the host metrics. The host metrics are sent even while the PLC is down
+# or if this agent has no local PLC (gateway mode)
+def sendPLCMetricsToServer():
+    if(plcSession is not None and plcAnomalies is not None):
+        # The PLC is sampled (and its samples kept in the history) by samplePLCMetrics, so only the means go up
+        dataToSend = plcAnomalies.drainSummaries(comDavra.conf['UUID'])
+    else:
+        dataToSend = readPLCMetrics()
+        recordHistory(dataToSend)
+
+    # Host metrics ride along in the same request
+    hostMetrics = getHostMetricsForServer()
+    recordHistory(hostMetrics)
+    dataToSend.extend(hostMetrics)
+    if dataToSend:
         comDavra.logInfo('Sending PLCnext data to: ' + comDavra.conf['server'] + ": " + comDavra.conf['UUID'])
         statusCode = comDavra.sendDataToServer(dataToSend).status_code
         comDavra.log('Response after sending PLCnext data: ' + str(statusCode))
-    
+
+    return
+
+
+def readPLCMetrics():
+    if(plcSession is None):
+        return []
+    try:
+        return plcSession.call(lambda device: davraPlc.readPLCStatusDatums(device, comDavra.conf['UUID'])) or []
     except Exception as e:
         comDavra.logError(f"Failed to fetch PLC metrics: {str(e)}")
+        return []
 
-    return
+
+# Check the local PLC session, reconnecting it if it dropped, and report the PLC system info after each connect
+# A report which fails is tried again on the next check
+reportedPLCConnectCount = 0
+def superviseLocalPLC():
+    global reportedPLCConnectCount
+    if(plcSession.checkHealth() and reportedPLCConnectCount != plcSession.connectCount):
+        connectCount = plcSession.connectCount
+        if(plcSession.call(sendPLCSystemInfoToServer) is True):
+            reportedPLCConnectCount = connectCount
+
+
+# Record a PLC going down or coming back up as an event on the PLC's device
+def onPLCStateChange(session, isUp, downtimeSeconds):
+    event = session.getStateEvent(isUp, downtimeSeconds)
+    if(uplink is not None):
+        uplink.add(event)
+    else:
+        comDavra.sendDataToServer(event)
+
+
+# The PLC does not convert types on a write, so each value is converted to the type of the variable
+# Integer values are checked against the range of the variable's type here, so a bad value fails on its own
+# rather than failing the batched write of every variable
+integerRscRanges = {
+    RscType.Int8: (-2 ** 7, 2 ** 7 - 1), RscType.Uint8: (0, 2 ** 8 - 1),
+    RscType.Int16: (-2 ** 15, 2 ** 15 - 1), RscType.Uint16: (0, 2 ** 16 - 1),
+    RscType.Int32: (-2 ** 31, 2 ** 31 - 1), RscType.Uint32: (0, 2 ** 32 - 1),
+    RscType.Int64: (-2 ** 63, 2 ** 63 - 1), RscType.Uint64: (0, 2 ** 64 - 1)
+}
+realRscTypes = [RscType.Real32, RscType.Real64]
+stringRscTypes = [RscType.Utf8String, RscType.String, RscType.AnsiString, RscType.Utf16String]
+def convertValueForPLC(value, rscType):
+    if(rscType == RscType.Bool):
+        if(type(value) == str):
+            if(value.strip().lower() not in ['true', 'false', '1', '0']):
+                raise ValueError('not a boolean: ' + value)
+            return value.strip().lower() in ['true', '1']
+        return bool(value)
+    if(rscType in integerRscRanges):
+        integer = getIntegerValue(value)
+        (lowest, highest) = integerRscRanges[rscType]
+        if(integer < lowest or integer > highest):
+            raise ValueError(str(integer) + ' is out of range for ' + rscType.name + ' (' + str(lowest) + ' to ' + str(highest) + ')')
+        return integer
+    if(rscType in realRscTypes):
+        return float(value)
+    if(rscType in stringRscTypes):
+        return str(value)
+    raise ValueError('writing ' + rscType.name + ' variables is not supported')
+
+
+# A number, or its text, as an int. Values with a fractional part are rejected rather than truncated
+def getIntegerValue(value):
+    if(type(value) == str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            value = float(value)
+    if(type(value) == float and value.is_integer() is False):
+        raise ValueError('not an integer: ' + str(value))
+    return int(value)
+
+
+# Write several PLC variables, given as { variableName: value }, eg { "Arp.Plc.Eclr/MainInstance.setpoint": 21.5 }
+# One batched read finds the type of every variable, then one batched write sets all of them,
+# so the values land in the same PLC cycle as far as the PLC allows.
+# Returns { variableName: "ok" or the reason it was not written }
+def writePLCVariables(device, values):
+    dataAccessService = IDataAccessService(device)
+    names = list(values.keys())
+    results = {}
+    writeItems = []
+    for name, readItem in zip(names, dataAccessService.Read(names)):
+        if(readItem.Error != DataAccessError.NONE):
+            results[name] = DataAccessError(readItem.Error).name
+            continue
+        try:
+            rscType = readItem.Value.GetType()
+            writeItems.append(WriteItem(name, RscVariant(convertValueForPLC(values[name], rscType), rscType)))
+        except Exception as e:
+            results[name] = 'InvalidValue: ' + str(e)
+    if(len(writeItems) > 0):
+        for writeItem, error in zip(writeItems, dataAccessService.Write(writeItems)):
+            results[writeItem.PortName] = 'ok' if error == DataAccessError.NONE else DataAccessError(error).name
+    return { name: results[name] for name in names }
 
 
 
@@ -405,6 +480,79 @@ def updateFunctionStatusAsReportedByDeviceApp(functionInfo):
     checkFunctionFinished()
     return
 
+
+# Run a function which takes a while (eg a profile or a backfill) on its own thread, so the MQTT callback or
+# job task which started it carries on. Only one of each runs at a time. The thread keeps its own copy of the
+# function record and of the job which started it, since another function may take over currentFunction.json
+# meanwhile. work(functionParameterValues) returns the response, or raises to fail the function
+backgroundFunctionThreads = {}
+def runFunctionInBackground(functionName, functionParameterValues, work):
+    runningThread = backgroundFunctionThreads.get(functionName)
+    if(runningThread is not None and runningThread.is_alive()):
+        comDavra.logWarning('Function ' + functionName + ' is already running')
+        comDavra.upsertJsonEntry(currentFunctionJson, 'response', 'Function ' + functionName + ' is already running')
+        comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'failed')
+        checkFunctionFinished()
+        return
+    functionInfo = { 'functionName': functionName, \
+        'functionParameterValues': dict(functionParameterValues), \
+        'status': 'running', \
+        'startTime': comDavra.getMilliSecondsSinceEpoch() }
+    thread = threading.Thread(target=runBackgroundFunction, args=(functionInfo, getRunningJobUuid(functionName), work), \
+        name='davra-' + functionName.replace('agent-action-', ''), daemon=True)
+    backgroundFunctionThreads[functionName] = thread
+    thread.start()
+    return
+
+
+def runBackgroundFunction(functionInfo, jobUuid, work):
+    try:
+        functionInfo['response'] = work(functionInfo['functionParameterValues'])
+        functionInfo['status'] = 'completed'
+    except Exception as e:
+        functionInfo['response'] = str(e)
+        functionInfo['status'] = 'failed'
+    functionInfo['endTime'] = comDavra.getMilliSecondsSinceEpoch()
+    # Nothing may raise from here, or the result would be lost with the thread
+    try:
+        with jobStateLock:
+            if(getCurrentFunctionUuid() == functionInfo['functionParameterValues']['functionUuid']):
+                comDavra.upsertJsonEntry(currentFunctionJson, 'response', functionInfo['response'])
+                comDavra.upsertJsonEntry(currentFunctionJson, 'status', functionInfo['status'])
+                checkFunctionFinished()
+                return
+            # Another function took over currentFunction.json, so report this one directly
+            comDavra.log('Function ' + functionInfo['functionName'] + ' finished after another function started')
+            reportFunctionFinishedAsEventToServer(functionInfo)
+            if(jobUuid is not None and getRunningJobUuid(functionInfo['functionName']) == jobUuid):
+                updateJobWithResult(functionInfo['status'], functionInfo['response'])
+                checkCurrentJob()
+    except Exception as e:
+        comDavra.logError('Could not report the result of function ' + functionInfo['functionName'] + ': ' + str(e))
+    return
+
+
+# The functionUuid of the function in currentFunction.json, or None if there is none
+def getCurrentFunctionUuid():
+    try:
+        with open(currentFunctionJson) as data_file:
+            return json.load(data_file)['functionParameterValues']['functionUuid']
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+# The UUID of the current job if it is running functionName, otherwise None
+def getRunningJobUuid(functionName):
+    try:
+        with open(currentJobJson) as data_file:
+            jobObject = json.load(data_file)
+        if(jobObject['devices'][0]['status'] == 'running' and jobObject['jobConfig']['functionName'] == functionName):
+            return jobObject['UUID']
+    except (IOError, ValueError, KeyError, TypeError, IndexError):
+        pass
+    return None
+
+
 # Function: Reboot this device        
 def agentFunctionReboot(functionParameterValues):
     # Put a file to indicate what is happening and start the reboot process
@@ -427,25 +575,60 @@ def checkIfJustBackAfterRebootTask():
             checkFunctionFinished()             
 
 
+# Download an artifact (tar.gz) from a url and extract it into extractPath
+def downloadAndExtractArtifact(artifactUrl, downloadPath, extractPath):
+    comDavra.ensureDirectoryExists(downloadPath)
+    comDavra.ensureDirectoryExists(extractPath)
+    comDavra.runCommandWithTimeout('cd ' + downloadPath + ' && /usr/bin/curl -LO ' + artifactUrl, 300)
+    comDavra.runCommandWithTimeout('cd ' + downloadPath + ' && /bin/tar -xvf ./* -C ' + extractPath, 300)
+
+
+# Rebuild an app bundle into bundlePath from a delta against an app already installed under installationDir/apps
+# Returns True if the bundle was rebuilt and its hash verified
+def reconstructAppFromDelta(deltaFile, tmpPath, bundlePath):
+    try:
+        deltaPath = tmpPath + '/delta'
+        downloadAndExtractArtifact(deltaFile, tmpPath + '/deltaDownload', deltaPath)
+        (deltaApplied, deltaMessage) = davraDelta.applyDelta(deltaPath, comDavra.installationDir + '/apps', bundlePath)
+        comDavra.log('Delta update: ' + deltaMessage)
+        return deltaApplied
+    except Exception as e:
+        comDavra.logWarning('Failed to apply delta:' + deltaFile + " : Error: " + str(e))
+        return False
+
+
 # Function: Push an Application which has an install.sh onto this device to run as a service
 # functionParameterValues should have "Installation File" which should be a tar.gz containing the service file,
 # an install.sh 
+# Optionally "Delta File" is a delta artifact (see davra_delta.py) against a version already installed.
+# If the delta cannot be applied or the rebuilt bundle fails verification, the full "Installation File" is downloaded.
 def agentFunctionPushAppWithInstaller(functionParameterValues):
     comDavra.logInfo('Function: Pushing Application onto device to run as a service ' + str(functionParameterValues))
     if(functionParameterValues["Installation File"]):
         installationFile = functionParameterValues["Installation File"]
+        deltaFile = functionParameterValues.get("Delta File")
         # Download the app tarball
         try:
             tmpPath = '/tmp/' + str(comDavra.getMilliSecondsSinceEpoch())
-            comDavra.ensureDirectoryExists(tmpPath)
-            comDavra.runCommandWithTimeout('cd ' + tmpPath + ' && /usr/bin/curl -LO ' + installationFile, 300)
-            comDavra.runCommandWithTimeout('cd ' + tmpPath + ' && /bin/tar -xvf ./* ', 300)
-            comDavra.runCommandWithTimeout('cd ' + tmpPath + ' && chmod 777 ./* ', 300)
+            bundlePath = tmpPath + '/bundle'
+            comDavra.ensureDirectoryExists(bundlePath)
+            bundleSource = deltaFile
+            if(not deltaFile or reconstructAppFromDelta(deltaFile, tmpPath, bundlePath) is False):
+                if(deltaFile):
+                    comDavra.logWarning('Delta update not possible, falling back to full download of ' + installationFile)
+                    comDavra.provideFreshDirectory(bundlePath)
+                bundleSource = installationFile
+                downloadAndExtractArtifact(installationFile, tmpPath + '/download', bundlePath)
+            comDavra.runCommandWithTimeout('cd ' + bundlePath + ' && chmod 777 ./* ', 300)
             # Ensure the install.sh is unix format
-            comDavra.runCommandWithTimeout("cd " + tmpPath + " &&  sed -i $'s/\r$//' install.sh ", 30)
+            comDavra.runCommandWithTimeout("cd " + bundlePath + " &&  sed -i $'s/\r$//' install.sh ", 30)
+            # Remember what was installed so later deltas can be applied against it
+            bundleManifest = davraDelta.getDirectoryManifest(bundlePath)
             installedAppPath = comDavra.installationDir + '/apps/' + str(comDavra.getMilliSecondsSinceEpoch())
             comDavra.ensureDirectoryExists(installedAppPath)
-            comDavra.runCommandWithTimeout('cd ' + tmpPath + ' && cp -r * ' + installedAppPath, 300)
+            # Copy everything, dotfiles included, as the manifest lists them
+            comDavra.runCommandWithTimeout('cd ' + bundlePath + ' && cp -a ./. ' + installedAppPath, 300)
+            davraDelta.writeBundleManifest(installedAppPath, bundleManifest, bundleSource)
             installResponse = comDavra.runCommandWithTimeout('cd ' + installedAppPath + ' && bash ./install.sh ', comDavra.conf["scriptMaxTime"])
             comDavra.log('Installation response: ' + str(installResponse[1]))
             scriptStatus = 'completed'  if (installResponse[0] == 0) else 'failed'
@@ -486,6 +669,10 @@ def agentFunctionReportAgentConfig(functionParameterValues):
 def agentFunctionUpdateAgentConfig(functionParameterValues):
     comDavra.logInfo('Function: Updating the agent config to server ' + str(functionParameterValues))
     comDavra.upsertConfigurationItem(functionParameterValues["key"], functionParameterValues["value"])
+    # Intervals such as heartbeatInterval, and the telemetry rules, take effect without a restart
+    if(functionParameterValues["key"] == 'telemetryRules'):
+        loadTelemetryRules()
+    applyScheduleConfiguration()
     comDavra.reportDeviceConfigurationToServer()
     comDavra.upsertJsonEntry(currentFunctionJson, 'response', comDavra.conf)
     comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'completed')
@@ -507,7 +694,7 @@ def agentFunctionRunScriptBash(functionParameterValues):
     scriptFile.write(str(functionParameterValues["script"]))
     scriptFile.close()
     comDavra.logInfo('Running script ' + str(functionParameterValues["script"]))
-    os.system("chmod 777 " + currentFunctionDir + "/script.sh")
+    os.chmod(currentFunctionDir + "/script.sh", 0o777)
     time.sleep(0.5) # Time for file flush to disk
     # Run the script with -x flag so it prints each command before ruuning it. 
     # This allows the UI to show it formatted better for user on jobs page
@@ -524,13 +711,177 @@ def agentFunctionRunScriptBash(functionParameterValues):
 # Function: This will search for the Digital Twin associated to the device (labels: { "OPCProfile" : <UUID> }) and update the opc-profile.json file
 def agentFunctionUpdateOPCProfile(functionParameterValues):
     comDavra.logInfo('Function: Updating the OPC Profile into the device')
-    res = comDavra.updateOPCProfile()
+    res = comDavra.updateOPCProfile(notifyOPCProfileUpdated, getPLCVariableNames())
     comDavra.upsertJsonEntry(currentFunctionJson, 'response', str(res))
     comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'completed')
     checkFunctionFinished()
     return
 
 
+# Function: Write values to PLC variables in one batch
+# "variables" is a json object of { variableName: value }. The response holds the result for each variable
+def agentFunctionWritePlcVariables(functionParameterValues):
+    comDavra.logInfo('Function: Writing PLC variables ' + str(functionParameterValues.get("variables")))
+    try:
+        values = functionParameterValues.get("variables")
+        if(type(values) == str):
+            values = json.loads(values)
+        if(type(values) != dict or len(values) == 0):
+            raise ValueError('variables must be a json object of { variableName: value }')
+        results = plcSession.call(lambda device: writePLCVariables(device, values)) if plcSession is not None else None
+        if(results is None):
+            raise IOError('not connected to the PLC')
+        failed = [name for name, result in results.items() if result != 'ok']
+        if(len(failed) > 0):
+            comDavra.logWarning('Could not write PLC variables ' + str(failed) + ': ' + str(results))
+        comDavra.upsertJsonEntry(currentFunctionJson, 'response', results)
+        comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'completed' if len(failed) == 0 else 'failed')
+    except Exception as e:
+        comDavra.logError('Failed to write PLC variables: ' + str(e))
+        comDavra.upsertJsonEntry(currentFunctionJson, 'response', str(e))
+        comDavra.upsertJsonEntry(currentFunctionJson, 'status', 'failed')
+    checkFunctionFinished()
+    return
+
+
+# Function: Profile the running agent for field diagnostics, without restarting it
+# Samples the CPU of every thread for "seconds" (at most davraProfiler.maxProfileSeconds) while tracing
+# memory allocations, then counts the live objects and dumps the thread stacks. The response holds a short
+# summary and the full report gzipped and base64 encoded (read it with davra_profiler.readCompressedReport)
+# The profile runs on its own thread (see runFunctionInBackground)
+def agentFunctionProfile(functionParameterValues):
+    comDavra.logInfo('Function: Profiling the agent ' + str(functionParameterValues))
+    runFunctionInBackground('agent-action-profile', functionParameterValues, takeProfile)
+    return
+
+
+def takeProfile(functionParameterValues):
+    try:
+        seconds = float(functionParameterValues.get("seconds") or 10)
+        topCount = int(functionParameterValues.get("topCount") or 30)
+        report = davraProfiler.runProfile(seconds, topCount)
+        report['agentStats'] = getAgentStats()
+        compressedReport = davraProfiler.getCompressedReport(report)
+        response = {
+            'seconds': report['cpu']['seconds'],
+            'samples': report['cpu']['samples'],
+            'threads': len(report['threads']),
+            'topOwn': report['cpu']['topOwn'][:5],
+            'tracedBytes': report['memory']['tracedBytes'],
+            'tracedSinceProfileStart': report['memory']['tracedSinceProfileStart'],
+            'topMemory': report['memory']['top'][:5],
+            'topObjects': report['objects']['top'][:5],
+            'report': compressedReport
+        }
+        comDavra.logInfo('Profile taken: ' + str(report['cpu']['samples']) + ' samples, report ' + \
+            str(len(compressedReport)) + ' bytes')
+        return response
+    except Exception as e:
+        comDavra.logError('Failed to profile the agent: ' + str(e))
+        raise
+
+
+# Function: Upload the history kept on the device for a time range again, eg after uploads were lost
+# "from" and "to" are epoch milliseconds (to defaults to now, from to an hour before to), "metrics" a comma
+# separated list of metric names (all if empty) and "device" a device UUID (all if empty, eg in gateway mode).
+# The samples go up in requests of backfillBatchSize datums, on their own thread (see runFunctionInBackground)
+def agentFunctionBackfill(functionParameterValues):
+    comDavra.logInfo('Function: Backfilling history ' + str(functionParameterValues))
+    runFunctionInBackground('agent-action-backfill', functionParameterValues, backfillHistory)
+    return
+
+
+def backfillHistory(functionParameterValues):
+    try:
+        if(history is None):
+            raise ValueError('history is not kept on this device (historyMaxMegabytes is 0)')
+        toTime = int(float(functionParameterValues.get("to") or comDavra.getMilliSecondsSinceEpoch()))
+        fromTime = int(float(functionParameterValues.get("from") or toTime - 3600000))
+        if(fromTime > toTime):
+            raise ValueError('from is after to')
+        names = [name.strip() for name in str(functionParameterValues.get("metrics") or '').split(',') if name.strip()]
+        history.flush(0)
+        batchSize = int(comDavra.conf.get('backfillBatchSize', 5000))
+        (batch, sentCount, requestCount) = ([], 0, 0)
+        metrics = history.getMetrics(functionParameterValues.get("device") or None, names or None)
+        for (deviceUuid, metricName) in metrics:
+            for (timestamp, value) in history.iterateSamples((deviceUuid, metricName), fromTime, toTime):
+                batch.append({ "UUID": deviceUuid, "name": metricName, "value": value, "msg_type": "datum", \
+                    "timestamp": timestamp })
+                if(len(batch) >= batchSize):
+                    sendBackfillBatch(batch)
+                    (sentCount, requestCount, batch) = (sentCount + len(batch), requestCount + 1, [])
+        if(len(batch) > 0):
+            sendBackfillBatch(batch)
+            (sentCount, requestCount) = (sentCount + len(batch), requestCount + 1)
+        response = { 'from': fromTime, 'to': toTime, 'metrics': len(metrics), 'datums': sentCount, 'requests': requestCount }
+        comDavra.logInfo('Backfilled history: ' + str(response))
+        return response
+    except Exception as e:
+        comDavra.logError('Failed to backfill history: ' + str(e))
+        raise
+
+
+def sendBackfillBatch(batch):
+    statusCode = comDavra.sendDataToServer(batch).status_code
+    if(statusCode != 200):
+        raise IOError('the server answered ' + str(statusCode) + ' to a batch of ' + str(len(batch)) + ' datums')
+
+
+# Tell the Device Apps (eg the OPC client) the OPC Profile changed, so they reload it straight away
+def notifyOPCProfileUpdated(opcProfile, opcVars):
+    comDavra.logInfo('OPC Profile ' + str(opcProfile) + ' updated with ' + str(len(opcVars)) + ' variable(s) to monitor')
+    if(clientOfDevice is not None):
+        sendMessageFromAgentToApps({ "opcProfileUpdated": { "opcProfile": opcProfile, "opcVarsToMonitor": opcVars } })
+
+
+# Sync the OPC Profile outside of a job, eg when the server announces the twin changed
+def syncOPCProfile():
+    comDavra.log('Syncing OPC Profile: ' + str(comDavra.updateOPCProfile(notifyOPCProfileUpdated, getPLCVariableNames())))
+
+
+
+###########################   PLC VARIABLE CATALOGUE
+
+# The variables of the PLC programs, read through the RSC Device session and kept on disk.
+# It is only rebuilt when the PLC project, firmware or program meta files change,
+# and the OPCVariables twin only receives it when it differs from what was last uploaded.
+plcCatalogueFile = comDavra.installationDir + '/plcCatalogue.json'
+plcCatalogue = davraCatalogue.loadCatalogue(plcCatalogueFile)
+plcCatalogueLock = threading.Lock()
+
+
+# The names of all PLC variables, or None if the catalogue has not been built yet
+def getPLCVariableNames():
+    if(len(plcCatalogue['variables']) == 0):
+        return None
+    return davraCatalogue.getVariableNames(plcCatalogue)
+
+
+def refreshPLCCatalogue():
+    global plcCatalogue
+    with plcCatalogueLock:
+        result = plcSession.call(lambda device: davraCatalogue.refreshCatalogue(device, plcCatalogue, \
+            comDavra.conf.get('plcMetaDir', davraCatalogue.defaultMetaDir), \
+            comDavra.conf.get('plcMetaFilePatterns', davraCatalogue.defaultMetaFilePatterns)))
+        if(result is None):
+            # The PLC is not connected, try again next time
+            return
+        (catalogue, diff) = result
+        changed = diff is not None
+        if(changed):
+            comDavra.logInfo('PLC variable catalogue rebuilt for project ' + catalogue['signature']['projectName'] + ': ' \
+                + str(len(catalogue['variables'])) + ' variables, ' + str(len(diff['added'])) + ' added, ' \
+                + str(len(diff['removed'])) + ' removed')
+        uploadDiff = davraCatalogue.getUploadDiff(catalogue)
+        if(uploadDiff is not None and comDavra.uploadPLCCatalogueToTwin(catalogue['variables'], uploadDiff)):
+            davraCatalogue.markUploaded(catalogue)
+            changed = True
+        if(changed):
+            davraCatalogue.saveCatalogue(plcCatalogueFile, catalogue)
+            plcCatalogue = catalogue
+
+
 
 ###########################   REPORT KNOWN AGENT CAPABILITIES
 
@@ -538,10 +889,17 @@ def agentFunctionUpdateOPCProfile(functionParameterValues):
 # Set which actions this agent can do and inform the server of these capabilities
 agentCapabilityFunctions = {} # Keep a pointer to the functions which enact each of capabilities
 def registerAgentCapabilities(functionName, functionDetails, functionToCallToEnactCapability):
+    registerAgentCapabilitiesInBulk({ functionName: (functionDetails, functionToCallToEnactCapability) })
+
+
+# Register several capabilities at once, as { functionName: (functionDetails, functionToCallToEnactCapability) }
+# The server is informed with at most one config write and one capabilities report
+def registerAgentCapabilitiesInBulk(capabilities):
     global agentCapabilityFunctions
-    agentCapabilityFunctions[functionName] = functionToCallToEnactCapability
+    for functionName, (functionDetails, functionToCallToEnactCapability) in capabilities.items():
+        agentCapabilityFunctions[functionName] = functionToCallToEnactCapability
     # Inform the server that this device has these capabilities
-    comDavra.registerDeviceCapability(functionName, functionDetails)
+    comDavra.registerDeviceCapabilities({ name: details for name, (details, function) in capabilities.items() })
 
 
 # Register the functions defined above as those which the agent can do
@@ -550,36 +908,53 @@ def registerAgentCapabilities(functionName, functionDetails, functionToCallToEna
 # Device Applications may also register their own capabilities separately
 #
 def registerAllAgentCapabilities():
-    registerAgentCapabilities('agent-action-pushAppWithInstaller', { \
-        "functionParameters": { "Installation File": "file" }, \
+    capabilities = {}
+    capabilities['agent-action-pushAppWithInstaller'] = ({ \
+        "functionParameters": { "Installation File": "file", "Delta File": "file" }, \
         "functionLabel": "Push Device App (with installer)", \
-        "functionDescription": "To run a device Application alongside the Device Agent on a device. Supply a tar.gz file containing an install.sh script to install it." \
+        "functionDescription": "To run a device Application alongside the Device Agent on a device. Supply a tar.gz file containing an install.sh script to install it. Optionally supply a delta against an installed version to reduce the download." \
     }, agentFunctionPushAppWithInstaller)
-    registerAgentCapabilities('agent-action-rebootDevice', { \
+    capabilities['agent-action-rebootDevice'] = ({ \
         "functionParameters": {}, \
         "functionLabel": "Reboot Device", \
         "functionDescription": "Reboot the device immediately" \
     }, agentFunctionReboot)
-    registerAgentCapabilities('agent-action-reportAgentConfig', { \
+    capabilities['agent-action-reportAgentConfig'] = ({ \
         "functionParameters": {}, \
         "functionLabel": "Report Agent Config to Server", \
         "functionDescription": "Send the agent configuration from agent to server" \
     }, agentFunctionReportAgentConfig)
-    registerAgentCapabilities('agent-action-updateAgentConfig', { \
+    capabilities['agent-action-updateAgentConfig'] = ({ \
         "functionParameters": { "key": "string", "value": "string" }, \
         "functionLabel": "Update Config on Device Agent", \
         "functionDescription": "Upsert a configuration item on the device" \
     }, agentFunctionUpdateAgentConfig)
-    registerAgentCapabilities('agent-action-runScriptBash', { \
+    capabilities['agent-action-runScriptBash'] = ({ \
         "functionParameters": { "script": "textarea" }, \
         "functionLabel": "Run bash script on Device", \
         "functionDescription": "Run a bash script once on the device, launched by the Device Agent" \
     }, agentFunctionRunScriptBash)
-    registerAgentCapabilities('agent-action-updateOPCProfile', { \
+    capabilities['agent-action-updateOPCProfile'] = ({ \
         "functionParameters": {}, \
         "functionLabel": "Update the OPC Profile on Device", \
         "functionDescription": "It will push the OPCProfile Digital Twin associated to the device" \
     }, agentFunctionUpdateOPCProfile)
+    capabilities['agent-action-writePlcVariables'] = ({ \
+        "functionParameters": { "variables": "string" }, \
+        "functionLabel": "Write PLC Variables", \
+        "functionDescription": "Write values to PLC variables in one batch. Supply a json object of { variableName: value }, eg {\"Arp.Plc.Eclr/MainInstance.setpoint\": 21.5}" \
+    }, agentFunctionWritePlcVariables)
+    capabilities['agent-action-profile'] = ({ \
+        "functionParameters": { "seconds": "number", "topCount": "number" }, \
+        "functionLabel": "Profile the Device Agent", \
+        "functionDescription": "Take a CPU profile of the running agent for some seconds (default 10, at most 60), with a memory allocation snapshot, counts of live objects by type and a stack dump of each thread. The response holds a summary and the full report, gzipped json in base64" \
+    }, agentFunctionProfile)
+    capabilities['agent-action-backfill'] = ({ \
+        "functionParameters": { "from": "number", "to": "number", "metrics": "string", "device": "string" }, \
+        "functionLabel": "Backfill History from Device", \
+        "functionDescription": "Upload again the metric values kept on the device between from and to (epoch milliseconds, default the last hour). Optionally only some metrics (comma separated names) or one device UUID" \
+    }, agentFunctionBackfill)
+    registerAgentCapabilitiesInBulk(capabilities)
 
 ###########################   MQTT Broker running on device
 
@@ -593,13 +968,44 @@ def mqttOnConnectDevice(client, userdata, flags, resultCode):
 
 
 # The callback for when a message is received from the mqtt broker on the device.
+# Each message is timed by kind, see appMessageKinds
 def mqttOnMessageDevice(client, userdata, msg):
-    payload = str(msg.payload.decode('utf8').replace("'", '"'))
-    if(comDavra.isJson(payload)):
-        processMessageFromAppToAgent(json.loads(payload))
-    else:
-        comDavra.logError('ERROR: Mqtt Device Broker: Received NON json Mqtt message: ' + payload)
+    startTime = time.perf_counter()
+    messageKind = 'invalid'
+    try:
+        with davraWatchdog.watch('mqtt.device'):
+            payload = str(msg.payload.decode('utf8').replace("'", '"'))
+            if(comDavra.isJson(payload)):
+                message = json.loads(payload)
+                messageKind = getAppMessageKind(message)
+                processMessageFromAppToAgent(message)
+            else:
+                comDavra.logError('ERROR: Mqtt Device Broker: Received NON json Mqtt message: ' + payload)
+    finally:
+        davraMetrics.observe('davra_mqtt_message_seconds', time.perf_counter() - startTime, kind=messageKind)
     return
+
+
+# What a message from the Device Apps asks of the agent, named after its first known key
+appMessageKinds = ['sendIotData', 'registerCapability', 'registerCapabilities', 'runFunctionOnAgent', \
+    'connectToAgent', 'retrieveConfigFromAgent', 'finishedFunctionOnApp']
+def getAppMessageKind(msg):
+    if(type(msg) != dict):
+        return 'invalid'
+    if("fromAgent" in msg):
+        return 'fromAgent'
+    for messageKind in appMessageKinds:
+        if(messageKind in msg):
+            return messageKind
+    return 'other'
+
+
+# Bytes the device broker sent which the agent has not read yet. If this grows, message handling is backing up
+def getDeviceBrokerBacklogBytes():
+    if(clientOfDevice is None or clientOfDevice.socket() is None):
+        return None
+    return struct.unpack('i', fcntl.ioctl(clientOfDevice.socket().fileno(), termios.FIONREAD, b'\0\0\0\0'))[0]
+davraMetrics.registerGauge('davra_mqtt_device_backlog_bytes', getDeviceBrokerBacklogBytes)
     
 
 # Setup the MQTT client talking to the broker on the device    
@@ -610,7 +1016,7 @@ if("mqttBrokerAgentHost" in comDavra.conf and len(comDavra.conf["mqttBrokerAgent
     clientOfDevice.on_message = mqttOnMessageDevice
     comDavra.logInfo('Starting to connect to MQTT broker running on device ' + comDavra.conf["mqttBrokerAgentHost"])
     try:
-        clientOfDevice.connect(comDavra.conf["mqttBrokerAgentHost"])
+        clientOfDevice.connect(comDavra.conf["mqttBrokerAgentHost"], int(comDavra.conf.get("mqttBrokerAgentPort", 1883)))
         clientOfDevice.loop_start() # Starts another thread to monitor incoming messages
     except Exception as e:
         comDavra.logError('Experienced error connecting to mqtt at ' + comDavra.conf["mqttBrokerAgentHost"] + ":" + str(e))
@@ -628,11 +1034,16 @@ def processMessageFromAppToAgent(msg):
     # Ignore any messages this agent published
     if("fromAgent" in msg):
         return
-    comDavra.log('processMessageFromAppToAgent: incoming msg: ' + str(msg))
+    trace = getMessageTrace(msg)
+    if(trace is not None):
+        trace["received"] = time.time()
+    comDavra.log('processMessageFromAppToAgent: incoming msg: ' + comDavra.getLogExcerpt(msg))
     if("registerCapability" in msg):
         capabilityName = msg["registerCapability"]
         capabilityDetails = msg["capabilityDetails"] if "capabilityDetails" in msg else {}
         comDavra.registerDeviceCapability(capabilityName, capabilityDetails)
+    if("registerCapabilities" in msg):
+        comDavra.registerDeviceCapabilities(msg["registerCapabilities"])
     if("runFunctionOnAgent" in msg):
         functionName = msg["runFunctionOnAgent"]
         functionParameterValues = msg["functionParameterValues"] if "functionParameterValues" in msg else {}
@@ -650,8 +1061,11 @@ def processMessageFromAppToAgent(msg):
         comDavra.log('From app to agent, app announcing it finished running a function: ' + functionName)
         updateFunctionStatusAsReportedByDeviceApp(msg)
     if("sendIotData" in msg):
-        comDavra.log('From app to agent, app announcing it has iotData to send ' + str(msg))
+        comDavra.log('From app to agent, app announcing it has iotData to send')
         sendIotDataToServer(msg)
+    if(trace is not None):
+        trace["handled"] = time.time()
+        recordMessageTrace(trace)
 
 
 # Send a message onto the mqtt topic which the Device Apps are lstening to
@@ -669,32 +1083,202 @@ def sendHeartbeatToDeviceApps():
 
 
 # Send metrics and events to the platform server
+# Only counts and a short excerpt are logged, so a large batch is not copied into log strings. Nothing is queued:
+# a message the server does not take is lost (it is still in the history), so only gateway mode needs the uplink
 def sendIotDataToServer(msgFromMqtt):
-    comDavra.log('Sending iotdata to server ')
-    print(str(msgFromMqtt))
     dataFromAgent = json.loads(msgFromMqtt["sendIotData"])
     if (type (dataFromAgent) == type ({})):
         dataFromAgent = [dataFromAgent]
     dataForServer = []
+    deviceUuid = comDavra.conf["UUID"]
     for metric in dataFromAgent:
         if (("UUID" in metric) == False):
-            metric["UUID"] = comDavra.conf["UUID"]
+            metric["UUID"] = deviceUuid
         if ("timestamp" not in metric):
             metric["timestamp"] = comDavra.getMilliSecondsSinceEpoch()
         if ("name" in metric and "value" in metric and "msg_type" in metric):
-            comDavra.log('Sending data now to server ')
-            print(str(metric))
             dataForServer.append(metric)
         else:
-            comDavra.logError('Not sending data to server as it appears incomplete: ' + str(metric))
+            comDavra.logError('Not sending data to server as it appears incomplete: ' + comDavra.getLogExcerpt(metric))
+    dataForServer = telemetryRules.apply(dataForServer)
     if dataForServer:
-        comDavra.log('Sending data to Server: ' + str(dataForServer))
+        comDavra.log('Sending ' + str(len(dataForServer)) + ' item(s) of iotdata to server, eg ' + \
+            comDavra.getLogExcerpt(dataForServer[0]))
+        recordHistory(dataForServer)
+        trace = getMessageTrace(msgFromMqtt)
+        if(trace is not None):
+            trace["enqueued"] = time.time()
         statusCode = comDavra.sendDataToServer(dataForServer).status_code
+        if(trace is not None and statusCode == 200):
+            trace["acked"] = time.time()
         comDavra.log('Response after sending iotdata to server: ' + str(statusCode))
-    
-    
-        
-        
+
+
+
+###########################   HISTORY ON THE DEVICE
+
+# Number datums sent to the server (from the Device Apps and the PLC sampling) are also kept on the device
+# in compressed chunks (see davra_history) for historyRetentionHours, within historyMaxMegabytes of disk.
+# The agent-action-backfill function uploads a range of them again. A historyMaxMegabytes of 0 turns it off.
+history = None
+
+
+def startHistory():
+    global history
+    maxMegabytes = float(comDavra.conf.get('historyMaxMegabytes', 64))
+    if(maxMegabytes <= 0):
+        return
+    try:
+        history = davraHistory.HistoryStore(comDavra.installationDir + '/history', \
+            float(comDavra.conf.get('historyRetentionHours', 72)) * 3600, int(maxMegabytes * 1000000), \
+            float(comDavra.conf.get('historyChunkSeconds', 600)), 3600, comDavra.log)
+    except Exception as e:
+        comDavra.logError('Cannot keep telemetry history on the device: ' + str(e))
+
+
+def recordHistory(dataToSend):
+    if(history is None):
+        return
+    try:
+        history.record(dataToSend)
+    except Exception as e:
+        comDavra.logError('Failed to add to the history: ' + str(e))
+
+
+def flushHistory():
+    history.flush(float(comDavra.conf.get('historyFlushInterval', 60)))
+
+
+
+###########################   TELEMETRY RULES
+
+# Rules in the config ("telemetryRules", see davra_rules) drop, rename, retag, deadband, downsample or
+# aggregate the datums the Device Apps send, before they are uploaded. They can be changed with
+# agent-action-updateAgentConfig (key telemetryRules, value the json list) and apply at once.
+telemetryRules = davraRules.RulesEngine([])
+
+
+def loadTelemetryRules():
+    global telemetryRules
+    rules = comDavra.conf.get('telemetryRules') or []
+    try:
+        if(type(rules) == str):
+            rules = json.loads(rules)
+        if(type(rules) != list):
+            raise ValueError('telemetryRules must be a list')
+    except ValueError as e:
+        comDavra.logError('Ignoring the telemetry rules: ' + str(e))
+        rules = []
+    previousRules = telemetryRules
+    telemetryRules = davraRules.RulesEngine(rules, comDavra.logWarning, int(comDavra.conf.get('telemetryRulesMaxSeries', 10000)))
+    if(telemetryRules.hasRules()):
+        comDavra.logInfo('Applying ' + str(len(telemetryRules.rules)) + ' telemetry rule(s)')
+    # Windows still open under the rules replaced go up now rather than being lost
+    sendTelemetryRulesOutput(previousRules.flushAggregates(flushAll=True))
+
+
+def flushTelemetryRules():
+    sendTelemetryRulesOutput(telemetryRules.flushAggregates())
+
+
+def sendTelemetryRulesOutput(dataToSend):
+    if(len(dataToSend) == 0):
+        return
+    recordHistory(dataToSend)
+    statusCode = comDavra.sendDataToServer(dataToSend).status_code
+    comDavra.log('Response after sending ' + str(len(dataToSend)) + ' aggregate(s) to server: ' + str(statusCode))
+
+
+
+###########################   PLC ANOMALY DETECTION
+
+# The PLC status metrics are sampled every anomalySampleInterval seconds (0 turns this off) and checked
+# against a running baseline (see davra_anomaly). Normally only their means go up with plcMetrics, but a
+# davra.plc.anomaly event with the raw samples around it is sent as soon as a metric leaves its usual range.
+# A metric still away from it after anomalyRebaselineSamples samples (10 minutes at the default interval) is
+# taken to have moved for good, and its new level becomes the baseline.
+# In gateway mode each acquisition is checked, and the events go up with the uplink.
+plcAnomalies = None
+
+
+def startAnomalyDetection():
+    global plcAnomalies
+    if(float(comDavra.conf.get('anomalySampleInterval', 5)) <= 0):
+        return
+    bounds = comDavra.conf.get('anomalyBounds') or {}
+    try:
+        if(type(bounds) == str):
+            bounds = json.loads(bounds)
+        if(type(bounds) != dict):
+            raise ValueError('anomalyBounds must be an object')
+    except ValueError as e:
+        comDavra.logError('Ignoring the anomaly bounds: ' + str(e))
+        bounds = {}
+    plcAnomalies = davraAnomaly.AnomalyDetector(float(comDavra.conf.get('anomalyAlpha', 0.05)), \
+        float(comDavra.conf.get('anomalyZScore', 4)), int(comDavra.conf.get('anomalyWarmup', 30)), \
+        int(comDavra.conf.get('anomalyContextSamples', 20)), int(comDavra.conf.get('anomalyClearSamples', 3)), \
+        float(comDavra.conf.get('anomalyMinDeviation', 1.0)), bounds, int(comDavra.conf.get('anomalyRebaselineSamples', 120)))
+
+
+def samplePLCMetrics():
+    onPLCData(readPLCMetrics())
+
+
+# Each reading of PLC metrics, for the history and the anomaly checks
+def onPLCData(dataToSend):
+    recordHistory(dataToSend)
+    if(plcAnomalies is None):
+        return
+    events = plcAnomalies.observe(dataToSend)
+    if(len(events) > 0):
+        sendAnomalyEventsToServer(events)
+
+
+def sendAnomalyEventsToServer(events):
+    for event in events:
+        comDavra.logWarning('PLC anomaly ' + event['value']['state'] + ': ' + event['value']['metric'] \
+            + ' = ' + str(event['value']['value']) + ' on ' + str(event['UUID']))
+    if(uplink is not None):
+        uplink.add(events)
+    else:
+        statusCode = comDavra.sendDataToServer(events).status_code
+        comDavra.log('Response after sending ' + str(len(events)) + ' anomaly event(s) to server: ' + str(statusCode))
+
+
+
+###########################   Latency tracing of messages from Device Applications
+
+# Apps stamp a sample of their messages with { "trace": { "id", "published" } } (see traceSampleRate in davra_sdk).
+# The agent adds when it received the message, when its data was ready to upload, when the server
+# acknowledged the upload and when it finished with the message (epoch seconds), and records the time
+# each stage took in the davra_trace_stage_seconds histogram. Untraced messages cost one dict lookup.
+traceStages = [
+    ('broker', 'published', 'received'),
+    ('processing', 'received', 'enqueued'),
+    ('upload', 'enqueued', 'acked'),
+    ('total', 'published', 'handled')
+]
+# The last few traces, for the stats endpoint
+recentTraces = collections.deque(maxlen=int(comDavra.conf.get('recentTraceCount', 20)))
+
+
+def getMessageTrace(msg):
+    trace = msg.get("trace")
+    return trace if type(trace) == dict and "published" in trace else None
+
+
+def recordMessageTrace(trace):
+    stageSeconds = {}
+    for (stage, startStamp, endStamp) in traceStages:
+        try:
+            # The app and agent share the device clock, a small negative difference is rounding
+            stageSeconds[stage] = max(0.0, float(trace[endStamp]) - float(trace[startStamp]))
+        except (KeyError, TypeError, ValueError):
+            continue
+        davraMetrics.observe('davra_trace_stage_seconds', stageSeconds[stage], stage=stage)
+    recentTraces.append({ "id": trace.get("id"), "fromApp": trace.get("fromApp"), \
+        "stagesMs": { stage: round(seconds * 1000, 3) for stage, seconds in stageSeconds.items() } })
+
 
 
 ###########################   MQTT Broker running on the Davra server (probably mqtt.davra.com)
@@ -716,10 +1300,11 @@ def mqttOnConnectServer(client, userdata, flags, resultCode):
 
 # The callback for when a message is received from the broker on platform server.
 def mqttOnMessageServer(client, userdata, msg):
-    payload = str(msg.payload.decode('utf8').replace("'", '"'))
-    comDavra.log('Mqtt Davra Server Broker: Received Mqtt message: ' + payload)
-    jsonPayload =  json.loads(payload) if comDavra.isJson(payload) else { "stringMsg": payload }
-    processMessageFromServerToAgent(jsonPayload)
+    with davraWatchdog.watch('mqtt.server'):
+        payload = str(msg.payload.decode('utf8').replace("'", '"'))
+        comDavra.log('Mqtt Davra Server Broker: Received Mqtt message: ' + payload)
+        jsonPayload =  json.loads(payload) if comDavra.isJson(payload) else { "stringMsg": payload }
+        processMessageFromServerToAgent(jsonPayload)
     return
 
     
@@ -755,6 +1340,9 @@ def processMessageFromServerToAgent(msg):
     if("davra-announcement" in msg and msg["davra-announcement"] == "check-for-jobs"):
         comDavra.log('From server to device, new jobs might be available')
         checkForPendingJob()
+    if("davra-announcement" in msg and msg["davra-announcement"] == "sync-opc-profile"):
+        comDavra.log('From server to device, the OPC Profile might have changed')
+        syncOPCProfile()
     if("davra-function" in msg):
         comDavra.log('From server to device, run a function: ' + str(msg["davra-function"]))
         funcParamsToRun = {}
@@ -765,49 +1353,264 @@ def processMessageFromServerToAgent(msg):
 
 
 
+###########################   SCHEDULED TASKS
+
+# Each periodic duty of the agent is a task on the scheduler with its own interval in seconds
+# Tasks run concurrently on a small pool (taskWorkers threads) so a slow endpoint does not delay the others.
+# A task running longer than taskDeadline seconds is reported as slow.
+# In gateway mode (plcEndpoints configured) the pool grows with the number of PLCs, within bounds
+gatewayEndpoints = comDavra.conf.get('plcEndpoints') or []
+scheduler = davraScheduler.Scheduler(comDavra.log, \
+    int(comDavra.conf.get('taskWorkers', min(16, 4 + len(gatewayEndpoints) // 2))), \
+    float(comDavra.conf.get('taskDeadline', 30)))
+# Job and function bookkeeping on disk is only touched by one scheduled task at a time
+jobStateLock = threading.Lock()
+# In gateway mode, the PLCs supervised and the uplink their data shares
+gateway = None
+uplink = None
+
+
+# How often each scheduled task runs, from the agent configuration
+# plcMetricsInterval and jobCheckInterval default to heartbeatInterval
+def getScheduleIntervals():
+    heartbeatInterval = float(comDavra.conf['heartbeatInterval'])
+    return {
+        'heartbeatApps': heartbeatInterval,
+        'heartbeat': heartbeatInterval,
+        'plcMetrics': float(comDavra.conf.get('plcMetricsInterval', heartbeatInterval)),
+        'checkForPendingJob': float(comDavra.conf.get('jobCheckInterval', heartbeatInterval)),
+        'verifyServerState': float(comDavra.conf.get('serverStateVerifyInterval', heartbeatInterval * 10)),
+        'hostMetrics': float(getHostMetricsInterval()),
+        'defineMetrics': float(comDavra.conf.get('metricDefinitionInterval', 60)),
+        'plcCatalogue': float(comDavra.conf.get('plcCatalogueInterval', 300)),
+        'uplink': float(comDavra.conf.get('uplinkFlushInterval', 5)),
+        'plcHealth': float(comDavra.conf.get('plcHealthInterval', 5)),
+        # Off unless statsEventInterval is set, eg 3600
+        'statsEvent': float(comDavra.conf.get('statsEventInterval', 0)),
+        'historyFlush': float(comDavra.conf.get('historyFlushInterval', 60)),
+        'plcAnomaly': float(comDavra.conf.get('anomalySampleInterval', 5)),
+        'telemetryRules': float(comDavra.conf.get('telemetryRulesFlushInterval', 5)) if telemetryRules.hasRules() else 0,
+        'checkRunningWork': 1,
+        'checkFinishedWork': 60
+    }
+
+
+# check if a currently running job or function is finished
+# Only check if the flag indicates one is running. checkFinishedWork also checks every minute just in case
+# If another task is busy with a job (eg running a long script) these checks skip this round.
+def checkRunningWork():
+    if(jobStateLock.acquire(blocking=False) is False):
+        return
+    try:
+        if(flagIsFunctionRunning is True):
+            checkFunctionFinished()
+        if(flagIsJobRunning is True):
+            checkCurrentJob()
+    finally:
+        jobStateLock.release()
+
+
+def checkFinishedWork():
+    if(jobStateLock.acquire(blocking=False) is False):
+        return
+    try:
+        checkFunctionFinished()
+        checkCurrentJob()
+    finally:
+        jobStateLock.release()
+
+
+def checkForPendingJobTask():
+    if(jobStateLock.acquire(blocking=False) is False):
+        comDavra.log('A job is still being processed, not checking for pending jobs this time')
+        return
+    try:
+        checkForPendingJob()
+    finally:
+        jobStateLock.release()
+
+
+# Put the agent's periodic duties onto the scheduler. All of them run once at startup,
+# those calling the server within the startup ramp.
+scheduledTaskFunctions = {}
+def scheduleAgentTasks():
+    scheduledTaskFunctions.update({
+        # Emit a heartbeat for any apps listening on mqtt
+        'heartbeatApps': sendHeartbeatToDeviceApps,
+        # Send a heartbeat to platform server
+        'heartbeat': sendHeartbeatMetricsToServer,
+        'plcMetrics': sendPLCMetricsToServer,
+        'checkForPendingJob': checkForPendingJobTask,
+        # Only occasionally, check the server still has the capabilities, labels and attributes
+        # last acknowledged, and re-send any that drifted
+        'verifyServerState': comDavra.verifyServerState,
+        # Sample host metrics on their own cadence, independent of heartbeatInterval
+        'hostMetrics': sampleHostMetrics,
+        # Define any new metric names seen in uploads on the server, in one request
+        'defineMetrics': comDavra.flushPendingMetricDefinitions,
+        # Check whether the PLC program changed, and if so rebuild the variable catalogue
+        'plcCatalogue': refreshPLCCatalogue,
+        # Keep the local PLC session alive, reconnecting within seconds of the PLC coming back
+        'plcHealth': superviseLocalPLC,
+        'statsEvent': sendStatsEventToServer,
+        # Write the history samples gathered in memory to disk
+        'historyFlush': flushHistory,
+        # Send the aggregates of the telemetry rules' windows as they close
+        'telemetryRules': flushTelemetryRules,
+        # Sample the PLC metrics often, to catch anomalies between the uploads
+        'plcAnomaly': samplePLCMetrics,
+        'checkRunningWork': checkRunningWork,
+        'checkFinishedWork': checkFinishedWork
+    })
+    if(plcSession is None):
+        # No local PLC to supervise or catalogue
+        scheduledTaskFunctions.pop('plcCatalogue')
+        scheduledTaskFunctions.pop('plcHealth')
+        scheduledTaskFunctions.pop('plcAnomaly')
+    elif(plcAnomalies is None):
+        scheduledTaskFunctions.pop('plcAnomaly')
+    if(history is None):
+        scheduledTaskFunctions.pop('historyFlush')
+    if(uplink is not None):
+        # Send what the PLCs queued, in as few requests as possible
+        scheduledTaskFunctions['uplink'] = uplink.flush
+    applyScheduleConfiguration()
+
+
+# Tasks which call the server. After a site-wide power cycle every device would otherwise call
+# at the same second, so each gets a fixed phase within its interval derived from the device UUID,
+# a startup ramp (first run spread over startupRamp seconds) and bounded random jitter.
+fleetSpreadTasks = ['heartbeat', 'plcMetrics', 'checkForPendingJob', 'verifyServerState', 'statsEvent']
+
+
+# Returns (phase, firstRunDelay, jitter) in seconds for a task
+def getTaskSpread(taskName, interval):
+    if(taskName not in fleetSpreadTasks):
+        return (None, 0, 0)
+    phaseFraction = comDavra.getDevicePhaseFraction(taskName)
+    startupRamp = min(interval, float(comDavra.conf.get('startupRamp', 120)))
+    # Jitter is capped at a tenth of the interval so it never blurs the phase spread
+    jitter = min(float(comDavra.conf.get('scheduleJitter', 10)), interval / 10)
+    return (phaseFraction * interval, phaseFraction * startupRamp, jitter)
+
+
+# Re-read task intervals from the configuration, eg after heartbeatInterval changed
+# An interval of 0 disables a task
+def applyScheduleConfiguration():
+    for taskName, interval in getScheduleIntervals().items():
+        if(taskName not in scheduledTaskFunctions):
+            continue
+        (phase, firstRunDelay, jitter) = getTaskSpread(taskName, interval)
+        if(interval <= 0):
+            scheduler.removeTask(taskName)
+        elif(scheduler.hasTask(taskName)):
+            scheduler.setInterval(taskName, interval, jitter, phase)
+        else:
+            scheduler.addTask(taskName, interval, scheduledTaskFunctions[taskName], jitter, firstRunDelay, phase)
+    if(gateway is not None):
+        gateway.scheduleTasks(scheduler, getScheduleIntervals()['plcMetrics'], getScheduleIntervals()['plcHealth'], \
+            float(comDavra.conf.get('startupRamp', 120)))
+
+
+
+###########################   INSTRUMENTATION
+
+# Latency histograms and counters (see davra_metrics) are served on 127.0.0.1:statsPort as
+# /metrics (Prometheus text) and /stats (JSON, with the stats below). A statsPort of 0 turns the endpoint off.
+def getAgentStats():
+    stats = { 'scheduler': scheduler.getStats() }
+    if(uplink is not None):
+        stats['uplink'] = uplink.getStats()
+    if(plcSession is not None):
+        stats['plc'] = plcSession.getStats()
+    if(gateway is not None):
+        stats['gateway'] = gateway.getStats()
+    stats['recentTraces'] = list(recentTraces)
+    stats['watchdog'] = davraWatchdog.getStats()
+    if(history is not None):
+        stats['history'] = history.getStats()
+    stats['telemetryRules'] = telemetryRules.getStats()
+    if(plcAnomalies is not None):
+        stats['anomaly'] = plcAnomalies.getStats()
+    return stats
+
+
+def startStatsEndpoint():
+    statsPort = int(comDavra.conf.get('statsPort', 9108))
+    if(statsPort > 0):
+        davraMetrics.startStatsServer(statsPort, getAgentStats, comDavra.log)
+
+
+# A compact copy of the instrumentation for the server, every statsEventInterval seconds
+def sendStatsEventToServer():
+    comDavra.sendDataToServer({
+        "UUID": comDavra.conf['UUID'],
+        "name": "davra.agent.stats",
+        "value": davraMetrics.getCompactSummary(),
+        "msg_type": "event"
+    })
+
+
+# The scheduler loop, the tasks and the MQTT callbacks are watched for stalls (see davra_watchdog).
+# Anything busy for longer than stallThreshold seconds is logged with its stack and reported
+# as a davra.agent.stall event, at most once every stallEventInterval seconds. A stallThreshold of 0 turns it off
+def startStallWatchdog():
+    stallThreshold = float(comDavra.conf.get('stallThreshold', 30))
+    if(stallThreshold > 0):
+        davraWatchdog.start(stallThreshold, float(comDavra.conf.get('stallEventInterval', 300)), \
+            sendStallEventToServer, comDavra.logWarning)
+
+
+def sendStallEventToServer(stall):
+    event = {
+        "UUID": comDavra.conf['UUID'],
+        "name": "davra.agent.stall",
+        "value": stall,
+        "msg_type": "event"
+    }
+    if(uplink is not None):
+        uplink.add(event)
+    else:
+        comDavra.sendDataToServer(event)
+
+
+
 ###########################   MAIN LOOP
 
-if __name__ == "__main__":
+# Runs until the process is stopped. A function so a harness (eg the benchmark suite) can import the agent and start it
+def main():
+    global plcSession, gateway, uplink, history
+    if(str(comDavra.conf.get('traceMemoryFromStartup', False)).lower() == 'true'):
+        # Lets agent-action-profile show where all the memory held was allocated, at some cost in speed and memory
+        davraProfiler.startMemoryTracing(int(comDavra.conf.get('traceMemoryFrames', 1)))
+    startStatsEndpoint()
+    startStallWatchdog()
+    startHistory()
+    loadTelemetryRules()
+    startAnomalyDetection()
     mqttConnectToServer()
     reportAgentStarted()
     sendMessageFromAgentToApps({ "name": "agent-test", "value": "sample published message"}) # Demonstrate mqtt ok
     # Run the reboot-finished check any time the program is started
     checkIfJustBackAfterRebootTask()  
     registerAllAgentCapabilities()
-    try:
-        with Device('127.0.0.1', secureInfoSupplier=secureInfoSupplier) as device:
-            comDavra.log("Connected to local PLC from Docker container.")
-            # Send PLCnext system info to platform server
-            sendPLCSystemInfoToServer(device)
-            # Main loop to run forever. 
-            # Send heartbeat signal to server ocassionally, check for jobs and run them
-            countMainLoop = 0
-            while True:
-                try:
-                    # Only every n seconds
-                    if(countMainLoop % int(comDavra.conf['heartbeatInterval']) == 0):
-                        # Emit a heartbeat for any apps listening on mqtt
-                        sendHeartbeatToDeviceApps()
-                        # Send a heartbeat to platform server
-                        sendHeartbeatMetricsToServer()
-                        # Send PLCnext metrics to platform server
-                        sendPLCMetricsToServer(device)
-                        # Check for any pending jobs
-                        checkForPendingJob() 
-                    # check if a currently running job or function is finished
-                    # Only check if the flag indicates one is running but also every n iterations just in case
-                    if(flagIsFunctionRunning is True or countMainLoop % 60 == 0):
-                        checkFunctionFinished()
-                    if(flagIsJobRunning is True or countMainLoop % 60 == 0):
-                        checkCurrentJob()    
-                    # Only occasionally, report all capabilities up to server just in case.
-                    if(countMainLoop % (int(comDavra.conf['heartbeatInterval']) * 10) == 0):
-                        comDavra.reportDeviceCapabilities()
-                except KeyboardInterrupt:
-                    print("Error: issue encountered")
-                    comDavra.logError("Error: issue encountered")
-                countMainLoop += 1
-                time.sleep(1)
-    except Exception as e:
-        comDavra.logError(f"Failed to connect to PLC: {str(e)}")
+    # The PLC connection is supervised by scheduled tasks, separately from the server duties,
+    # so heartbeats and jobs carry on while a PLC is down and the PLC is reconnected once it is back
+    if(len(gatewayEndpoints) > 0):
+        # Gateway mode: supervise the PLCs listed in plcEndpoints instead of the local PLC
+        uplink = davraUplink.Uplink(comDavra.sendDataToServer, int(comDavra.conf.get('uplinkMaxBatch', 500)), \
+            int(comDavra.conf.get('uplinkMaxQueued', 20000)), comDavra.log, int(comDavra.conf.get('uplinkMaxQueuedBytes', 8000000)))
+        gateway = davraGateway.Gateway(gatewayEndpoints, uplink, float(comDavra.conf.get('plcTimeout', 10)), \
+            float(comDavra.conf.get('plcMaxBackoff', 30)), onPLCStateChange, onPLCData)
+    else:
+        plcSession = davraPlc.PlcSession('local', '127.0.0.1', comDavra.conf['UUID'], secureInfoSupplier, 41100, \
+            float(comDavra.conf.get('plcTimeout', 10)), float(comDavra.conf.get('plcMaxBackoff', 30)), comDavra.log, \
+            onPLCStateChange)
+    # Run forever. 
+    # Send heartbeat signal to server ocassionally, check for jobs and run them
+    scheduleAgentTasks()
+    scheduler.runForever()
+
+if __name__ == "__main__":
+    main()
 # End Main loop
\ No newline at end of file
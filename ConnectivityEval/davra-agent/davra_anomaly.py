@@ -0,0 +1,214 @@
+# Streaming anomaly detection on PLC metrics, for reporting by exception
+# Each metric (device UUID and name) keeps an exponentially weighted mean and variance, the last few raw
+# samples and an aggregate since the last upload, so memory per metric is constant whatever the sample rate.
+# A sample is anomalous when it is more than zScore deviations from the mean (once warmupSamples have been
+# seen), or outside fixed bounds given for the metric. Entering an anomaly gives a davra.plc.anomaly event
+# with the raw samples leading up to it; coming back within bounds for clearSamples samples in a row gives
+# one more event marking the end. Between anomalies only the aggregates (see drainSummaries) go up.
+# The baseline is frozen while a metric is anomalous, so an anomaly which lasts is not learned as normal:
+# it ends once the metric is back within the range it had before the anomaly started. A metric which has
+# moved for good (eg a new setpoint) would then stay anomalous for ever, so after rebaselineSamples samples
+# of one anomaly the baseline is seeded afresh from the latest samples, with a 'rebaselined' event ending it.
+#
+import collections
+import math
+import threading
+import time
+
+
+class MetricDetector(object):
+    __slots__ = ('mean', 'variance', 'count', 'recent', 'anomalyStart', 'anomalyPeak', 'anomalySamples', \
+        'normalRun', 'summaryCount', 'summarySum')
+
+    def __init__(self, contextSamples):
+        self.mean = 0.0
+        self.variance = 0.0
+        self.count = 0
+        self.recent = collections.deque(maxlen=contextSamples)
+        # When the current anomaly started (epoch milliseconds), None while the metric is normal
+        self.anomalyStart = None
+        self.anomalyPeak = None
+        self.anomalySamples = 0
+        self.normalRun = 0
+        self.summaryCount = 0
+        self.summarySum = 0.0
+
+    # Fold a sample into the mean and variance (West's incremental form of the EWMA variance)
+    def updateBaseline(self, value, alpha):
+        if(self.count == 0):
+            self.mean = value
+        else:
+            difference = value - self.mean
+            increment = alpha * difference
+            self.mean += increment
+            self.variance = (1 - alpha) * (self.variance + difference * increment)
+        self.count += 1
+
+    # Start the baseline afresh from the given samples, eg once the metric has settled at a new level
+    def seedBaseline(self, values):
+        self.mean = sum(values) / len(values)
+        self.variance = sum((value - self.mean) ** 2 for value in values) / len(values)
+
+    def addToSummary(self, value):
+        self.summaryCount += 1
+        self.summarySum += value
+
+
+class AnomalyDetector(object):
+    # alpha weights each new sample in the mean. Deviations are at least minDeviation, so a metric which
+    # barely moves (eg humidity) does not alert on its first small change.
+    # bounds is { metricName: [lowest, highest] } (either may be None) for limits which always apply.
+    # rebaselineSamples of 0 keeps the baseline frozen however long an anomaly lasts
+    def __init__(self, alpha = 0.05, zScore = 4.0, warmupSamples = 30, contextSamples = 20, clearSamples = 3, \
+        minDeviation = 1.0, bounds = None, rebaselineSamples = 120):
+        self.alpha = alpha
+        self.zScore = zScore
+        self.warmupSamples = warmupSamples
+        self.contextSamples = contextSamples
+        self.clearSamples = clearSamples
+        self.minDeviation = minDeviation
+        self.bounds = bounds or {}
+        self.rebaselineSamples = rebaselineSamples
+        # { (uuid, name): MetricDetector }
+        self.detectors = {}
+        self.lock = threading.Lock()
+        self.sampleCount = 0
+        self.anomalyCount = 0
+        self.rebaselineCount = 0
+
+    # Check datums ({ UUID, name, value, timestamp }) as they are sampled. Returns the events to send now
+    def observe(self, data):
+        now = int(time.time() * 1000)
+        events = []
+        with self.lock:
+            for datum in data:
+                value = datum.get('value')
+                if(type(value) not in (int, float) or not math.isfinite(value)):
+                    continue
+                key = (datum.get('UUID'), datum.get('name'))
+                detector = self.detectors.get(key)
+                if(detector is None):
+                    detector = self.detectors[key] = MetricDetector(self.contextSamples)
+                event = self.check(key, detector, float(value), int(datum.get('timestamp') or now))
+                if(event is not None):
+                    events.append(event)
+                self.sampleCount += 1
+        return events
+
+    # Why the value is anomalous, or None. The mean and deviation are those from before this sample
+    def getReason(self, key, detector, value):
+        (lowest, highest) = (self.bounds.get(key[1]) or [None, None])[:2]
+        if(lowest is not None and value < lowest):
+            return 'below ' + str(lowest)
+        if(highest is not None and value > highest):
+            return 'above ' + str(highest)
+        if(detector.count < self.warmupSamples):
+            return None
+        if(abs(value - detector.mean) > self.zScore * self.getDeviation(detector)):
+            return 'zScore'
+        return None
+
+    def getDeviation(self, detector):
+        return max(math.sqrt(detector.variance), self.minDeviation)
+
+    def check(self, key, detector, value, timestamp):
+        reason = self.getReason(key, detector, value)
+        event = None
+        if(reason is not None):
+            detector.normalRun = 0
+            if(detector.anomalyStart is None):
+                detector.anomalyStart = timestamp
+                detector.anomalyPeak = value
+                detector.anomalySamples = 0
+                self.anomalyCount += 1
+                event = self.getEvent(key, 'started', {
+                    "value": value,
+                    "timestamp": timestamp,
+                    "reason": reason,
+                    "zScore": round((value - detector.mean) / self.getDeviation(detector), 2),
+                    "mean": round(detector.mean, 4),
+                    "deviation": round(self.getDeviation(detector), 4),
+                    "samples": list(detector.recent) + [[timestamp, value]]
+                })
+            elif(abs(value - detector.mean) > abs(detector.anomalyPeak - detector.mean)):
+                detector.anomalyPeak = value
+        elif(detector.anomalyStart is not None):
+            detector.normalRun += 1
+            if(detector.normalRun >= self.clearSamples):
+                event = self.getEvent(key, 'ended', {
+                    "value": value,
+                    "timestamp": timestamp,
+                    "peak": detector.anomalyPeak,
+                    "durationSeconds": round((timestamp - detector.anomalyStart) / 1000.0, 1),
+                    "samples": list(detector.recent)[-self.clearSamples:] + [[timestamp, value]]
+                })
+                (detector.anomalyStart, detector.anomalyPeak, detector.normalRun) = (None, None, 0)
+        if(detector.anomalyStart is not None):
+            detector.anomalySamples += 1
+            # Only a deviation from the baseline can be learned: values outside the fixed bounds stay anomalous
+            if(event is None and reason == 'zScore' and 0 < self.rebaselineSamples <= detector.anomalySamples):
+                event = self.rebaseline(key, detector, value, timestamp)
+        if(detector.anomalyStart is None and reason is None):
+            detector.updateBaseline(value, self.alpha)
+        detector.recent.append([timestamp, value])
+        detector.addToSummary(value)
+        return event
+
+    # End an anomaly which has lasted rebaselineSamples samples, taking the samples during it as the new normal
+    def rebaseline(self, key, detector, value, timestamp):
+        recentCount = min(len(detector.recent), detector.anomalySamples - 1)
+        previousMean = detector.mean
+        detector.seedBaseline([sample[1] for sample in list(detector.recent)[len(detector.recent) - recentCount:]] + [value])
+        self.rebaselineCount += 1
+        event = self.getEvent(key, 'rebaselined', {
+            "value": value,
+            "timestamp": timestamp,
+            "peak": detector.anomalyPeak,
+            "durationSeconds": round((timestamp - detector.anomalyStart) / 1000.0, 1),
+            "previousMean": round(previousMean, 4),
+            "mean": round(detector.mean, 4),
+            "deviation": round(self.getDeviation(detector), 4)
+        })
+        (detector.anomalyStart, detector.anomalyPeak, detector.anomalySamples) = (None, None, 0)
+        return event
+
+    def getEvent(self, key, state, details):
+        value = { "metric": key[1], "state": state }
+        value.update(details)
+        return {
+            "UUID": key[0],
+            "name": "davra.plc.anomaly",
+            "value": value,
+            "msg_type": "event"
+        }
+
+    # The mean of each metric since the last call, as datums, and start afresh. Metrics of other devices
+    # than deviceUuid are left alone when it is given
+    def drainSummaries(self, deviceUuid = None):
+        summaries = []
+        with self.lock:
+            for (uuid, name), detector in self.detectors.items():
+                if(detector.summaryCount == 0 or (deviceUuid is not None and uuid != deviceUuid)):
+                    continue
+                summaries.append({
+                    "UUID": uuid,
+                    "name": name,
+                    "value": detector.summarySum / detector.summaryCount,
+                    "msg_type": "datum"
+                })
+                (detector.summaryCount, detector.summarySum) = (0, 0.0)
+        return summaries
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'samples': self.sampleCount,
+                'anomalies': self.anomalyCount,
+                'rebaselines': self.rebaselineCount,
+                'metrics': { uuid + ' ' + name: {
+                    'mean': round(detector.mean, 3),
+                    'deviation': round(math.sqrt(detector.variance), 3),
+                    'samples': detector.count,
+                    'anomalous': detector.anomalyStart is not None
+                } for (uuid, name), detector in sorted(self.detectors.items()) }
+            }
@@ -0,0 +1,153 @@
+# PLC variable catalogue for the Davra Agent
+# The variables (ports) of the PLC programs are read from the program meta files
+# (eg *.progmeta, *.compmeta) through the RSC file services of the existing Device session,
+# so nothing has to browse the OPC UA address space node by node.
+# The catalogue is kept on disk with a signature of the PLC project name, firmware version
+# and the CRC32 of every meta file. A refresh costs a few RSC calls, and only meta files
+# whose CRC changed are read and parsed again.
+#
+import fnmatch
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+import davra_lib as comDavra
+import davra_plc as davraPlc
+from PyPlcnextRsc.Arp.Device.Interface.Services import IDeviceInfoService
+from PyPlcnextRsc.Arp.Plc.Domain.Services import IPlcInfoService, PlcInfoId
+from PyPlcnextRsc.Arp.System.Commons.Services.Io import IDirectoryService, IFileService, Traits, FileSystemError
+
+
+# Where the meta files of the active PLCnext Engineer project live on the controller
+defaultMetaDir = '/opt/plcnext/projects/PCWE/Plc/Meta'
+defaultMetaFilePatterns = ['*.progmeta', '*.compmeta']
+
+
+def getEmptyCatalogue():
+    return { 'signature': {}, 'files': {}, 'variables': [] }
+
+
+def loadCatalogue(catalogueFile):
+    try:
+        if(os.path.isfile(catalogueFile)):
+            with open(catalogueFile) as data_file:
+                catalogue = json.load(data_file)
+            if('signature' in catalogue and 'files' in catalogue and 'variables' in catalogue):
+                return catalogue
+    except Exception as e:
+        comDavra.log('Ignoring unreadable PLC variable catalogue: ' + str(e))
+    return getEmptyCatalogue()
+
+
+def saveCatalogue(catalogueFile, catalogue):
+    comDavra.writeJsonFileAtomically(catalogueFile, catalogue)
+
+
+# Drop the xml namespace from a tag, eg "{http://www.phoenixcontact.com/schema/metaconfig}Port" -> "Port"
+def getLocalTag(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+
+# Returns the variables declared in a meta file as a list of { name, type, program, attributes }
+# A variable belongs to the nearest enclosing element with a name (the program or component)
+def parseMetaFile(content):
+    variables = []
+    root = ElementTree.fromstring(content)
+    def visit(element, owner):
+        for child in element:
+            if(getLocalTag(child) == 'Port' and child.get('name')):
+                variables.append({
+                    'name': child.get('name'),
+                    'type': child.get('type', ''),
+                    'program': owner,
+                    'attributes': child.get('attributes', '')
+                })
+            else:
+                visit(child, child.get('name', owner) if getLocalTag(child) in ['Program', 'Component'] else owner)
+    visit(root, root.get('name', ''))
+    return variables
+
+
+# Returns { path: crc32 } for every meta file below metaDir, in a single RSC call
+def getMetaFileCrcs(device, metaDir, patterns):
+    metaFileCrcs = {}
+    for entry in IDirectoryService(device).EnumerateFileSystemTraitsEntries(metaDir, '*', Traits.Crc32, True):
+        if(entry.IsFile is False or not any(fnmatch.fnmatch(os.path.basename(entry.Path), p) for p in patterns)):
+            continue
+        crc = None
+        for traitItem in entry.Traits:
+            if(traitItem.Trait == Traits.Crc32):
+                crc = traitItem.Value.GetValue()
+        metaFileCrcs[entry.Path] = crc
+    return metaFileCrcs
+
+
+def getPlcSignature(device, metaDir, patterns):
+    return {
+        'projectName': str(IPlcInfoService(device).GetInfo(PlcInfoId.ProjectName).GetValue()),
+        'firmwareVersion': str(davraPlc.getItems(IDeviceInfoService(device), 'IDeviceInfoService.GetItems', ['General.Firmware.Version'])[0].GetValue()),
+        'metaFiles': getMetaFileCrcs(device, metaDir, patterns)
+    }
+
+
+def readMetaFile(device, path):
+    (stream, traits, error) = IFileService(device).Read(Traits.NONE, path)
+    if(error != FileSystemError.NONE):
+        raise IOError('Cannot read ' + path + ' from PLC: ' + str(error))
+    return stream.getValue()
+
+
+# Variables are identified by program and name
+def getVariableKey(variable):
+    return variable['program'] + '/' + variable['name']
+
+
+# Returns { added: [keys], removed: [keys] } between two lists of variable keys
+def getCatalogueDiff(oldKeys, newKeys):
+    return { 'added': sorted(set(newKeys) - set(oldKeys)), 'removed': sorted(set(oldKeys) - set(newKeys)) }
+
+
+# Returns the diff between the variables last uploaded to the server and the catalogue,
+# or None if the server is up to date
+def getUploadDiff(catalogue):
+    keys = [getVariableKey(v) for v in catalogue['variables']]
+    if(catalogue.get('uploadedKeys') == keys):
+        return None
+    return getCatalogueDiff(catalogue.get('uploadedKeys') or [], keys)
+
+
+def markUploaded(catalogue):
+    catalogue['uploadedKeys'] = [getVariableKey(v) for v in catalogue['variables']]
+
+
+# Bring the catalogue in line with the PLC. Returns (catalogue, diff) where diff is None if the
+# PLC signature is unchanged. A new project or firmware re-reads every meta file,
+# otherwise only those whose CRC changed.
+def refreshCatalogue(device, catalogue, metaDir = defaultMetaDir, patterns = defaultMetaFilePatterns):
+    signature = getPlcSignature(device, metaDir, patterns)
+    oldSignature = catalogue['signature']
+    if(signature == oldSignature):
+        return (catalogue, None)
+    sameProgramBase = signature['projectName'] == oldSignature.get('projectName') \
+        and signature['firmwareVersion'] == oldSignature.get('firmwareVersion')
+    oldCrcs = oldSignature.get('metaFiles', {}) if sameProgramBase else {}
+    files = {}
+    for path, crc in signature['metaFiles'].items():
+        if(crc is not None and oldCrcs.get(path) == crc and path in catalogue['files']):
+            files[path] = catalogue['files'][path]
+            continue
+        try:
+            files[path] = parseMetaFile(readMetaFile(device, path))
+        except Exception as e:
+            comDavra.logWarning('Skipping PLC meta file ' + path + ': ' + str(e))
+            # Read it again on the next refresh
+            signature['metaFiles'][path] = None
+            files[path] = []
+    variables = sorted((v for fileVariables in files.values() for v in fileVariables), key=getVariableKey)
+    diff = getCatalogueDiff([getVariableKey(v) for v in catalogue['variables']], [getVariableKey(v) for v in variables])
+    refreshedCatalogue = dict(catalogue)
+    refreshedCatalogue.update({ 'signature': signature, 'files': files, 'variables': variables })
+    return (refreshedCatalogue, diff)
+
+
+def getVariableNames(catalogue):
+    return set(v['name'] for v in catalogue['variables'])
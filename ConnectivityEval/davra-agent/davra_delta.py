@@ -0,0 +1,180 @@
+# Delta updates for Device Applications pushed by the Davra Agent
+# A delta artifact is a tar.gz holding a delta.json manifest plus a "files" directory
+# with every file which was added or changed between two versions of an app bundle.
+# The agent rebuilds the full bundle from a version already installed under
+# installationDir/apps and verifies the result before installing it.
+#
+# To create a delta artifact from two app bundles (directories or tar.gz files):
+#   python davra_delta.py <old bundle> <new bundle> <delta.tar.gz>
+#
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import tarfile
+import tempfile
+
+
+# Name of the file kept in each installed app directory describing the bundle it came from
+bundleManifestFilename = '.davra_bundle.json'
+# Name of the manifest inside a delta artifact
+deltaManifestFilename = 'delta.json'
+# Directory inside a delta artifact holding the added or changed files
+deltaFilesDirname = 'files'
+# The agent strips carriage returns from the end of each line of this script before installing a bundle
+installScriptName = 'install.sh'
+
+
+# Sha256 of a single file, read in chunks so large files do not sit in RAM
+def getFileHash(filePath):
+    fileHash = hashlib.sha256()
+    with open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+
+# Sha256 of the install script as installed, ie with unix line endings, so a bundle hashes the same
+# before and after the agent normalises it
+def getInstallScriptHash(filePath):
+    with open(filePath, 'rb') as f:
+        return hashlib.sha256(re.sub(b'\r$', b'', f.read(), flags=re.MULTILINE)).hexdigest()
+
+
+# Build a manifest of every file below a directory as { relativePath: sha256 }
+def getDirectoryManifest(directory):
+    manifest = {}
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if(filename == bundleManifestFilename):
+                continue
+            filePath = os.path.join(root, filename)
+            if(os.path.islink(filePath)):
+                continue
+            relativePath = os.path.relpath(filePath, directory).replace(os.sep, '/')
+            if(relativePath == installScriptName):
+                manifest[relativePath] = getInstallScriptHash(filePath)
+            else:
+                manifest[relativePath] = getFileHash(filePath)
+    return manifest
+
+
+# Hash of a whole bundle, independent of tar ordering and file timestamps
+def getManifestHash(manifest):
+    treeHash = hashlib.sha256()
+    for relativePath in sorted(manifest):
+        treeHash.update((relativePath + '\0' + manifest[relativePath] + '\n').encode('utf8'))
+    return treeHash.hexdigest()
+
+
+# Record which bundle an installed app directory came from, so it can be the base of a later delta
+def writeBundleManifest(appDir, manifest, source):
+    bundleInfo = {
+        'treeHash': getManifestHash(manifest),
+        'source': source,
+        'files': manifest
+    }
+    with open(os.path.join(appDir, bundleManifestFilename), 'w') as outfile:
+        json.dump(bundleInfo, outfile, indent=4)
+    return bundleInfo
+
+
+# Find an installed app (newest first) whose bundle has the given tree hash
+# Returns a tuple of (appDir, bundleInfo) or (None, None)
+def findInstalledBundle(appsDir, treeHash):
+    if(os.path.isdir(appsDir) is False):
+        return (None, None)
+    for appDirName in sorted(os.listdir(appsDir), reverse=True):
+        bundleManifestFile = os.path.join(appsDir, appDirName, bundleManifestFilename)
+        if(os.path.isfile(bundleManifestFile) is False):
+            continue
+        try:
+            with open(bundleManifestFile) as data_file:
+                bundleInfo = json.load(data_file)
+        except Exception:
+            continue
+        if(bundleInfo.get('treeHash') == treeHash):
+            return (os.path.join(appsDir, appDirName), bundleInfo)
+    return (None, None)
+
+
+# Copy a file into a bundle directory, creating parent directories as needed
+def copyIntoBundle(sourceFile, bundleDir, relativePath):
+    destinationFile = os.path.join(bundleDir, relativePath)
+    os.makedirs(os.path.dirname(destinationFile), exist_ok=True)
+    shutil.copy2(sourceFile, destinationFile)
+
+
+# Rebuild a full bundle in targetDir from an extracted delta artifact and an installed base version.
+# Returns (True, message) only if every base file is unmodified and the result matches the target hash.
+def applyDelta(deltaDir, appsDir, targetDir):
+    deltaManifestFile = os.path.join(deltaDir, deltaManifestFilename)
+    if(os.path.isfile(deltaManifestFile) is False):
+        return (False, 'Delta artifact has no ' + deltaManifestFilename)
+    with open(deltaManifestFile) as data_file:
+        deltaManifest = json.load(data_file)
+    if('baseTreeHash' not in deltaManifest or 'targetTreeHash' not in deltaManifest):
+        return (False, 'Delta manifest is missing baseTreeHash or targetTreeHash')
+    (baseDir, baseInfo) = findInstalledBundle(appsDir, deltaManifest['baseTreeHash'])
+    if(baseDir is None):
+        return (False, 'No installed app matches base ' + deltaManifest['baseTreeHash'])
+    removedFiles = set(deltaManifest.get('removedFiles', []))
+    deltaFilesDir = os.path.join(deltaDir, deltaFilesDirname)
+    changedFiles = getDirectoryManifest(deltaFilesDir) if os.path.isdir(deltaFilesDir) else {}
+    # Unchanged files come from the installed base, and must still be as they were installed
+    for relativePath, fileHash in baseInfo['files'].items():
+        if(relativePath in removedFiles or relativePath in changedFiles):
+            continue
+        baseFile = os.path.join(baseDir, relativePath)
+        if(os.path.isfile(baseFile) is False or getFileHash(baseFile) != fileHash):
+            return (False, 'Installed base file was modified since install: ' + relativePath)
+        copyIntoBundle(baseFile, targetDir, relativePath)
+    for relativePath in changedFiles:
+        copyIntoBundle(os.path.join(deltaFilesDir, relativePath), targetDir, relativePath)
+    resultHash = getManifestHash(getDirectoryManifest(targetDir))
+    if(resultHash != deltaManifest['targetTreeHash']):
+        return (False, 'Reconstructed bundle hash ' + resultHash + ' does not match ' + deltaManifest['targetTreeHash'])
+    return (True, 'Reconstructed bundle ' + resultHash + ' from ' + baseDir)
+
+
+# Create a delta artifact (tar.gz) which turns oldBundleDir into newBundleDir
+def createDelta(oldBundleDir, newBundleDir, deltaArchive):
+    oldManifest = getDirectoryManifest(oldBundleDir)
+    newManifest = getDirectoryManifest(newBundleDir)
+    deltaManifest = {
+        'baseTreeHash': getManifestHash(oldManifest),
+        'targetTreeHash': getManifestHash(newManifest),
+        'removedFiles': sorted(set(oldManifest) - set(newManifest))
+    }
+    changedFiles = sorted(p for p in newManifest if oldManifest.get(p) != newManifest[p])
+    with tempfile.TemporaryDirectory() as tmpDir:
+        manifestFile = os.path.join(tmpDir, deltaManifestFilename)
+        with open(manifestFile, 'w') as outfile:
+            json.dump(deltaManifest, outfile, indent=4)
+        with tarfile.open(deltaArchive, 'w:gz') as tar:
+            tar.add(manifestFile, arcname=deltaManifestFilename)
+            for relativePath in changedFiles:
+                tar.add(os.path.join(newBundleDir, relativePath), arcname=deltaFilesDirname + '/' + relativePath)
+    print('Delta ' + deltaManifest['baseTreeHash'] + ' -> ' + deltaManifest['targetTreeHash'] + ': ' \
+        + str(len(changedFiles)) + ' changed, ' + str(len(deltaManifest['removedFiles'])) + ' removed')
+    return deltaManifest
+
+
+# Bundles may be given as directories or as the tar.gz which would be pushed to the device
+def extractBundleIfArchive(bundle, tmpDir):
+    if(os.path.isdir(bundle)):
+        return bundle
+    extractDir = tempfile.mkdtemp(dir=tmpDir)
+    with tarfile.open(bundle) as tar:
+        tar.extractall(extractDir)
+    return extractDir
+
+
+if __name__ == "__main__":
+    if(len(sys.argv) != 4):
+        print('Usage: python davra_delta.py <old bundle> <new bundle> <delta.tar.gz>')
+        sys.exit(1)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        createDelta(extractBundleIfArchive(sys.argv[1], tmpDir), extractBundleIfArchive(sys.argv[2], tmpDir), sys.argv[3])
@@ -0,0 +1,100 @@
+# Gateway mode for the Davra Agent
+# One agent supervises several PLCnext controllers, listed in the config as plcEndpoints, eg
+#   "plcEndpoints": [ { "name": "press1", "host": "10.0.0.11", "UUID": "<Davra device UUID>",
+#                       "user": "admin", "passwordEnv": "PRESS1_PLC_PASS", "port": 41100, "interval": 60 } ]
+# user and passwordEnv default to the PLC_USER and PLC_PASS environment variables. Passwords are
+# taken from the environment so they never end up in config.json, which is reported to the server.
+# Each endpoint reports as its own Davra device. Its acquisition and health check are tasks on the agent's
+# scheduler, so endpoints share the scheduler's bounded worker pool rather than having a thread each,
+# and all of their data reaches the server through one shared Uplink.
+#
+import os
+import davra_lib as comDavra
+import davra_plc as davraPlc
+
+
+class Gateway(object):
+    # onStateChange(session, isUp, downtimeSeconds) is called when a PLC goes down or comes back up
+    # onData(dataToSend) is called with the datums of each acquisition as they are queued, eg to keep history
+    def __init__(self, endpoints, uplink, timeout = 10, maxBackoff = 30, onStateChange = None, onData = None):
+        self.uplink = uplink
+        self.onData = onData
+        self.sessions = {}
+        # Per endpoint: the connect count and attributes last reported to the server
+        self.reportedConnectCounts = {}
+        self.reportedAttributes = {}
+        self.intervals = {}
+        for endpoint in endpoints:
+            if(not endpoint.get('name') or not endpoint.get('host') or not endpoint.get('UUID')):
+                comDavra.logError('Ignoring PLC endpoint without name, host and UUID: ' + str(endpoint))
+                continue
+            if(endpoint['name'] in self.sessions):
+                comDavra.logError('Ignoring PLC endpoint with duplicate name: ' + endpoint['name'])
+                continue
+            self.sessions[endpoint['name']] = davraPlc.PlcSession(endpoint['name'], endpoint['host'], endpoint['UUID'], \
+                self.getCredentialsSupplier(endpoint), int(endpoint.get('port', 41100)), timeout, maxBackoff, comDavra.log, \
+                onStateChange)
+            self.intervals[endpoint['name']] = endpoint.get('interval')
+            self.reportedConnectCounts[endpoint['name']] = 0
+            self.reportedAttributes[endpoint['name']] = {}
+        comDavra.logInfo('Gateway mode: supervising ' + str(len(self.sessions)) + ' PLC(s)')
+
+    def getCredentialsSupplier(self, endpoint):
+        def credentialsSupplier():
+            return (endpoint.get('user', os.environ.get('PLC_USER', '')), \
+                os.environ.get(endpoint.get('passwordEnv', 'PLC_PASS'), ''))
+        return credentialsSupplier
+
+    # Read the status of one PLC and queue it for the uplink. After each (re)connect
+    # its system info is also reported as attributes of its device.
+    def acquire(self, name):
+        session = self.sessions[name]
+        try:
+            dataToSend = session.call(lambda device: davraPlc.readPLCStatusDatums(device, session.deviceUuid))
+            if(dataToSend is None):
+                return
+            self.uplink.add(dataToSend)
+            if(self.onData is not None):
+                self.onData(dataToSend)
+            if(self.reportedConnectCounts[name] != session.connectCount):
+                self.reportSystemInfo(name)
+        except Exception as e:
+            comDavra.logError('Failed to read PLC ' + name + ': ' + str(e))
+
+    def reportSystemInfo(self, name):
+        session = self.sessions[name]
+        attributes = session.call(davraPlc.readPLCSystemInfo)
+        if(attributes is None):
+            return
+        changedAttributes = { key: value for key, value in attributes.items() if self.reportedAttributes[name].get(key) != value }
+        if(len(changedAttributes) > 0):
+            if(comDavra.patchDeviceAttributesOnServer(session.deviceUuid, changedAttributes).status_code != 200):
+                return
+            self.reportedAttributes[name].update(changedAttributes)
+        self.reportedConnectCounts[name] = session.connectCount
+
+    # Add (or update the interval of) one acquisition task and one health check task per PLC.
+    # Each PLC gets a fixed phase within the interval derived from its UUID, so they are polled
+    # spread out rather than all at once.
+    def scheduleTasks(self, scheduler, defaultInterval, healthInterval, startupRamp = 120):
+        for name, session in self.sessions.items():
+            phaseFraction = comDavra.getDevicePhaseFraction(session.deviceUuid)
+            tasks = {
+                'plc.' + name: (float(self.intervals[name] or defaultInterval), lambda name = name: self.acquire(name)),
+                'plc.' + name + '.health': (float(healthInterval), session.checkHealth)
+            }
+            for taskName, (interval, functionToRun) in tasks.items():
+                if(interval <= 0):
+                    scheduler.removeTask(taskName)
+                elif(scheduler.hasTask(taskName)):
+                    scheduler.setInterval(taskName, interval, None, phaseFraction * interval)
+                else:
+                    scheduler.addTask(taskName, interval, functionToRun, 0, \
+                        phaseFraction * min(interval, startupRamp), phaseFraction * interval)
+
+    def dispose(self):
+        for session in self.sessions.values():
+            session.dispose()
+
+    def getStats(self):
+        return { name: session.getStats() for name, session in self.sessions.items() }
@@ -0,0 +1,398 @@
+# On-device history of telemetry for the Davra Agent, for when uploads were lost or the server needs a re-sync
+# Number samples are kept per metric (device UUID and name) in compressed chunks: timestamps as
+# delta-of-delta and values XORed with the previous value (as in Facebook's Gorilla), so a regularly
+# sampled metric takes a few bits per sample. A chunk is sealed after chunkSeconds of samples, or
+# when its metric goes quiet, and appended to the current segment file; a new segment starts every
+# segmentSeconds. An index of every chunk's time range is kept in memory (rebuilt from the chunk headers
+# at startup) so a range read only opens the chunks which overlap it.
+# Retention is by whole segments: the oldest go once past retentionSeconds or when all together exceed maxBytes.
+# Samples still in an open chunk are only in memory, so up to chunkSeconds of history may be lost on power loss.
+#
+import bisect
+import os
+import struct
+import threading
+import time
+
+
+# Each chunk on disk is this header, then the UUID, the metric name and the compressed samples
+chunkHeader = struct.Struct('>4sHHqqII')
+chunkMagic = b'DVH1'
+maxChunkSamples = 1000
+float64 = struct.Struct('>d')
+uint64 = struct.Struct('>Q')
+mask64 = (1 << 64) - 1
+
+
+class BitWriter(object):
+    __slots__ = ('buffer', 'current', 'currentBits')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.current = 0
+        self.currentBits = 0
+
+    def write(self, value, bitCount):
+        self.current = (self.current << bitCount) | value
+        self.currentBits += bitCount
+        while self.currentBits >= 8:
+            self.currentBits -= 8
+            self.buffer.append((self.current >> self.currentBits) & 0xFF)
+        self.current &= (1 << self.currentBits) - 1
+
+    def getBytes(self):
+        if(self.currentBits == 0):
+            return bytes(self.buffer)
+        return bytes(self.buffer) + bytes([(self.current << (8 - self.currentBits)) & 0xFF])
+
+
+class BitReader(object):
+    __slots__ = ('bits', 'remaining')
+
+    def __init__(self, data):
+        self.bits = int.from_bytes(data, 'big')
+        self.remaining = len(data) * 8
+
+    def read(self, bitCount):
+        self.remaining -= bitCount
+        if(self.remaining < 0):
+            raise ValueError('history chunk is truncated')
+        return (self.bits >> self.remaining) & ((1 << bitCount) - 1)
+
+
+# Delta-of-delta of the timestamps (milliseconds) in buckets: 0 for the same interval as before,
+# then 7, 9 or 12 bits, or the full 64 bits for a jump
+timestampBuckets = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+
+
+class ChunkEncoder(object):
+    __slots__ = ('writer', 'count', 'startTime', 'lastTime', 'lastDelta', 'lastBits', 'leading', 'trailing')
+
+    def __init__(self):
+        self.writer = BitWriter()
+        self.count = 0
+        self.startTime = None
+        self.lastTime = None
+        self.lastDelta = 0
+        self.lastBits = 0
+        self.leading = None
+        self.trailing = None
+
+    def add(self, timestamp, value):
+        bits = uint64.unpack(float64.pack(value))[0]
+        if(self.count == 0):
+            self.writer.write(timestamp & mask64, 64)
+            self.writer.write(bits, 64)
+            self.startTime = timestamp
+        else:
+            self.addTimestamp(timestamp)
+            self.addValue(bits)
+        self.lastTime = timestamp
+        self.lastBits = bits
+        self.count += 1
+
+    def addTimestamp(self, timestamp):
+        delta = timestamp - self.lastTime
+        deltaOfDelta = delta - self.lastDelta
+        self.lastDelta = delta
+        if(deltaOfDelta == 0):
+            self.writer.write(0, 1)
+            return
+        for (prefix, prefixBits, valueBits) in timestampBuckets:
+            offset = (1 << (valueBits - 1)) - 1
+            if(-offset <= deltaOfDelta <= offset + 1):
+                self.writer.write(prefix, prefixBits)
+                self.writer.write(deltaOfDelta + offset, valueBits)
+                return
+        self.writer.write(0b1111, 4)
+        self.writer.write(deltaOfDelta & mask64, 64)
+
+    def addValue(self, bits):
+        xor = bits ^ self.lastBits
+        if(xor == 0):
+            self.writer.write(0, 1)
+            return
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if(self.leading is not None and leading >= self.leading and trailing >= self.trailing):
+            # The changed bits fit in the window of the previous value
+            self.writer.write(0b10, 2)
+            self.writer.write(xor >> self.trailing, 64 - self.leading - self.trailing)
+            return
+        meaningfulBits = 64 - leading - trailing
+        self.writer.write(0b11, 2)
+        self.writer.write(leading, 5)
+        self.writer.write(meaningfulBits - 1, 6)
+        self.writer.write(xor >> trailing, meaningfulBits)
+        (self.leading, self.trailing) = (leading, trailing)
+
+
+# The [(timestamp, value)] samples of one chunk
+def decodeChunk(payload, count):
+    reader = BitReader(payload)
+    samples = []
+    if(count == 0):
+        return samples
+    timestamp = reader.read(64)
+    if(timestamp >= 1 << 63):
+        timestamp -= 1 << 64
+    bits = reader.read(64)
+    samples.append((timestamp, float64.unpack(uint64.pack(bits))[0]))
+    (delta, leading, trailing) = (0, 0, 0)
+    for index in range(1, count):
+        # The bucket is given by how many 1 bits lead the timestamp (0 to 4)
+        bucket = 0
+        while bucket < 4 and reader.read(1) == 1:
+            bucket += 1
+        if(bucket == 0):
+            deltaOfDelta = 0
+        elif(bucket == 4):
+            deltaOfDelta = reader.read(64)
+            if(deltaOfDelta >= 1 << 63):
+                deltaOfDelta -= 1 << 64
+        else:
+            valueBits = timestampBuckets[bucket - 1][2]
+            deltaOfDelta = reader.read(valueBits) - ((1 << (valueBits - 1)) - 1)
+        delta += deltaOfDelta
+        timestamp += delta
+        if(reader.read(1) == 1):
+            if(reader.read(1) == 1):
+                leading = reader.read(5)
+                meaningfulBits = reader.read(6) + 1
+                trailing = 64 - leading - meaningfulBits
+            bits ^= reader.read(64 - leading - trailing) << trailing
+        samples.append((timestamp, float64.unpack(uint64.pack(bits))[0]))
+    return samples
+
+
+class ChunkRef(object):
+    __slots__ = ('startTime', 'endTime', 'count', 'segment', 'offset', 'length')
+
+    def __init__(self, startTime, endTime, count, segment, offset, length):
+        self.startTime = startTime
+        self.endTime = endTime
+        self.count = count
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+
+class Segment(object):
+    __slots__ = ('path', 'startTime', 'size', 'newestTime')
+
+    def __init__(self, path, startTime):
+        self.path = path
+        self.startTime = startTime
+        self.size = 0
+        self.newestTime = 0
+
+
+class HistoryStore(object):
+    # retentionSeconds and maxBytes bound what is kept on disk. Chunks are sealed after chunkSeconds
+    def __init__(self, directory, retentionSeconds = 3 * 86400, maxBytes = 64000000, chunkSeconds = 600, \
+        segmentSeconds = 3600, logFunction = print):
+        self.directory = directory
+        self.retentionSeconds = retentionSeconds
+        self.maxBytes = maxBytes
+        self.chunkSeconds = chunkSeconds
+        self.segmentSeconds = segmentSeconds
+        self.log = logFunction
+        self.lock = threading.RLock()
+        # { (uuid, name): ChunkEncoder } still being filled
+        self.openChunks = {}
+        # { (uuid, name): ([chunk start times], [ChunkRef]) } sorted by start time
+        self.index = {}
+        self.segments = []
+        self.currentSegment = None
+        self.sampleCount = 0
+        self.skippedCount = 0
+        os.makedirs(directory, exist_ok=True)
+        self.loadIndex()
+
+    # Read the header of every chunk in the segment files, skipping the samples
+    def loadIndex(self):
+        for fileName in sorted(os.listdir(self.directory)):
+            if(not fileName.startswith('history-') or not fileName.endswith('.dvh')):
+                continue
+            try:
+                segment = Segment(os.path.join(self.directory, fileName), int(fileName[8:-4]))
+            except ValueError:
+                continue
+            with open(segment.path, 'rb') as segmentFile:
+                data = segmentFile.read()
+            offset = 0
+            while offset + chunkHeader.size <= len(data):
+                (magic, uuidLength, nameLength, startTime, endTime, count, payloadLength) = \
+                    chunkHeader.unpack_from(data, offset)
+                length = chunkHeader.size + uuidLength + nameLength + payloadLength
+                if(magic != chunkMagic or offset + length > len(data)):
+                    # A chunk cut short, eg by a power cut while it was written. Nothing after it is read
+                    self.log('History: ignoring the end of ' + fileName + ' from byte ' + str(offset))
+                    break
+                keyStart = offset + chunkHeader.size
+                key = (data[keyStart:keyStart + uuidLength].decode('utf8'), \
+                    data[keyStart + uuidLength:keyStart + uuidLength + nameLength].decode('utf8'))
+                self.addToIndex(key, ChunkRef(startTime, endTime, count, segment, offset, length))
+                segment.newestTime = max(segment.newestTime, endTime)
+                offset += length
+            segment.size = len(data)
+            self.segments.append(segment)
+
+    def addToIndex(self, key, chunkRef):
+        (startTimes, chunkRefs) = self.index.setdefault(key, ([], []))
+        position = bisect.bisect_right(startTimes, chunkRef.startTime)
+        startTimes.insert(position, chunkRef.startTime)
+        chunkRefs.insert(position, chunkRef)
+
+    # Add number samples from datums as given to the server ({ UUID, name, value, timestamp }, timestamp
+    # in epoch milliseconds, now if missing). Anything which is not a number (eg events) is not kept
+    def record(self, dataToRecord):
+        now = int(time.time() * 1000)
+        with self.lock:
+            for datum in dataToRecord:
+                value = datum.get('value')
+                if(type(value) not in (int, float, bool) or datum.get('msg_type', 'datum') != 'datum'):
+                    self.skippedCount += 1
+                    continue
+                try:
+                    self.addSample((datum.get('UUID', ''), datum['name']), int(datum.get('timestamp') or now), float(value))
+                except (KeyError, TypeError, ValueError, OverflowError):
+                    self.skippedCount += 1
+
+    def addSample(self, key, timestamp, value):
+        encoder = self.openChunks.get(key)
+        # A chunk spans at most chunkSeconds and only moves forward in time, which keeps range reads simple
+        if(encoder is not None and (timestamp < encoder.lastTime or timestamp - encoder.startTime > self.chunkSeconds * 1000 \
+        or encoder.count >= maxChunkSamples)):
+            self.sealChunk(key, encoder)
+            encoder = None
+        if(encoder is None):
+            encoder = self.openChunks[key] = ChunkEncoder()
+        encoder.add(timestamp, value)
+        self.sampleCount += 1
+
+    def sealChunk(self, key, encoder):
+        del self.openChunks[key]
+        if(encoder.count == 0):
+            return
+        segment = self.getCurrentSegment()
+        uuidBytes = key[0].encode('utf8')
+        nameBytes = key[1].encode('utf8')
+        payload = encoder.writer.getBytes()
+        record = chunkHeader.pack(chunkMagic, len(uuidBytes), len(nameBytes), encoder.startTime, encoder.lastTime, \
+            encoder.count, len(payload)) + uuidBytes + nameBytes + payload
+        try:
+            with open(segment.path, 'ab') as segmentFile:
+                segmentFile.write(record)
+        except OSError as e:
+            self.log('History: could not write to ' + segment.path + ': ' + str(e))
+            return
+        self.addToIndex(key, ChunkRef(encoder.startTime, encoder.lastTime, encoder.count, segment, segment.size, len(record)))
+        segment.size += len(record)
+        segment.newestTime = max(segment.newestTime, encoder.lastTime)
+
+    def getCurrentSegment(self):
+        now = time.time()
+        if(self.currentSegment is None or now - self.currentSegment.startTime / 1000.0 > self.segmentSeconds \
+        or self.currentSegment.size > self.maxBytes / 16):
+            startTime = int(now * 1000)
+            if(len(self.segments) > 0 and startTime <= self.segments[-1].startTime):
+                startTime = self.segments[-1].startTime + 1
+            self.currentSegment = Segment(os.path.join(self.directory, 'history-' + str(startTime) + '.dvh'), startTime)
+            self.segments.append(self.currentSegment)
+            self.enforceRetention()
+        return self.currentSegment
+
+    # Remove the oldest segments which are past retentionSeconds, or while all together are over maxBytes
+    def enforceRetention(self):
+        oldestKept = (time.time() - self.retentionSeconds) * 1000
+        while len(self.segments) > 1:
+            segment = self.segments[0]
+            totalBytes = sum(segment.size for segment in self.segments)
+            if(segment.newestTime >= oldestKept and totalBytes <= self.maxBytes):
+                break
+            self.segments.pop(0)
+            try:
+                os.remove(segment.path)
+            except OSError:
+                pass
+            for key in list(self.index.keys()):
+                (startTimes, chunkRefs) = self.index[key]
+                keep = [position for position, chunkRef in enumerate(chunkRefs) if chunkRef.segment is not segment]
+                if(len(keep) == 0):
+                    del self.index[key]
+                elif(len(keep) < len(chunkRefs)):
+                    self.index[key] = ([startTimes[position] for position in keep], [chunkRefs[position] for position in keep])
+
+    # Seal the chunks which have had no sample for idleSeconds or are older than chunkSeconds,
+    # so they reach the disk. Call periodically, and with idleSeconds 0 to seal everything (eg on exit)
+    def flush(self, idleSeconds = 60):
+        now = int(time.time() * 1000)
+        with self.lock:
+            for key, encoder in list(self.openChunks.items()):
+                if(idleSeconds == 0 or now - encoder.lastTime > idleSeconds * 1000 \
+                or now - encoder.startTime > self.chunkSeconds * 1000):
+                    self.sealChunk(key, encoder)
+            self.enforceRetention()
+
+    # The metrics kept as [(uuid, name)], optionally only those of one device or matching some names
+    def getMetrics(self, deviceUuid = None, names = None):
+        with self.lock:
+            keys = set(self.index.keys()) | set(self.openChunks.keys())
+        return sorted(key for key in keys if (deviceUuid is None or key[0] == deviceUuid) and (names is None or key[1] in names))
+
+    # The samples of one metric from fromTime to toTime (epoch milliseconds, inclusive) as (timestamp, value),
+    # decoded one chunk at a time so a long range does not have to fit in memory
+    def iterateSamples(self, key, fromTime, toTime):
+        with self.lock:
+            (startTimes, chunkRefs) = self.index.get(key, ([], []))
+            # Chunks span at most chunkSeconds, so none starting before that could reach fromTime
+            first = bisect.bisect_left(startTimes, fromTime - self.chunkSeconds * 1000)
+            last = bisect.bisect_right(startTimes, toTime)
+            chunkRefs = [chunkRef for chunkRef in chunkRefs[first:last] if chunkRef.endTime >= fromTime]
+            encoder = self.openChunks.get(key)
+            openChunk = (encoder.writer.getBytes(), encoder.count) if encoder is not None else None
+        (segmentFile, segmentPath) = (None, None)
+        try:
+            for chunkRef in chunkRefs:
+                if(chunkRef.segment.path != segmentPath):
+                    if(segmentFile is not None):
+                        segmentFile.close()
+                    (segmentFile, segmentPath) = (None, chunkRef.segment.path)
+                    try:
+                        segmentFile = open(segmentPath, 'rb')
+                    except OSError:
+                        # Removed by retention since the index was read
+                        pass
+                if(segmentFile is None):
+                    continue
+                segmentFile.seek(chunkRef.offset)
+                data = segmentFile.read(chunkRef.length)
+                (magic, uuidLength, nameLength, startTime, endTime, count, payloadLength) = chunkHeader.unpack_from(data)
+                for sample in decodeChunk(data[chunkHeader.size + uuidLength + nameLength:], count):
+                    if(fromTime <= sample[0] <= toTime):
+                        yield sample
+        finally:
+            if(segmentFile is not None):
+                segmentFile.close()
+        if(openChunk is not None):
+            for sample in decodeChunk(*openChunk):
+                if(fromTime <= sample[0] <= toTime):
+                    yield sample
+
+    def read(self, key, fromTime, toTime):
+        return list(self.iterateSamples(key, fromTime, toTime))
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'metrics': len(set(self.index.keys()) | set(self.openChunks.keys())),
+                'chunks': sum(len(chunkRefs) for (startTimes, chunkRefs) in self.index.values()),
+                'openChunks': len(self.openChunks),
+                'segments': len(self.segments),
+                'bytes': sum(segment.size for segment in self.segments),
+                'oldest': min([chunkRefs[0].startTime for (startTimes, chunkRefs) in self.index.values()] or [None]) \
+                    if self.index else None,
+                'samplesRecorded': self.sampleCount,
+                'skipped': self.skippedCount
+            }
@@ -1,14 +1,20 @@
 # Utility functions for other programs
 #
 import subprocess
-import os, string
+import os, string, shutil
 import time, requests, os.path
 from requests.auth import HTTPBasicAuth
 import json 
 from pprint import pprint
 import sys
 import uuid
+import hashlib
+import threading
 from datetime import datetime
+import re
+import functools
+import davra_sysinfo
+import davra_metrics as davraMetrics
 
 # Update this when anything changes in the agent
 davraAgentVersion = "2_0_0" 
@@ -18,6 +24,10 @@ installationDir = "/usr/bin/davra"
 agentConfigFile = installationDir + "/config.json"
 # Where logs are saved by default
 logDir = "/var/log"
+# Content hashes of the device state (labels, attributes, capabilities) the server last acknowledged
+serverStateCacheFile = installationDir + "/serverState.json"
+# Names of the metrics already defined on the server
+definedMetricsFile = installationDir + "/definedMetrics.json"
 # Flags to indicate cache entries
 flagNewCapabilityReadyToReport = False
 
@@ -41,13 +51,21 @@ def getConfiguration():
 
 # Update (or insert) a configuration item with a value
 def upsertConfigurationItem(itemKey, itemValue):
+    upsertConfigurationItems({ itemKey: itemValue })
+    return
+
+
+# Update (or insert) several configuration items at once, as { itemKey: itemValue }
+# The config file is written and reported to the server once, and only if something changed
+def upsertConfigurationItems(items):
     global conf
     loadConfiguration()
     if(os.path.isfile(agentConfigFile) is True):
-        # If this a new key or an alteration of the current config
-        if((itemKey in conf) == False or conf[itemKey] != itemValue):
-            # Update the item
-            conf[itemKey] = itemValue
+        # If these are new keys or an alteration of the current config
+        changedItems = { key: value for key, value in items.items() if (key in conf) == False or conf[key] != value }
+        if(len(changedItems) > 0):
+            # Update the items
+            conf.update(changedItems)
             # Write the full config file to disk
             with open(agentConfigFile, 'w') as outfile:
                 json.dump(conf, outfile, indent=4)
@@ -77,22 +95,30 @@ def reportDeviceConfigurationToServer():
     return
 
 
-def updateOPCProfile():
+# Bring ./data/config.json (read by the OPC client) in line with the OPC Profile twin of this device
+# The file is only rewritten, atomically, when the profile changed, and onChange(opcProfile, opcVars)
+# is then called so consumers can reload at once rather than polling the file
+# If knownVariables (a set of PLC variable names) is given, variables to monitor missing from it are reported
+opcProfileConfigFile = "./data/config.json"
+def updateOPCProfile(onChange = None, knownVariables = None):
     def log_and_return(msg, content=None):
         log(msg)
         if content:
             log(content)
         return msg
 
+    # Returns True if the file changed
     def update_config_file(filepath, key, value):
         config = {}
         if os.path.exists(filepath):
             with open(filepath, "r") as f:
                 config = json.load(f)
+        if key in config and getContentHash(config[key]) == getContentHash(value):
+            return False
         config[key] = value
-        with open(filepath, "w") as f:
-            json.dump(config, f, indent=4)
-            f.write("\n")
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        writeJsonFileAtomically(filepath, config)
+        return True
 
     # Step 1: Get the device
     r = httpGet(conf['server'] + '/api/v1/devices/' + conf['UUID'])
@@ -126,13 +152,55 @@ def updateOPCProfile():
     if not opc_vars:
         return log_and_return("'opcVarsToMonitor' key missing from the twin's custom attributes: " + str(opcProfile), r.content)
 
-    # Step 3: Update config.json
-    config_file = "./data/config.json"
-    update_config_file(config_file, "opcVarsToMonitor", opc_vars)
-
+    # Validate the variables against the PLC variable catalogue, no browsing needed
+    unknown_vars = []
+    if knownVariables:
+        unknown_vars = [v.get('name') for v in opc_vars if v.get('name') not in knownVariables]
+        if unknown_vars:
+            logWarning(f"OPC Profile {opcProfile} has variables not found on the PLC: {unknown_vars}")
+
+    # Step 3: Update config.json, unless it already holds this profile
+    if not update_config_file(opcProfileConfigFile, "opcVarsToMonitor", opc_vars):
+        return log_and_return(f"OPC Profile {opcProfile} unchanged, config file already up to date")
+    if onChange is not None:
+        onChange(opcProfile, opc_vars)
+
+    if unknown_vars:
+        return f"Config file updated with the following OPC vars to monitor: {opc_vars}. Not found on the PLC: {unknown_vars}"
     return f"Config file successfully updated with the following OPC vars to monitor: {opc_vars}"
 
 
+# Update some of the custom attributes of a digital twin, keeping the others
+def updateTwinCustomAttributes(twinUuid, attributes):
+    r = httpGet(conf['server'] + '/api/v1/twins/' + str(twinUuid))
+    if r.status_code != 200:
+        log("Issue while getting twin from server: " + str(r.status_code))
+        return r
+    customAttributes = json.loads(r.content).get('customAttributes') or {}
+    customAttributes.update(attributes)
+    return httpPut(conf['server'] + '/api/v1/twins/' + str(twinUuid), { "customAttributes": customAttributes })
+
+
+# Send the PLC variable catalogue to the OPCVariables twin of this device (labels: { "OPCVariables": <UUID> })
+# diff ({ added, removed }) goes along so consumers can see what changed. Returns True once uploaded
+def uploadPLCCatalogueToTwin(variables, diff):
+    r = httpGet(conf['server'] + '/api/v1/devices/' + conf['UUID'])
+    if r.status_code != 200 or json.loads(r.content).get('totalRecords') != 1:
+        log("Issue while getting device from server: " + str(r.status_code))
+        return False
+    twinUuid = (json.loads(r.content)['records'][0].get('labels') or {}).get('OPCVariables')
+    if not twinUuid:
+        log("'OPCVariables' label missing from the device's labels, not uploading the PLC variable catalogue")
+        return False
+    r = updateTwinCustomAttributes(twinUuid, { "plcVariables": variables, "plcVariablesChanged": diff })
+    if r.status_code != 200:
+        log("Issue while uploading the PLC variable catalogue to twin " + str(twinUuid) + ": " + str(r.status_code))
+        return False
+    logInfo('Uploaded PLC variable catalogue to twin ' + str(twinUuid) + ': ' + str(len(diff['added'])) + ' added, ' \
+        + str(len(diff['removed'])) + ' removed')
+    return True
+
+
 # Send a log message to the server
 def logToServer(severity, message):
     # Do not send log to server if severity not in the required set
@@ -146,7 +214,8 @@ def logToServer(severity, message):
             "message": message
         }
     }
-    sendLogToServer(dataToSend)
+    r = sendLogToServer(dataToSend)
+    davraMetrics.increment('davra_log_shipped_total', severity=severity, outcome='ok' if r.status_code == 200 else 'failed')
     return
 
 # Send various severities of log messages with easy function names
@@ -160,7 +229,8 @@ def logWarning(log_msg):
     log(log_msg, "WARN")
 
 def logError(log_msg):
-    log(log_msg.decode('utf8'), "ERROR")
+    # Response bodies arrive as bytes, most other messages as str
+    log(log_msg.decode('utf8') if isinstance(log_msg, bytes) else log_msg, "ERROR")
 
 # Log a message to disk and console
 def log(log_msg, severity = "DEBUG"):
@@ -169,11 +239,11 @@ def log(log_msg, severity = "DEBUG"):
     try:
         file_size = os.path.getsize(logDir + "/davra_agent.log")
     except:
-        os.system("touch " + logDir + "/davra_agent.log")
+        file_size = 0
     try:
         print(log_time + ": " + log_msg) # Echo to stdout as well as the file
         if file_size > 10000000:
-            os.system("mv " + logDir + "/davra_agent.log " + logDir + "/davra_agent.log.old")
+            os.replace(logDir + "/davra_agent.log", logDir + "/davra_agent.log.old")
         logfile = open(logDir + "/davra_agent.log", "a")
         logfile.write(log_time + ": " + log_msg + "\n")
         logfile.close()
@@ -200,17 +270,34 @@ def createMetricOnServer(metricName, metricUnits, metricDescription):
     #    + '"label": "' + metricName + '", '\
     #    + '"description": "' + metricDescription + '", '\
     #    + '"semantics": "metric" }]'
-    contents = [ { "name": metricName, "label": metricName, "description": metricDescription, "semantics": "metric" } ]
+    createMetricsOnServer([(metricName, metricUnits, metricDescription)])
+    return
+
+
+# Define several metrics on the server with a single request
+# Supply a list of tuples (metricName, metricUnits, metricDescription)
+# Metrics already defined on this server (see definedMetricsFile) are not sent again unless forced
+def createMetricsOnServer(metrics, force = False):
+    contents = []
+    for (metricName, metricUnits, metricDescription) in metrics:
+        if(force is False and isMetricDefined(metricName)):
+            continue
+        contents.append({ "name": metricName, "label": metricName, "description": metricDescription, "semantics": "metric" })
+    if(len(contents) == 0):
+        return(notModifiedRequestsObject())
     r = httpPost(conf['server'] + '/api/v1/iotdata/meta-data', contents)
+    metricNames = [metric["name"] for metric in contents]
     if(r.status_code == 200):
-        log("Metric created on server: " + metricName)
+        log("Metrics created on server: " + ', '.join(metricNames))
+        rememberDefinedMetrics(metricNames)
     else:
-        log("Failed to create metric on server: " + metricName + ' : ' + str(r.status_code))
-    return
+        log("Failed to create metrics on server: " + ', '.join(metricNames) + ' : ' + str(r.status_code))
+    return(r)
 
 
 # When sending iot data, this is a shorter function to use then regular put
 def sendDataToServer(dataToSend):
+    noteMetricNames(dataToSend)
     responseFromServer = httpPut(conf['server'] + '/api/v1/iotdata', dataToSend)
     return(responseFromServer)
 
@@ -219,26 +306,106 @@ def sendLogToServer(dataToSend):
     return(responseFromServer)
 
 
+# About maxLength characters of some data as json, for log messages about large payloads
+# Built from the start of the data only: long strings are sliced and long lists or objects cut off with
+# their length, so a large message (eg an app's sendIotData batch) is never copied whole
+def getLogExcerpt(data, maxLength = 500):
+    parts = []
+    appendLogExcerpt(data, parts, maxLength)
+    return ''.join(parts)
+
+
+# Add the excerpt of data to parts, using at most about remaining characters. Returns what is left of remaining
+def appendLogExcerpt(data, parts, remaining):
+    if(type(data) in (dict, list, tuple)):
+        isDict = type(data) == dict
+        parts.append('{' if isDict else '[')
+        remaining -= 1
+        for index, item in enumerate(data.items() if isDict else data):
+            if(remaining <= 0):
+                parts.append('... (' + str(len(data)) + (' keys)' if isDict else ' items)'))
+                return remaining
+            separator = ', ' if index > 0 else ''
+            if(isDict):
+                separator += json.dumps(str(item[0])) + ': '
+                item = item[1]
+            parts.append(separator)
+            remaining = appendLogExcerpt(item, parts, remaining - len(separator))
+        parts.append('}' if isDict else ']')
+        return remaining - 1
+    if(type(data) == str):
+        if(len(data) <= remaining):
+            text = json.dumps(data)
+        elif(remaining <= 0):
+            text = '...'
+        else:
+            text = json.dumps(data[:max(remaining, 0)]) + '... (' + str(len(data)) + ' characters)'
+    elif(data is None or type(data) in (bool, int, float)):
+        text = json.dumps(data)
+    elif(type(data) in (bytes, bytearray)):
+        text = repr(bytes(data[:max(remaining, 0)])) + ('... (' + str(len(data)) + ' bytes)' if len(data) > remaining else '')
+    else:
+        text = str(data)[:max(remaining, 0)]
+    parts.append(text)
+    return remaining - len(text)
+
+
 # For when a http request fails, use this to return a similar object
 class emptyRequestsObject(object):
     status_code = 500
     content = ""
 
+# For when a http request was not needed because the server already has the data
+class notModifiedRequestsObject(object):
+    status_code = 200
+    content = ""
+
+
+# All requests to the server go through one session, so its connections (and TLS handshakes)
+# are reused. httpPoolSize is how many connections may be open at once, eg one per task worker.
+httpSession = None
+httpSessionLock = threading.Lock()
+def getHttpSession():
+    global httpSession
+    with httpSessionLock:
+        if(httpSession is None):
+            poolSize = int(conf.get('httpPoolSize', 8))
+            httpSession = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+            httpSession.mount('https://', adapter)
+            httpSession.mount('http://', adapter)
+        return httpSession
+
+# The API path of a request with ids replaced, so requests to the same API share one latency series
+# eg https://server/api/v1/devices/3f2a...e1/attributes -> /api/v1/devices/:id/attributes
+idPathSegmentPattern = re.compile(r'^([0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|[0-9]+)$')
+@functools.lru_cache(maxsize=256)
+def getEndpointLabel(destination):
+    path = destination.split('://', 1)[-1].partition('/')[2].split('?')[0]
+    return '/' + '/'.join(':id' if idPathSegmentPattern.match(segment) else segment for segment in path.split('/'))
+
+def recordHttpRequest(method, destination, startTime, status):
+    davraMetrics.observe('davra_http_request_seconds', time.perf_counter() - startTime, \
+        method=method, endpoint=getEndpointLabel(destination), status=str(status))
+
 # Make a http request of type PUT
 # Supply the destination API endpoint as string and the dataToSend as JSON object
 def httpPut(destination, dataToSend):
     headers = getHeadersForRequests()
     cert = getCertForRequests()
     try:
-        r = requests.put(destination, data=json.dumps(dataToSend), headers=headers, cert=cert, timeout=20)
+        startTime = time.perf_counter()
+        r = getHttpSession().put(destination, data=json.dumps(dataToSend), headers=headers, cert=cert, timeout=20)
+        recordHttpRequest('PUT', destination, startTime, r.status_code)
         if (r.status_code == 200):
             return(r)
         else:
             log("Issue while sending data to server. " + str(r))
             return(r)
     except Exception as e:
+        recordHttpRequest('PUT', destination, startTime, 'error')
         log('Failed to make http PUT:' + str(destination) + " : " \
-        + json.dumps(dataToSend) + " \n Error: " + str(e))
+        + getLogExcerpt(dataToSend) + " \n Error: " + str(e))
         return(emptyRequestsObject())
 
 
@@ -249,15 +416,18 @@ def httpPost(destination, dataToSend):
     headers = getHeadersForRequests()
     cert = getCertForRequests()
     try:
-        r = requests.post(destination, data=json.dumps(dataToSend), headers=headers, cert=cert, timeout=20)
+        startTime = time.perf_counter()
+        r = getHttpSession().post(destination, data=json.dumps(dataToSend), headers=headers, cert=cert, timeout=20)
+        recordHttpRequest('POST', destination, startTime, r.status_code)
         if (r.status_code == 200):
             return(r)
         else:
             log("Issue while sending data to server. " + str(r))
             return(r)
     except Exception as e:
+        recordHttpRequest('POST', destination, startTime, 'error')
         log('Failed to make http PUT:' + str(destination) + " : " \
-        + json.dumps(dataToSend) + " \n Error: " + str(e))
+        + getLogExcerpt(dataToSend) + " \n Error: " + str(e))
         return(emptyRequestsObject())
 
 
@@ -267,15 +437,18 @@ def httpPatch(destination, dataToSend):
     headers = getHeadersForRequests()
     cert = getCertForRequests()
     try:
-        r = requests.patch(destination, data=json.dumps(dataToSend), headers=headers, cert=cert, timeout=20)
+        startTime = time.perf_counter()
+        r = getHttpSession().patch(destination, data=json.dumps(dataToSend), headers=headers, cert=cert, timeout=20)
+        recordHttpRequest('PATCH', destination, startTime, r.status_code)
         if (r.status_code == 200):
             return(r)
         else:
             log("Issue while sending data to server. " + str(r))
             return(r)
     except Exception as e:
+        recordHttpRequest('PATCH', destination, startTime, 'error')
         log('Failed to make http PATCH:' + str(destination) + " : " \
-        + json.dumps(dataToSend) + " \n Error: " + str(e))
+        + getLogExcerpt(dataToSend) + " \n Error: " + str(e))
         return(emptyRequestsObject())
     
 
@@ -285,24 +458,32 @@ def httpGet(destination):
     headers = getHeadersForRequests()
     cert = getCertForRequests()
     try:
-        r = requests.get(destination, headers=headers, cert=cert, timeout=20)
+        startTime = time.perf_counter()
+        r = getHttpSession().get(destination, headers=headers, cert=cert, timeout=20)
+        recordHttpRequest('GET', destination, startTime, r.status_code)
         if (r.status_code == 200):
             return(r)
         else:
             log("Issue while making http GET. " + str(r))
             return(r)
     except Exception as e:
+        recordHttpRequest('GET', destination, startTime, 'error')
         log('Failed to make http GET:' + str(destination) + " : \n Error: " + str(e))
         return(emptyRequestsObject())
 
 
 # Send the device capabilities from config file up to server at /api/v1/devices
-def reportDeviceCapabilities():
+# Skipped if the server already acknowledged exactly these capabilities, unless forced
+def reportDeviceCapabilities(force = False):
+    if(force is False and isServerStateCurrent('capabilities', 'all', conf["capabilities"])):
+        log('Device capabilities unchanged since last acknowledged by server, not reporting')
+        return(200)
     dataToSend = { "capabilities": conf["capabilities"] }
     log('Reporting device capabilities to server ' + str(dataToSend))
     r = httpPut(conf['server'] + '/api/v1/devices/' + conf["UUID"], dataToSend)
     if (r.status_code == 200):
         log('Reported device capabilities to server ' + str(r.content))
+        rememberServerState('capabilities', 'all', dataToSend["capabilities"])
         return(r.status_code)
     else:
         log("Issue while reporting capabilities to server. " + str(r.status_code))
@@ -313,13 +494,25 @@ def reportDeviceCapabilities():
 # Update (or insert) a configuration item with a capability for this device
 def registerDeviceCapability(itemKey, itemValue):
     logInfo('registerDeviceCapability ' + str(itemKey) + ': ' + str(itemValue));
-    listCapabilities = conf["capabilities"] if "capabilities" in conf else {}
-    # If the capability was already known (and in the config.info)
-    if((itemKey in listCapabilities) == False or listCapabilities[itemKey] != itemValue):
-        log('registerDeviceCapability : this is a new capability')
-        listCapabilities[itemKey] = itemValue
-        upsertConfigurationItem("capabilities", listCapabilities)
-        reportDeviceCapabilities()
+    registerDeviceCapabilities({ itemKey: itemValue })
+    return;
+
+
+# Update (or insert) several capabilities for this device at once, as { capabilityName: capabilityDetails }
+# Only new or changed capabilities cause a write, so a batch costs at most one config write
+# and one report of the capabilities to the server
+def registerDeviceCapabilities(capabilities):
+    listCapabilities = dict(conf["capabilities"]) if "capabilities" in conf else {}
+    changedCapabilities = [key for key in capabilities \
+        if (key in listCapabilities) == False or listCapabilities[key] != capabilities[key]]
+    # If all the capabilities were already known (and in the config.info)
+    if(len(changedCapabilities) == 0):
+        return;
+    log('registerDeviceCapabilities : new or changed capabilities ' + str(changedCapabilities))
+    for key in changedCapabilities:
+        listCapabilities[key] = capabilities[key]
+    upsertConfigurationItem("capabilities", listCapabilities)
+    reportDeviceCapabilities()
     return;
 
 
@@ -337,15 +530,180 @@ def unregisterDeviceCapability(itemKey):
 
 def getLanIpAddress():
     # Returns the current LAN IP address.
-    arg = "ip route list"
-    p = subprocess.Popen(arg,shell=True,text=True,stdout=subprocess.PIPE)
-    data = p.communicate()
-    logInfo(data)
-    split_data = data[0].split()
-    ipaddr = split_data[split_data.index("src")+1]
-    return ipaddr
+    return davra_sysinfo.getLanIpAddress()
+
+
+
+
+###########################   SERVER STATE CACHE
+
+# The agent remembers what the server last acknowledged for the labels, attributes and capabilities
+# it sets, as content hashes in serverStateCacheFile. Updates matching the cache are skipped.
+# verifyServerState occasionally compares the cache with the device record to correct drift.
+serverStateCache = None
+serverStateLock = threading.RLock()
+# Values set during this run, so anything found to have drifted can be sent again. Kept whether or not
+# they needed sending, as after a restart the cache usually already has them
+serverStateValues = { 'labels': {}, 'attributes': {} }
+
+
+# Stable hash of any json-like value
+def getContentHash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+def getServerStateCache():
+    global serverStateCache
+    with serverStateLock:
+        if(serverStateCache is None):
+            # The cache only holds for the server and device it was written for
+            scope = getContentHash([conf.get('server'), conf.get('UUID')])
+            serverStateCache = { 'scope': scope, 'labels': {}, 'attributes': {}, 'capabilities': {} }
+            try:
+                if(os.path.isfile(serverStateCacheFile)):
+                    with open(serverStateCacheFile) as data_file:
+                        cachedState = json.load(data_file)
+                    if(cachedState.get('scope') == scope):
+                        serverStateCache.update(cachedState)
+            except Exception as e:
+                log('Ignoring unreadable server state cache: ' + str(e))
+        return serverStateCache
 
 
+def isServerStateCurrent(kind, key, value):
+    with serverStateLock:
+        return getServerStateCache()[kind].get(key) == getContentHash(value)
+
+
+def noteServerStateValue(kind, key, value):
+    with serverStateLock:
+        serverStateValues[kind][key] = value
+
+
+def rememberServerState(kind, key, value):
+    with serverStateLock:
+        cache = getServerStateCache()
+        if(kind in serverStateValues):
+            serverStateValues[kind][key] = value
+        if(cache[kind].get(key) != getContentHash(value)):
+            cache[kind][key] = getContentHash(value)
+            try:
+                writeJsonFileAtomically(serverStateCacheFile, cache)
+            except Exception as e:
+                log('Could not save server state cache: ' + str(e))
+
+
+def forgetServerState(kind, key):
+    with serverStateLock:
+        cache = getServerStateCache()
+        if(key in cache[kind]):
+            cache[kind].pop(key)
+            try:
+                writeJsonFileAtomically(serverStateCacheFile, cache)
+            except Exception as e:
+                log('Could not save server state cache: ' + str(e))
+
+
+# Compare the cached server state with the device record (a single GET) and re-send anything which drifted
+def verifyServerState():
+    r = httpGet(conf['server'] + '/api/v1/devices/' + conf['UUID'])
+    if (r.status_code != 200 or json.loads(r.content).get('totalRecords') != 1):
+        log("Issue while verifying device state on server: " + str(r.status_code))
+        return
+    device = json.loads(r.content)['records'][0]
+    serverValues = {
+        'labels': device.get('labels') or {},
+        'attributes': device.get('customAttributes') or {},
+        'capabilities': { 'all': device.get('capabilities') or {} }
+    }
+    driftedKeys = []
+    for kind in ['labels', 'attributes', 'capabilities']:
+        for key in list(getServerStateCache()[kind].keys()):
+            if(key not in serverValues[kind] or isServerStateCurrent(kind, key, serverValues[kind][key]) is False):
+                driftedKeys.append(kind + '.' + key)
+                forgetServerState(kind, key)
+    if(len(driftedKeys) == 0):
+        log('Device state on server matches the local cache')
+        return
+    logInfo('Device state on server drifted from local cache: ' + str(driftedKeys))
+    reportDeviceCapabilities()
+    for labelKey, labelValue in list(serverStateValues['labels'].items()):
+        updateDeviceLabelOnServer(labelKey, labelValue)
+    updateDeviceAttributesOnServer(dict(serverStateValues['attributes']))
+
+
+
+###########################   METRIC DEFINITIONS
+
+# Every metric name needs a definition on the server. Names already defined are kept in
+# definedMetricsFile, so each is created once. Datum names seen by sendDataToServer which are
+# not defined yet are queued and defined together by flushPendingMetricDefinitions.
+definedMetrics = None
+pendingMetricDefinitions = {}
+definedMetricsLock = threading.RLock()
+
+
+def getDefinedMetrics():
+    global definedMetrics
+    with definedMetricsLock:
+        if(definedMetrics is None):
+            # The registry only holds for the server it was written for
+            scope = getContentHash(conf.get('server'))
+            definedMetrics = { 'scope': scope, 'metrics': [] }
+            try:
+                if(os.path.isfile(definedMetricsFile)):
+                    with open(definedMetricsFile) as data_file:
+                        registry = json.load(data_file)
+                    if(registry.get('scope') == scope):
+                        definedMetrics['metrics'] = registry.get('metrics', [])
+            except Exception as e:
+                log('Ignoring unreadable metric registry: ' + str(e))
+            definedMetrics['names'] = set(definedMetrics['metrics'])
+        return definedMetrics
+
+
+def isMetricDefined(metricName):
+    return metricName in getDefinedMetrics()['names']
+
+
+def rememberDefinedMetrics(metricNames):
+    with definedMetricsLock:
+        registry = getDefinedMetrics()
+        newNames = [name for name in metricNames if name not in registry['names']]
+        for name in metricNames:
+            pendingMetricDefinitions.pop(name, None)
+        if(len(newNames) == 0):
+            return
+        registry['names'].update(newNames)
+        registry['metrics'] = sorted(registry['names'])
+        try:
+            writeJsonFileAtomically(definedMetricsFile, { 'scope': registry['scope'], 'metrics': registry['metrics'] })
+        except Exception as e:
+            log('Could not save metric registry: ' + str(e))
+
+
+# Queue the names of any datums (a dict or a list of dicts) which are not defined on the server yet
+# At most maxPendingMetricDefinitions are queued; names past that are queued when next seen after a flush
+def noteMetricNames(dataToSend):
+    maxPending = int(conf.get('maxPendingMetricDefinitions', 1000))
+    for datum in (dataToSend if type(dataToSend) == list else [dataToSend]):
+        try:
+            if(datum.get("msg_type") != "datum" or isMetricDefined(datum["name"])):
+                continue
+            with definedMetricsLock:
+                if(len(pendingMetricDefinitions) < maxPending):
+                    pendingMetricDefinitions.setdefault(datum["name"], (datum["name"], '', datum["name"]))
+        except Exception:
+            pass
+
+
+# Define every queued metric name on the server in one request
+def flushPendingMetricDefinitions():
+    with definedMetricsLock:
+        metrics = list(pendingMetricDefinitions.values())
+    if(len(metrics) > 0):
+        createMetricsOnServer(metrics)
+
 
 
 ###########################   MQTT
@@ -405,66 +763,47 @@ def runCommandWithTimeout(command, timeout):
 
 
 # Returns operating system detail
+# These system readings come from /proc via davra_sysinfo rather than spawning processes
 def getOperatingSystem():
-    retVal = runNativeCommandLine("grep PRETTY_NAME /etc/os-release")
-    if(retVal != None and len(retVal) > 1 and '=' in retVal):
-        return retVal.split('=')[1]
-    else:
-        return runNativeCommandLine("uname -a")
-
+    return davra_sysinfo.getOperatingSystem()
 
 
 def getRam():
     #Returns a tuple (total ram, available ram) in megabytes.
-    try:
-        s = subprocess.run(["free", "-m"], capture_output=True, text=True).stdout
-        lines = s.split("\n")
-        return ( int(lines[1].split()[1]), int(lines[2].split()[3]) )
-    except:
-        return (0, 0)
+    return davra_sysinfo.getRam()
 
 def getProcessCount():
     #Returns the number of processes.
-    try:
-        s = subprocess.run(["ps","-e"], capture_output=True, text=True).stdout
-        return len(s.split("\n"))
-    except:
-        return 0
+    return davra_sysinfo.getProcessCount()
 
 def getUptime():
     #Returns a tuple (uptime, 1 min load average).
-    try:
-        s = subprocess.run(["uptime"], capture_output=True, text=True).stdout
-        load_split = s.split("load average: ")
-        load_one = float(load_split[1].split(",")[0])
-        up = load_split[0]
-        up_pos = up.rfind(",", 0, len(up)-4)
-        up = up[:up_pos].split("up ")[1]
-        return (up, load_one)
-    except:
-        return ("", 0)
+    return (davra_sysinfo.getUptimeText(), davra_sysinfo.getLoadAverage()[0])
 
 def getUptimeProcess():
     # Returns uptime in seconds
-    try:
-        s = subprocess.run(["cat", "/proc/uptime"], capture_output=True, text=True).stdout
-        return int(float(s.split(" ")[0]))
-    except:
-        return 0
+    return davra_sysinfo.getUptimeSeconds()
 
 
 ###########################   Utilities
 
 
+# Set one label on the device. Skipped if the server already acknowledged this value.
+# Only the labels are sent back, not the whole device record.
 def updateDeviceLabelOnServer(labelKey, labelValue):
+    noteServerStateValue('labels', labelKey, labelValue)
+    if(isServerStateCurrent('labels', labelKey, labelValue)):
+        return notModifiedRequestsObject()
     r = httpGet(conf['server'] + '/api/v1/devices/' + conf['UUID'])
     if (r.status_code == 200 and json.loads(r.content)['totalRecords'] == 1):
-        dataToSend = json.loads(r.content)['records'][0]
-        if (dataToSend['labels'] is None):
-            dataToSend['labels'] = {}
-        dataToSend['labels'][labelKey] = labelValue
-        r = httpPut(conf['server'] + '/api/v1/devices/' + conf['UUID'], dataToSend)
+        labels = json.loads(r.content)['records'][0].get('labels') or {}
+        if (labels.get(labelKey) == labelValue):
+            rememberServerState('labels', labelKey, labelValue)
+            return r
+        labels[labelKey] = labelValue
+        r = httpPut(conf['server'] + '/api/v1/devices/' + conf['UUID'], { "labels": labels })
         if (r.status_code == 200):
+            rememberServerState('labels', labelKey, labelValue)
             return r
         else:
             log("Issue while updating device label on server: " + str(r.status_code))
@@ -478,15 +817,41 @@ def updateDeviceLabelOnServer(labelKey, labelValue):
 
 
 def updateDeviceAttributeOnServer(attributeKey, attributeValue):
+    return updateDeviceAttributesOnServer({ attributeKey: attributeValue })
+
+
+# Set several custom attributes on the device in one PATCH, sending only those
+# which differ from what the server last acknowledged
+def updateDeviceAttributesOnServer(attributes):
     dataToSend = {}
-    dataToSend[attributeKey] = attributeValue
-    r = httpPatch(conf['server'] + '/api/v1/devices/' + conf['UUID'] + '/attributes', dataToSend)
+    for attributeKey, attributeValue in attributes.items():
+        noteServerStateValue('attributes', attributeKey, attributeValue)
+        if(isServerStateCurrent('attributes', attributeKey, attributeValue) is False):
+            dataToSend[attributeKey] = attributeValue
+    if(len(dataToSend) == 0):
+        return notModifiedRequestsObject()
+    r = patchDeviceAttributesOnServer(conf['UUID'], dataToSend)
     if (r.status_code == 200):
-        return r
-    else:
+        for attributeKey, attributeValue in dataToSend.items():
+            rememberServerState('attributes', attributeKey, attributeValue)
+    return r
+
+
+# Set custom attributes on any device (eg a PLC behind this gateway) in one PATCH
+def patchDeviceAttributesOnServer(deviceUuid, attributes):
+    r = httpPatch(conf['server'] + '/api/v1/devices/' + deviceUuid + '/attributes', attributes)
+    if (r.status_code != 200):
         log("Issue while updating device attribute on server: " + str(r.status_code))
-        log(r.content)    
-        return r
+        log(r.content)
+    return r
+
+
+# A fraction in [0, 1) which is fixed for this device, derived from its UUID.
+# Used to spread periodic calls from a fleet of devices evenly across an interval.
+# The salt gives each periodic task of the device its own position.
+def getDevicePhaseFraction(salt = ''):
+    digest = hashlib.sha256((conf.get('UUID', '') + salt).encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'big') / float(2 ** 64)
 
 
 def getMilliSecondsSinceEpoch():
@@ -510,20 +875,31 @@ def getAbsoluteFileLocation(inputFilename):
 # Remove a directory if it already exists and make it again, ready for writing to
 def provideFreshDirectory(dirToClean):
     if(len(dirToClean) > 3):
-        os.system("sudo rm -rf " + dirToClean)
-        os.system("mkdir -p " + dirToClean)
-        os.system("sudo chmod 777 " + dirToClean)
+        shutil.rmtree(dirToClean, ignore_errors=True)
+        ensureDirectoryExists(dirToClean)
     return
 
 
 # Ensure a directory exists for writing to
 def ensureDirectoryExists(dir):
     if(len(dir) > 3):
-        os.system("mkdir -p " + dir)
-        os.system("sudo chmod 777 " + dir)
+        try:
+            os.makedirs(dir, exist_ok=True)
+            os.chmod(dir, 0o777)
+        except Exception as e:
+            log('Failed to prepare directory ' + dir + ': ' + str(e))
     return
 
 
+# Write a json file so readers never see it half written (write a temporary file then rename it)
+def writeJsonFileAtomically(jsonFile, content):
+    tmpFile = jsonFile + '.tmp'
+    with open(tmpFile, 'w') as outfile:
+        json.dump(content, outfile, indent=4)
+        outfile.write("\n")
+    os.replace(tmpFile, jsonFile)
+
+
 # Edit a json file to upsert a parameter
 def upsertJsonEntry(jsonFileToEdit, jsonKey, jsonValue):
     fileContent = None
@@ -0,0 +1,236 @@
+# Low-overhead instrumentation for the Davra Agent
+# Latency histograms (fixed buckets), counters and gauges kept in memory. Recording one observation
+# is a bisect and a few additions under a lock, cheap enough to leave on everywhere.
+# They are served on a localhost-only HTTP endpoint as Prometheus text (/metrics) or JSON (/stats),
+# and getCompactSummary() gives a small version for the davra.agent.stats event.
+#
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds of the histogram buckets, in seconds. Observations above the last go in the +Inf bucket
+bucketBounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+metricHelp = {
+    'davra_http_request_seconds': 'HTTP requests to the Davra server by method, endpoint and status',
+    'davra_http_retries_total': 'Batches kept to be sent again after a failed request, by source',
+    'davra_uplink_rejected_total': 'Items dropped by the uplink because the server rejected them, by status',
+    'davra_rsc_call_seconds': 'RSC calls to the PLC by call and outcome',
+    'davra_mqtt_message_seconds': 'Handling of each MQTT message from the Device Apps, by kind',
+    'davra_mqtt_device_backlog_bytes': 'Bytes received from the device broker but not yet handled',
+    'davra_task_seconds': 'Scheduled task runs, eg the heartbeat tick, by task',
+    'davra_trace_stage_seconds': 'Sampled messages from the Device Apps: broker, processing, upload and total time',
+    'davra_stall_seconds': 'How long the scheduler loop, a task or an MQTT callback stayed stalled, by activity',
+    'davra_rules_datums_total': 'Datums from the Device Apps by what the telemetry rules did with them',
+    'davra_log_shipped_total': 'Log messages sent to the server, by severity and outcome'
+}
+
+
+class Histogram(object):
+    __slots__ = ('bucketCounts', 'count', 'sum')
+
+    def __init__(self):
+        self.bucketCounts = [0] * (len(bucketBounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.bucketCounts[bisect.bisect_left(bucketBounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # Estimate a quantile by interpolating within the bucket it falls in
+    def getQuantile(self, quantile):
+        if(self.count == 0):
+            return None
+        rank = quantile * self.count
+        cumulative = 0
+        for index, bucketCount in enumerate(self.bucketCounts):
+            if(bucketCount > 0 and cumulative + bucketCount >= rank):
+                lower = bucketBounds[index - 1] if index > 0 else 0.0
+                if(index >= len(bucketBounds)):
+                    return lower
+                return lower + (bucketBounds[index] - lower) * (rank - cumulative) / bucketCount
+            cumulative += bucketCount
+        return bucketBounds[-1]
+
+
+# Series are keyed by (name, ((labelName, labelValue), ...)) with the labels sorted
+# Each kind holds at most maxSeries series, so an unexpected label value cannot grow memory without bound.
+# Observations for new series past that are dropped and counted in droppedSeriesObservations
+maxSeries = 1000
+droppedSeriesObservations = 0
+histograms = {}
+counters = {}
+# { name: function returning a number, or { labelsTuple: number } }, read when stats are collected
+gaugeFunctions = {}
+metricsLock = threading.Lock()
+
+
+def getSeriesKey(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def observe(name, seconds, **labels):
+    global droppedSeriesObservations
+    key = getSeriesKey(name, labels)
+    with metricsLock:
+        histogram = histograms.get(key)
+        if(histogram is None):
+            if(len(histograms) >= maxSeries):
+                droppedSeriesObservations += 1
+                return
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def increment(name, amount = 1, **labels):
+    global droppedSeriesObservations
+    key = getSeriesKey(name, labels)
+    with metricsLock:
+        if(key not in counters and len(counters) >= maxSeries):
+            droppedSeriesObservations += 1
+            return
+        counters[key] = counters.get(key, 0) + amount
+
+
+def registerGauge(name, gaugeFunction):
+    gaugeFunctions[name] = gaugeFunction
+
+
+def readGauges():
+    gauges = {}
+    for name, gaugeFunction in list(gaugeFunctions.items()):
+        try:
+            value = gaugeFunction()
+        except Exception:
+            continue
+        if(value is None):
+            continue
+        if(type(value) == dict):
+            for labels, labelledValue in value.items():
+                gauges[(name, labels)] = labelledValue
+        else:
+            gauges[(name, ())] = value
+    return gauges
+
+
+def formatLabels(labels, extraLabel = None):
+    pairs = list(labels) + ([extraLabel] if extraLabel is not None else [])
+    if(len(pairs) == 0):
+        return ''
+    return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, value in pairs) + '}'
+
+
+def getPrometheusText():
+    with metricsLock:
+        histogramCopies = { key: (list(h.bucketCounts), h.count, h.sum) for key, h in histograms.items() }
+        counterCopies = dict(counters)
+    lines = []
+    describedNames = set()
+    def describe(name, metricType):
+        if(name not in describedNames):
+            describedNames.add(name)
+            if(name in metricHelp):
+                lines.append('# HELP ' + name + ' ' + metricHelp[name])
+            lines.append('# TYPE ' + name + ' ' + metricType)
+    for (name, labels), (bucketCounts, count, total) in sorted(histogramCopies.items()):
+        describe(name, 'histogram')
+        cumulative = 0
+        for index, bucketCount in enumerate(bucketCounts):
+            cumulative += bucketCount
+            upperBound = repr(bucketBounds[index]) if index < len(bucketBounds) else '+Inf'
+            lines.append(name + '_bucket' + formatLabels(labels, ('le', upperBound)) + ' ' + str(cumulative))
+        lines.append(name + '_sum' + formatLabels(labels) + ' ' + repr(total))
+        lines.append(name + '_count' + formatLabels(labels) + ' ' + str(count))
+    for (name, labels), value in sorted(counterCopies.items()):
+        describe(name, 'counter')
+        lines.append(name + formatLabels(labels) + ' ' + str(value))
+    for (name, labels), value in sorted(readGauges().items()):
+        describe(name, 'gauge')
+        lines.append(name + formatLabels(labels) + ' ' + str(value))
+    return '\n'.join(lines) + '\n'
+
+
+def getSeriesName(name, labels):
+    return name + formatLabels(labels)
+
+
+def roundSeconds(seconds):
+    return round(seconds, 6) if seconds is not None else None
+
+
+# Every series with its count, sum and estimated quantiles (in seconds)
+def getSnapshot():
+    with metricsLock:
+        snapshot = {
+            'histograms': { getSeriesName(name, labels): {
+                'count': h.count,
+                'sum': round(h.sum, 6),
+                'p50': roundSeconds(h.getQuantile(0.5)),
+                'p90': roundSeconds(h.getQuantile(0.9)),
+                'p99': roundSeconds(h.getQuantile(0.99)),
+                'buckets': list(h.bucketCounts)
+            } for (name, labels), h in sorted(histograms.items()) },
+            'counters': { getSeriesName(name, labels): value for (name, labels), value in sorted(counters.items()) }
+        }
+    snapshot['gauges'] = { getSeriesName(name, labels): value for (name, labels), value in sorted(readGauges().items()) }
+    snapshot['bucketBounds'] = list(bucketBounds)
+    snapshot['droppedSeriesObservations'] = droppedSeriesObservations
+    return snapshot
+
+
+# A small summary for sending to the server: per histogram series [count, p50 ms, p99 ms], counters and gauges
+def getCompactSummary():
+    with metricsLock:
+        summary = {
+            'latencyMs': { getSeriesName(name, labels): [h.count, round((h.getQuantile(0.5) or 0) * 1000, 1), \
+                round((h.getQuantile(0.99) or 0) * 1000, 1)] for (name, labels), h in sorted(histograms.items()) },
+            'counters': { getSeriesName(name, labels): value for (name, labels), value in sorted(counters.items()) }
+        }
+    summary['gauges'] = { getSeriesName(name, labels): value for (name, labels), value in sorted(readGauges().items()) }
+    return summary
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if(path == '/metrics'):
+            (contentType, content) = ('text/plain; version=0.0.4', getPrometheusText())
+        elif(path == '/stats'):
+            stats = getSnapshot()
+            if(self.server.extraStatsFunction is not None):
+                try:
+                    stats.update(self.server.extraStatsFunction())
+                except Exception as e:
+                    stats['extraStatsError'] = str(e)
+            (contentType, content) = ('application/json', json.dumps(stats, indent=4, default=str))
+        else:
+            self.send_error(404)
+            return
+        content = content.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+# Serve /metrics and /stats on 127.0.0.1 only. extraStatsFunction returns a dict merged into /stats.
+# Returns the server, or None if the port could not be opened
+def startStatsServer(port, extraStatsFunction = None, logFunction = print):
+    try:
+        statsServer = ThreadingHTTPServer(('127.0.0.1', port), StatsRequestHandler)
+    except OSError as e:
+        logFunction('Cannot open the stats endpoint on 127.0.0.1:' + str(port) + ': ' + str(e))
+        return None
+    statsServer.daemon_threads = True
+    statsServer.extraStatsFunction = extraStatsFunction
+    threading.Thread(target=statsServer.serve_forever, name='davra-stats', daemon=True).start()
+    logFunction('Stats available on http://127.0.0.1:' + str(port) + '/metrics and /stats')
+    return statsServer
@@ -0,0 +1,241 @@
+# PLCnext controller sessions for the Davra Agent
+# A PlcSession owns the RSC Device connection to one controller. When a call fails the
+# connection is dropped and re-established on a later call, with exponential backoff
+# so an unreachable controller costs one connect attempt per backoff period and no more.
+# A periodic checkHealth notices a dead connection, and reconnects, without waiting for the next read.
+# Every change between up and down is passed to onStateChange so PLC-down periods can be recorded.
+# Also the RSC reads the agent makes of every controller, batched into one call each.
+#
+import random
+import threading
+import time
+import davra_metrics as davraMetrics
+from PyPlcnextRsc import Device, ExtraConfigure
+from PyPlcnextRsc.Arp.Device.Interface.Services import IDeviceInfoService, IDeviceStatusService
+
+
+# Status items read from the controller and the metric each is sent as
+plcStatusMetrics = {
+    "Status.Cpu.0.Load.Percent": "plcnext.cpu_load",
+    "Status.Memory.Usage.Percent": "plcnext.memory_usage",
+    "Status.ProgramMemoryIEC.Usage.Percent": "plcnext.program_memory_usage",
+    "Status.DataMemoryIEC.Usage.Percent": "plcnext.data_memory_usage",
+    "Status.Board.Temperature.Centigrade": "plcnext.board_temperature",
+    "Status.Board.Humidity": "plcnext.board_humidity"
+}
+
+# Info items read from the controller and the device attribute each is reported as
+plcInfoAttributes = {
+    "General.ArticleName": "articleName",
+    "General.ArticleNumber": "articleNumber",
+    "General.SerialNumber": "serialNumber",
+    "General.Firmware.Version": "firmwareVersion",
+    "General.Hardware.Version": "hardwareVersion",
+    "Interfaces.Ethernet.1.0.Mac": "macAddress"
+}
+
+
+# service.GetItems(identifiers), timed as callName
+def getItems(service, callName, identifiers):
+    startTime = time.perf_counter()
+    outcome = 'error'
+    try:
+        results = service.GetItems(identifiers)
+        outcome = 'ok'
+        return results
+    finally:
+        davraMetrics.observe('davra_rsc_call_seconds', time.perf_counter() - startTime, call=callName, outcome=outcome)
+
+
+# Read every status item in one call and return them as datums for the device deviceUuid
+def readPLCStatusDatums(device, deviceUuid):
+    statusItems = list(plcStatusMetrics.keys())
+    dataToSend = []
+    results = getItems(IDeviceStatusService(device), 'IDeviceStatusService.GetItems', statusItems)
+    # Stamped when read, as they may wait in the uplink (for as long as the server is unreachable) before going up
+    timestamp = int(time.time() * 1000)
+    for identifier, result in zip(statusItems, results):
+        dataToSend.append({
+            "UUID": deviceUuid,
+            "name": plcStatusMetrics[identifier],
+            "value": result.GetValue(),
+            "msg_type": "datum",
+            "timestamp": timestamp
+        })
+    return dataToSend
+
+
+# A cheap read used to check a session is alive
+def probePLC(device):
+    return getItems(IDeviceStatusService(device), 'IDeviceStatusService.GetItems', ["Status.Cpu.0.Load.Percent"])
+
+
+# Read every info item in one call and return them as { attributeName: value }
+def readPLCSystemInfo(device):
+    infoItems = list(plcInfoAttributes.keys())
+    return { plcInfoAttributes[identifier]: result.GetValue() \
+        for identifier, result in zip(infoItems, getItems(IDeviceInfoService(device), 'IDeviceInfoService.GetItems', infoItems)) }
+
+
+class PlcSession(object):
+    # credentialsSupplier returns (user, password). timeout is the RSC socket timeout in seconds.
+    # onStateChange(session, isUp, downtimeSeconds) is called when the PLC goes down or comes back up
+    def __init__(self, name, host, deviceUuid, credentialsSupplier, port = 41100, timeout = 10, \
+        maxBackoff = 30, logFunction = print, onStateChange = None):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.deviceUuid = deviceUuid
+        self.credentialsSupplier = credentialsSupplier
+        self.timeout = timeout
+        self.maxBackoff = maxBackoff
+        self.log = logFunction
+        self.device = None
+        self.lock = threading.RLock()
+        # Failed connects in a row, and when (monotonic) the next connect may be tried
+        self.failureCount = 0
+        self.nextConnectTime = 0.0
+        # Incremented on every successful connect, so callers can tell a new session from an old one
+        self.connectCount = 0
+        self.lastError = None
+        self.onStateChange = onStateChange
+        # None until the first connect attempt, then True or False
+        self.isUp = None
+        # When (epoch seconds) the current down period started
+        self.downSince = None
+
+    def isConnected(self):
+        return self.device is not None
+
+    # Returns the connected Device, connecting first if needed and the backoff allows it, else None
+    def ensureConnected(self):
+        with self.lock:
+            if(self.device is not None):
+                return self.device
+            if(time.monotonic() < self.nextConnectTime):
+                return None
+            configure = ExtraConfigure()
+            configure.timeout = self.timeout
+            device = Device(self.host, port=self.port, config=configure, secureInfoSupplier=self.credentialsSupplier)
+            try:
+                device.connect()
+            except Exception as e:
+                device.dispose()
+                self.scheduleReconnect(e)
+                stateChange = self.setUp(False)
+                device = None
+            else:
+                self.device = device
+                self.failureCount = 0
+                self.connectCount += 1
+                self.log('PLC ' + self.name + ' connected at ' + self.host)
+                stateChange = self.setUp(True)
+        self.notifyStateChange(stateChange)
+        return device
+
+    # Record whether the PLC is up. Returns (isUp, downtimeSeconds) if that changed, else None
+    def setUp(self, isUp):
+        if(self.isUp == isUp):
+            return None
+        wasDown = self.isUp is False
+        self.isUp = isUp
+        if(isUp is False):
+            self.downSince = time.time()
+            return (False, None)
+        downtimeSeconds = time.time() - self.downSince if wasDown else None
+        self.downSince = None
+        self.lastError = None
+        return (True, downtimeSeconds) if wasDown else None
+
+    def notifyStateChange(self, stateChange):
+        if(stateChange is None):
+            return
+        (isUp, downtimeSeconds) = stateChange
+        if(isUp):
+            self.log('PLC ' + self.name + ' back up after ' + str(round(downtimeSeconds, 1)) + 's')
+        if(self.onStateChange is not None):
+            try:
+                self.onStateChange(self, isUp, downtimeSeconds)
+            except Exception as e:
+                self.log('PLC ' + self.name + ' state change handler failed: ' + str(e))
+
+    # An event recording the PLC going down, or coming back up after downtimeSeconds
+    def getStateEvent(self, isUp, downtimeSeconds = None):
+        value = { "plc": self.name, "host": self.host }
+        if(isUp):
+            value["downtimeSeconds"] = round(downtimeSeconds, 1)
+        else:
+            value["error"] = self.lastError
+        return {
+            "UUID": self.deviceUuid,
+            "name": "davra.plc.up" if isUp else "davra.plc.down",
+            "value": value,
+            "msg_type": "event"
+        }
+
+    # Wait 2, 4, 8 ... seconds (up to maxBackoff) before the next connect, spread by up to half
+    # so controllers which went down together do not all reconnect in the same second
+    def scheduleReconnect(self, error):
+        self.failureCount += 1
+        self.lastError = str(error)
+        backoff = min(self.maxBackoff, 2 ** self.failureCount)
+        backoff = backoff * random.uniform(0.5, 1.0)
+        self.nextConnectTime = time.monotonic() + backoff
+        self.log('PLC ' + self.name + ' at ' + self.host + ' unavailable (' + self.lastError + '), retrying in ' \
+            + str(round(backoff, 1)) + 's')
+
+    # Drop the connection after a failed call. The next call reconnects, subject to the backoff
+    def markFailed(self, error):
+        with self.lock:
+            if(self.device is not None):
+                try:
+                    self.device.dispose()
+                except Exception:
+                    pass
+                self.device = None
+                # The first reconnect is tried at once, the PLC may only have dropped this connection
+                self.failureCount = 0
+                self.nextConnectTime = 0.0
+                self.lastError = str(error)
+                self.log('PLC ' + self.name + ' connection lost: ' + self.lastError)
+            else:
+                self.scheduleReconnect(error)
+            stateChange = self.setUp(False)
+        self.notifyStateChange(stateChange)
+
+    # Run functionToRun(device) over the session. Returns its result, or None if not connected.
+    # A failure drops the connection and is raised to the caller.
+    def call(self, functionToRun):
+        device = self.ensureConnected()
+        if(device is None):
+            return None
+        try:
+            return functionToRun(device)
+        except Exception as e:
+            self.markFailed(e)
+            raise
+
+    # Check the session with a cheap read, reconnecting (subject to the backoff) if it is down.
+    # Returns True if the PLC answered
+    def checkHealth(self):
+        try:
+            return self.call(probePLC) is not None
+        except Exception:
+            return False
+
+    def dispose(self):
+        with self.lock:
+            if(self.device is not None):
+                self.device.dispose()
+                self.device = None
+
+    def getStats(self):
+        return {
+            "host": self.host,
+            "UUID": self.deviceUuid,
+            "connected": self.isConnected(),
+            "downSince": self.downSince,
+            "connectCount": self.connectCount,
+            "failureCount": self.failureCount,
+            "lastError": self.lastError
+        }
@@ -0,0 +1,148 @@
+# On-demand diagnostics for the Davra Agent, run inside the agent while it keeps working
+# A sampling CPU profile of every thread (sys._current_frames at a fixed interval, so the overhead is
+# bounded and the threads being profiled are not slowed down as with cProfile), a tracemalloc snapshot
+# of where the memory still held was allocated, counts of live objects by type, and a stack dump of each thread.
+# The snapshot only sees allocations made while tracing: since startMemoryTracing() if that was called
+# at startup, otherwise since the profile started. The object counts cover everything alive.
+# getCompressedReport() gives the report as base64 of gzipped json, small enough for a function response.
+#
+import base64
+import gc
+import gzip
+import json
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+
+# The profile is time-boxed so a job cannot leave the agent profiling
+maxProfileSeconds = 60
+defaultSampleInterval = 0.01
+
+
+def getFrameKey(frame):
+    code = frame.f_code
+    return code.co_filename + ':' + code.co_name + ':' + str(frame.f_lineno)
+
+
+# Sample the stacks of all threads but this one every sampleInterval seconds for the given seconds
+# Returns the top functions by own samples (where the thread was) and by cumulative samples (on the stack)
+def sampleCpuProfile(seconds, sampleInterval = defaultSampleInterval, topCount = 30):
+    seconds = max(0.1, min(float(seconds), maxProfileSeconds))
+    ownThread = threading.get_ident()
+    threadNames = { thread.ident: thread.name for thread in threading.enumerate() }
+    ownSamples = {}
+    cumulativeSamples = {}
+    threadSamples = {}
+    # Collapsed stacks (root;...;leaf) with their counts, as used to draw a flame graph
+    stackSamples = {}
+    sampleCount = 0
+    endTime = time.monotonic() + seconds
+    while time.monotonic() < endTime:
+        for threadId, frame in sys._current_frames().items():
+            if(threadId == ownThread):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(getFrameKey(frame))
+                frame = frame.f_back
+            if(len(stack) == 0):
+                continue
+            threadName = threadNames.get(threadId, str(threadId))
+            threadSamples[threadName] = threadSamples.get(threadName, 0) + 1
+            ownSamples[stack[0]] = ownSamples.get(stack[0], 0) + 1
+            for key in set(stack):
+                cumulativeSamples[key] = cumulativeSamples.get(key, 0) + 1
+            collapsed = threadName + ';' + ';'.join(reversed(stack))
+            stackSamples[collapsed] = stackSamples.get(collapsed, 0) + 1
+        sampleCount += 1
+        time.sleep(sampleInterval)
+    def getTop(samples):
+        return [[key, count] for key, count in sorted(samples.items(), key=lambda item: -item[1])[:topCount]]
+    return {
+        'seconds': seconds,
+        'sampleInterval': sampleInterval,
+        'samples': sampleCount,
+        'threadSamples': threadSamples,
+        'topOwn': getTop(ownSamples),
+        'topCumulative': getTop(cumulativeSamples),
+        'stacks': stackSamples
+    }
+
+
+# The allocations still held, grouped by line, largest first
+def getMemorySnapshot(topCount = 30):
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    statistics = snapshot.statistics('lineno')
+    (current, peak) = tracemalloc.get_traced_memory()
+    return {
+        'tracedBytes': current,
+        'peakTracedBytes': peak,
+        'top': [{ 'location': str(stat.traceback[0]), 'bytes': stat.size, 'count': stat.count } \
+            for stat in statistics[:topCount]]
+    }
+
+
+# The live objects the garbage collector tracks (containers and instances, not eg strings or numbers),
+# counted by type with their shallow sizes, most numerous first
+def getObjectCounts(topCount = 30):
+    counts = {}
+    for item in gc.get_objects():
+        typeName = type(item).__module__ + '.' + type(item).__qualname__
+        typeCount = counts.get(typeName)
+        if(typeCount is None):
+            typeCount = counts[typeName] = [0, 0]
+        typeCount[0] += 1
+        try:
+            typeCount[1] += sys.getsizeof(item)
+        except TypeError:
+            pass
+    top = sorted(counts.items(), key=lambda item: -item[1][0])[:topCount]
+    return {
+        'objects': sum(count for count, size in counts.values()),
+        'top': [{ 'type': typeName, 'count': count, 'shallowBytes': size } for typeName, (count, size) in top]
+    }
+
+
+# Trace memory allocations from now on, eg from agent startup, so a later profile sees everything still held
+def startMemoryTracing(frames = 1):
+    if(not tracemalloc.is_tracing()):
+        tracemalloc.start(frames)
+
+
+def getThreadStacks():
+    threadNames = { thread.ident: thread.name for thread in threading.enumerate() }
+    return { threadNames.get(threadId, str(threadId)) + ' (' + str(threadId) + ')': traceback.format_stack(frame) \
+        for threadId, frame in sys._current_frames().items() }
+
+
+# Profile the CPU for the given seconds while tracing memory allocations, then dump the thread stacks
+# tracemalloc is only left running if it already was before
+def runProfile(seconds = 10, topCount = 30, sampleInterval = defaultSampleInterval):
+    startedTracing = False
+    if(not tracemalloc.is_tracing()):
+        tracemalloc.start()
+        startedTracing = True
+    try:
+        report = { 'startTime': int(time.time() * 1000) }
+        report['cpu'] = sampleCpuProfile(seconds, sampleInterval, topCount)
+        report['memory'] = getMemorySnapshot(topCount)
+        report['memory']['tracedSinceProfileStart'] = startedTracing
+        report['objects'] = getObjectCounts(topCount)
+        report['threads'] = getThreadStacks()
+    finally:
+        if(startedTracing):
+            tracemalloc.stop()
+    return report
+
+
+def getCompressedReport(report):
+    return base64.b64encode(gzip.compress(json.dumps(report).encode('utf8'))).decode('ascii')
+
+
+# Read a report given by getCompressedReport, eg when looking at a function response
+def readCompressedReport(compressedReport):
+    return json.loads(gzip.decompress(base64.b64decode(compressedReport)).decode('utf8'))
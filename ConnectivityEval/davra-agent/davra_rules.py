@@ -0,0 +1,226 @@
+# Edge rules for telemetry forwarded by the Davra Agent, to cut upload volume without changing the apps
+# Rules are a list in the config ("telemetryRules"), each matching metric names by a glob pattern:
+#   { "match": "opc.*.status", "drop": true }
+#   { "match": "bench.*", "rename": "site1.{name}", "tags": { "line": "2" } }
+#   { "match": "plc.temperature*", "deadband": 0.5, "maxSilenceSeconds": 300 }
+#   { "match": "vibration.*", "downsample": { "count": 1, "seconds": 10 } }
+#   { "match": "power.*", "aggregate": { "seconds": 60, "functions": ["avg", "min", "max", "count"] } }
+# The first rule whose pattern matches a name applies; names no rule matches pass unchanged.
+# A rule may rename and retag, then report only changes beyond its deadband, then keep at most count datums
+# per window of seconds, and finally replace the datums by one per function per window (<name>.avg etc).
+# The patterns are compiled once into one regular expression and the rule for each name is cached,
+# so a datum costs a dict lookup and the rule's own work.
+#
+import fnmatch
+import math
+import re
+import threading
+import time
+import davra_metrics as davraMetrics
+
+
+aggregateFunctions = ('avg', 'min', 'max', 'count', 'sum')
+
+
+class Rule(object):
+    __slots__ = ('pattern', 'drop', 'rename', 'tags', 'deadband', 'maxSilence', \
+        'downsampleCount', 'downsampleSeconds', 'aggregateSeconds', 'aggregateFunctions')
+
+    def __init__(self, config):
+        self.pattern = str(config['match'])
+        self.drop = bool(config.get('drop', False))
+        self.rename = config.get('rename')
+        self.tags = config.get('tags')
+        if(self.tags is not None and type(self.tags) != dict):
+            raise ValueError('tags must be an object')
+        self.deadband = float(config['deadband']) if config.get('deadband') is not None else None
+        self.maxSilence = float(config.get('maxSilenceSeconds', 0))
+        downsample = config.get('downsample')
+        self.downsampleCount = int(downsample.get('count', 1)) if downsample else None
+        self.downsampleSeconds = float(downsample['seconds']) if downsample else None
+        aggregate = config.get('aggregate')
+        self.aggregateSeconds = float(aggregate['seconds']) if aggregate else None
+        self.aggregateFunctions = tuple(aggregate.get('functions', ['avg'])) if aggregate else ()
+        for function in self.aggregateFunctions:
+            if(function not in aggregateFunctions):
+                raise ValueError('unknown aggregate function ' + str(function))
+        # Windows are whole milliseconds
+        for seconds in (self.downsampleSeconds, self.aggregateSeconds):
+            if(seconds is not None and not (math.isfinite(seconds) and seconds >= 0.001)):
+                raise ValueError('window seconds must be a number of at least 0.001')
+
+
+class RulesEngine(object):
+    # rules is the list from the config. Rules which cannot be read are logged and left out
+    # At most maxSeries series (device UUID and name) keep state for deadband, downsample and aggregate rules
+    def __init__(self, rules, logFunction = print, maxSeries = 10000):
+        self.log = logFunction
+        self.maxSeries = maxSeries
+        self.rules = []
+        for index, config in enumerate(rules or []):
+            try:
+                self.rules.append(Rule(config))
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                self.log('Ignoring telemetry rule ' + str(index) + ' ' + str(config) + ': ' + str(e))
+        # One alternation of all the patterns: the first alternative which matches is the first rule in order
+        self.matcher = re.compile('|'.join('(?P<r' + str(position) + '>' + fnmatch.translate(rule.pattern) + ')' \
+            for position, rule in enumerate(self.rules))) if self.rules else None
+        # { name: Rule or None }
+        self.ruleCache = {}
+        self.lock = threading.Lock()
+        # { (uuid, name): [lastReportedValue, lastReportedTime] } for deadband rules
+        self.deadbandState = {}
+        # { (uuid, name): [windowStart, count] } for downsample rules
+        self.downsampleState = {}
+        # { (uuid, name): [windowStart, count, sum, min, max, rule, uuid, outputName] } for aggregate rules
+        self.aggregateState = {}
+        self.counts = {}
+
+    def hasRules(self):
+        return len(self.rules) > 0
+
+    def getRule(self, name):
+        try:
+            return self.ruleCache[name]
+        except KeyError:
+            pass
+        match = self.matcher.match(name) if self.matcher is not None else None
+        rule = self.rules[int(match.lastgroup[1:])] if match is not None else None
+        # Names are bounded in practice, but an app inventing names must not grow the cache for ever
+        if(len(self.ruleCache) >= self.maxSeries):
+            self.ruleCache.clear()
+        self.ruleCache[name] = rule
+        return rule
+
+    # The datum's timestamp as epoch milliseconds. Apps may send anything, so one which is not a number is
+    # taken as now, for the rules (the datum itself goes on with the timestamp it had)
+    def getTimestamp(self, datum, now):
+        try:
+            return int(float(datum.get('timestamp') or now))
+        except (TypeError, ValueError, OverflowError):
+            return now
+
+    def hasRoomFor(self, state, key):
+        return key in state or len(state) < self.maxSeries
+
+    # Apply the rules to datums about to be sent ({ UUID, name, value, msg_type, timestamp }, timestamp in
+    # epoch milliseconds). Returns what should be sent, including aggregates of windows which just closed.
+    def apply(self, dataToSend, now = None):
+        if(self.matcher is None):
+            return dataToSend
+        now = int(time.time() * 1000) if now is None else now
+        output = []
+        outcomes = {}
+        with self.lock:
+            for datum in dataToSend:
+                rule = self.getRule(str(datum.get('name')))
+                if(rule is None):
+                    output.append(datum)
+                    outcome = 'passed'
+                else:
+                    outcome = self.applyRule(rule, datum, now, output)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            for outcome, count in outcomes.items():
+                self.counts[outcome] = self.counts.get(outcome, 0) + count
+        for outcome, count in outcomes.items():
+            davraMetrics.increment('davra_rules_datums_total', count, outcome=outcome)
+        return output
+
+    # Add what is left of the datum after the rule to output. Returns what happened to it
+    def applyRule(self, rule, datum, now, output):
+        if(rule.drop):
+            return 'dropped'
+        key = (datum.get('UUID'), datum.get('name'))
+        if(rule.rename is not None or rule.tags is not None):
+            datum = dict(datum)
+            if(rule.rename is not None):
+                datum['name'] = rule.rename.replace('{name}', str(key[1]))
+            if(rule.tags is not None):
+                datum['tags'] = dict(datum.get('tags') or {}, **rule.tags)
+        value = datum.get('value')
+        isNumber = type(value) in (int, float) and math.isfinite(value)
+        timestamp = self.getTimestamp(datum, now)
+        if(rule.deadband is not None and not self.passesDeadband(rule, key, value, isNumber, timestamp)):
+            return 'deadband'
+        if(rule.downsampleSeconds is not None and not self.passesDownsample(rule, key, timestamp)):
+            return 'downsampled'
+        if(rule.aggregateSeconds is not None and isNumber and self.hasRoomFor(self.aggregateState, key)):
+            self.addToAggregate(rule, key, datum, float(value), timestamp, output)
+            return 'aggregated'
+        output.append(datum)
+        return 'passed'
+
+    # Report a number only once it moves more than the deadband from the value last reported,
+    # anything else only when it changes. With maxSilenceSeconds, report at least that often
+    def passesDeadband(self, rule, key, value, isNumber, timestamp):
+        state = self.deadbandState.get(key)
+        if(state is not None):
+            (lastValue, lastTime) = state
+            silenceOver = rule.maxSilence > 0 and timestamp - lastTime >= rule.maxSilence * 1000
+            if(isNumber and type(lastValue) in (int, float)):
+                changed = abs(value - lastValue) > rule.deadband
+            else:
+                changed = value != lastValue
+            if(not changed and not silenceOver):
+                return False
+        elif(not self.hasRoomFor(self.deadbandState, key)):
+            return True
+        self.deadbandState[key] = [value, timestamp]
+        return True
+
+    def passesDownsample(self, rule, key, timestamp):
+        windowStart = timestamp - timestamp % int(rule.downsampleSeconds * 1000)
+        state = self.downsampleState.get(key)
+        if(state is None or state[0] != windowStart):
+            if(state is None and not self.hasRoomFor(self.downsampleState, key)):
+                return True
+            state = self.downsampleState[key] = [windowStart, 0]
+        state[1] += 1
+        return state[1] <= rule.downsampleCount
+
+    def addToAggregate(self, rule, key, datum, value, timestamp, output):
+        windowStart = timestamp - timestamp % int(rule.aggregateSeconds * 1000)
+        state = self.aggregateState.get(key)
+        if(state is not None and state[0] != windowStart):
+            # A datum from another window closes the one being aggregated
+            output.extend(self.getAggregateData(state))
+            state = None
+        if(state is None):
+            state = self.aggregateState[key] = [windowStart, 0, 0.0, value, value, rule, datum.get('UUID'), datum.get('name')]
+        state[1] += 1
+        state[2] += value
+        state[3] = min(state[3], value)
+        state[4] = max(state[4], value)
+
+    def getAggregateData(self, state):
+        (windowStart, count, total, minimum, maximum, rule, uuid, name) = state
+        values = { 'avg': total / count, 'min': minimum, 'max': maximum, 'count': count, 'sum': total }
+        aggregateData = []
+        for function in rule.aggregateFunctions:
+            datum = { 'UUID': uuid, 'name': name + '.' + function, 'value': values[function], 'msg_type': 'datum', \
+                'timestamp': windowStart }
+            if(rule.tags is not None):
+                datum['tags'] = dict(rule.tags)
+            aggregateData.append(datum)
+        return aggregateData
+
+    # The aggregates of every window which has ended by now (epoch milliseconds). Call periodically,
+    # or with flushAll to close every window (eg before the rules are replaced)
+    def flushAggregates(self, now = None, flushAll = False):
+        now = int(time.time() * 1000) if now is None else now
+        output = []
+        with self.lock:
+            for key, state in list(self.aggregateState.items()):
+                if(flushAll or state[0] + state[5].aggregateSeconds * 1000 <= now):
+                    output.extend(self.getAggregateData(state))
+                    del self.aggregateState[key]
+        return output
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'rules': len(self.rules),
+                'datums': dict(self.counts),
+                'series': { 'deadband': len(self.deadbandState), 'downsample': len(self.downsampleState), \
+                    'aggregate': len(self.aggregateState) }
+            }
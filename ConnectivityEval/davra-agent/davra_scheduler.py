@@ -0,0 +1,267 @@
+# Deadline based task scheduler for the Davra Agent
+# Each periodic duty of the agent (heartbeat, PLC sampling, job checks etc) is a task with its own interval.
+# Deadlines are kept on a fixed grid (previous deadline + interval) so time spent running tasks
+# does not make the schedule drift, and a timer heap means the loop sleeps until the next task is due.
+# With maxWorkers > 0, due tasks run concurrently on a bounded thread pool so one slow call
+# (eg a 20s HTTP timeout) does not hold up the others.
+#
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import davra_metrics as davraMetrics
+import davra_watchdog as davraWatchdog
+
+
+class ScheduledTask(object):
+    def __init__(self, name, interval, functionToRun, jitter):
+        self.name = name
+        self.interval = float(interval)
+        self.functionToRun = functionToRun
+        self.jitter = float(jitter)
+        # The nominal deadline on the task's grid. Jitter is added on top but never accumulates.
+        self.nextDeadline = 0.0
+        # Seconds past each multiple of interval (wall clock) at which the task runs, or None to run from when added
+        self.phase = None
+        # Heap entries from before a re-schedule carry an older generation and are ignored
+        self.generation = 0
+        self.runCount = 0
+        # Deadlines the task has been scheduled past, counted when it is rescheduled (before it runs, for the pool)
+        self.deadlineCount = 0
+        self.overrunCount = 0
+        self.failureCount = 0
+        self.slowCount = 0
+        self.lastDuration = 0.0
+        self.maxDuration = 0.0
+        self.lastLateness = 0.0
+        self.maxLateness = 0.0
+
+    def getStats(self):
+        return {
+            "interval": self.interval,
+            "runCount": self.runCount,
+            "overrunCount": self.overrunCount,
+            "failureCount": self.failureCount,
+            "slowCount": self.slowCount,
+            "lastDuration": round(self.lastDuration, 3),
+            "maxDuration": round(self.maxDuration, 3),
+            "maxLateness": round(self.maxLateness, 3)
+        }
+
+
+class Scheduler(object):
+    # taskDeadline is how many seconds a task may run on the pool before it is reported as slow
+    def __init__(self, logFunction = print, maxWorkers = 0, taskDeadline = 30):
+        self.log = logFunction
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='davra-task') if maxWorkers > 0 else None
+        self.taskDeadline = taskDeadline
+        # Tasks currently running on the pool as { name: [startTime, reportedSlow] }
+        self.inFlight = {}
+        self.tasks = {}
+        self.timerHeap = []
+        self.sequence = itertools.count()
+        self.lock = threading.RLock()
+        self.wakeUp = threading.Event()
+        self.running = False
+
+    # Add a task which runs functionToRun every interval seconds (fractions allowed).
+    # The first run is firstRunDelay seconds from now. Each run starts up to jitter seconds after its deadline.
+    # With a phase, runs after the first are aligned to the wall clock so that (epoch seconds - phase)
+    # is a multiple of interval. Devices with different phases stay spread out whenever they started.
+    def addTask(self, name, interval, functionToRun, jitter = 0, firstRunDelay = 0, phase = None):
+        with self.lock:
+            task = ScheduledTask(name, interval, functionToRun, jitter)
+            task.phase = phase
+            task.nextDeadline = time.monotonic() + firstRunDelay
+            self.tasks[name] = task
+            self.pushTask(task)
+        self.wakeUp.set()
+        return task
+
+    def removeTask(self, name):
+        with self.lock:
+            task = self.tasks.pop(name, None)
+            if(task is not None):
+                task.generation += 1
+
+    def hasTask(self, name):
+        return name in self.tasks
+
+    # Change the interval (and optionally jitter and phase) of a task while the scheduler is running.
+    # The next deadline moves to one new interval after the previous run so the change takes effect at once.
+    def setInterval(self, name, interval, jitter = None, phase = None):
+        with self.lock:
+            task = self.tasks.get(name)
+            if(task is None):
+                return
+            interval = float(interval)
+            if(interval == task.interval and (jitter is None or float(jitter) == task.jitter) \
+            and (phase is None or phase == task.phase)):
+                return
+            self.log('Scheduler: task ' + name + ' interval ' + str(task.interval) + 's -> ' + str(interval) + 's')
+            previousDeadline = task.nextDeadline - task.interval
+            task.interval = interval
+            if(jitter is not None):
+                task.jitter = float(jitter)
+            if(phase is not None):
+                task.phase = phase
+            task.nextDeadline = max(previousDeadline + interval, time.monotonic())
+            if(task.phase is not None and task.deadlineCount > 0):
+                task.nextDeadline = self.getAlignedDeadline(task, previousDeadline + task.interval / 2)
+            task.generation += 1
+            self.pushTask(task)
+        self.wakeUp.set()
+
+    # The first deadline at or after notBefore (monotonic) which falls on the task's wall clock phase
+    def getAlignedDeadline(self, task, notBefore):
+        monotonicNow = time.monotonic()
+        wallNotBefore = time.time() + (notBefore - monotonicNow)
+        wallDeadline = task.phase + math.ceil((wallNotBefore - task.phase) / task.interval) * task.interval
+        return notBefore + (wallDeadline - wallNotBefore)
+
+    def pushTask(self, task):
+        dueTime = task.nextDeadline + (random.uniform(0, task.jitter) if task.jitter > 0 else 0)
+        heapq.heappush(self.timerHeap, (dueTime, next(self.sequence), task.name, task.generation))
+
+    # Seconds until the next task is due (0 if one is due now), or None if there are no tasks
+    def getTimeUntilNextTask(self):
+        with self.lock:
+            self.discardStaleEntries()
+            if(not self.timerHeap):
+                return None
+            return max(0.0, self.timerHeap[0][0] - time.monotonic())
+
+    def discardStaleEntries(self):
+        while self.timerHeap:
+            (dueTime, sequence, name, generation) = self.timerHeap[0]
+            task = self.tasks.get(name)
+            if(task is not None and task.generation == generation):
+                return
+            heapq.heappop(self.timerHeap)
+
+    # Pop every task which is due now, in deadline order
+    def popDueTasks(self):
+        dueTasks = []
+        now = time.monotonic()
+        with self.lock:
+            self.discardStaleEntries()
+            while self.timerHeap and self.timerHeap[0][0] <= now:
+                (dueTime, sequence, name, generation) = heapq.heappop(self.timerHeap)
+                task = self.tasks.get(name)
+                if(task is not None and task.generation == generation):
+                    dueTasks.append(task)
+                self.discardStaleEntries()
+        return dueTasks
+
+    # Move a task's deadline on by whole intervals, staying on its grid.
+    # If the deadline after this run has already passed, the task overran and missed runs are skipped.
+    def rescheduleTask(self, task):
+        with self.lock:
+            if(self.tasks.get(task.name) is not task):
+                return
+            now = time.monotonic()
+            task.deadlineCount += 1
+            if(task.phase is not None and task.deadlineCount == 1):
+                # After the startup run, join the task's phase on the wall clock grid
+                # at least half an interval later so the first two runs are not back to back
+                task.nextDeadline = self.getAlignedDeadline(task, task.nextDeadline + task.interval / 2)
+            else:
+                task.nextDeadline += task.interval
+            if(task.nextDeadline <= now):
+                missedRuns = int(math.floor((now - task.nextDeadline) / task.interval)) + 1
+                task.overrunCount += 1
+                task.nextDeadline += missedRuns * task.interval
+                self.log('Scheduler: task ' + task.name + ' overran its ' + str(task.interval) + 's interval (started ' \
+                    + str(round(task.lastLateness, 3)) + 's late, took ' + str(round(task.lastDuration, 3)) + 's), skipping ' \
+                    + str(missedRuns) + ' run(s)')
+            task.generation += 1
+            self.pushTask(task)
+
+    # dueDeadline is the deadline this run is for, if the task was already rescheduled past it
+    def runTask(self, task, dueDeadline = None):
+        startTime = time.monotonic()
+        task.lastLateness = startTime - (task.nextDeadline if dueDeadline is None else dueDeadline)
+        task.maxLateness = max(task.maxLateness, task.lastLateness)
+        try:
+            with davraWatchdog.watch('task.' + task.name):
+                task.functionToRun()
+        except Exception as e:
+            task.failureCount += 1
+            self.log('Scheduler: task ' + task.name + ' failed: ' + str(e))
+        finally:
+            task.lastDuration = time.monotonic() - startTime
+            task.maxDuration = max(task.maxDuration, task.lastDuration)
+            task.runCount += 1
+            davraMetrics.observe('davra_task_seconds', task.lastDuration, task=task.name)
+
+    # Run every task which is due now
+    def runPending(self):
+        for task in self.popDueTasks():
+            if(self.executor is None):
+                self.runTask(task)
+                self.rescheduleTask(task)
+            else:
+                self.dispatchTask(task)
+        self.reportSlowTasks()
+
+    # Hand a task to the pool. Its next deadline is set at once; a task still running from
+    # its previous deadline is not started twice, that run is skipped and counted as an overrun.
+    def dispatchTask(self, task):
+        with self.lock:
+            if(task.name in self.inFlight):
+                task.overrunCount += 1
+                self.log('Scheduler: task ' + task.name + ' is still running from its previous deadline, skipping this run')
+                self.rescheduleTask(task)
+                return
+            self.inFlight[task.name] = [time.monotonic(), False]
+            dueDeadline = task.nextDeadline
+            self.rescheduleTask(task)
+        future = self.executor.submit(self.runTask, task, dueDeadline)
+        future.add_done_callback(lambda f, task = task: self.finishTask(task))
+
+    def finishTask(self, task):
+        with self.lock:
+            (startTime, reportedSlow) = self.inFlight.pop(task.name, [0, False])
+        if(reportedSlow):
+            self.log('Scheduler: slow task ' + task.name + ' finished after ' + str(round(task.lastDuration, 3)) + 's')
+
+    # Report (once per run) any task which has been running longer than taskDeadline
+    def reportSlowTasks(self):
+        now = time.monotonic()
+        with self.lock:
+            for name, runState in self.inFlight.items():
+                if(runState[1] is False and now - runState[0] > self.taskDeadline):
+                    runState[1] = True
+                    if(name in self.tasks):
+                        self.tasks[name].slowCount += 1
+                    self.log('Scheduler: task ' + name + ' still running after ' + str(round(now - runState[0], 1)) \
+                        + 's, other tasks continue')
+
+    # Run tasks as they fall due until stop() is called
+    def runForever(self):
+        self.running = True
+        while self.running:
+            # The loop itself is watched for stalls while it has work in hand, not while it waits
+            with davraWatchdog.watch('scheduler'):
+                self.runPending()
+            timeUntilNextTask = self.getTimeUntilNextTask()
+            if(timeUntilNextTask is None):
+                timeUntilNextTask = 60
+            # Wake at least every second while tasks are running so slow ones are reported promptly
+            if(self.inFlight):
+                timeUntilNextTask = min(timeUntilNextTask, 1.0)
+            self.wakeUp.wait(timeUntilNextTask)
+            self.wakeUp.clear()
+
+    def stop(self):
+        self.running = False
+        self.wakeUp.set()
+        if(self.executor is not None):
+            self.executor.shutdown(wait=False)
+
+    def getStats(self):
+        with self.lock:
+            return { name: task.getStats() for name, task in self.tasks.items() }
@@ -4,6 +4,8 @@
 #
 import os
 import time
+import random
+import uuid
 import requests
 import json 
 from pprint import pprint
@@ -18,8 +20,11 @@ import paho.mqtt.client as mqtt
 
 # Where is the MQTT broker running on the agent
 mqttBrokerAgentHost = '127.0.0.1' 
+mqttBrokerAgentPort = 1883
 # Is the certificate required for Mqtt. If so, config file must be available
 useAdvancedMqttAuthorisation = False 
+# Fraction (0 to 1) of messages to the agent stamped for latency tracing. None follows traceSampleRate in the agent config
+traceSampleRate = None
 
 # END CONFIG
 
@@ -125,7 +130,7 @@ def connectToAgent(nameOfApplication):
         mqttClientOfDevice.on_connect = mqttOnConnectDevice
         mqttClientOfDevice.on_message = mqttOnMessageDevice
         log('Starting to connect to MQTT broker running on device ' + mqttBrokerAgentHost)
-        mqttClientOfDevice.connect(mqttBrokerAgentHost)
+        mqttClientOfDevice.connect(mqttBrokerAgentHost, mqttBrokerAgentPort)
         mqttClientOfDevice.loop_start() # Starts another thread to monitor incoming messages
         time.sleep(2)
         sendMessageFromAppToAgent({"connectToAgent": deviceApplicationName})
@@ -159,9 +164,22 @@ def sendMessageFromAppToAgent(msg):
     global mqttClientOfDevice
     msg['fromApp'] = deviceApplicationName 
     log('sendMessageFromAppToAgent: sending msg: ' + str(msg))
+    sampleRate = getTraceSampleRate()
+    if(sampleRate > 0 and random.random() < sampleRate):
+        # The agent adds its own stamps and records how long each stage took
+        msg['trace'] = {'id': uuid.uuid4().hex[:16], 'fromApp': deviceApplicationName, 'published': time.time()}
     mqttClientOfDevice.publish('/agent', json.dumps(msg))
 
 
+def getTraceSampleRate():
+    if(traceSampleRate is not None):
+        return traceSampleRate
+    try:
+        return float(agentConfig.get('traceSampleRate', 0))
+    except (TypeError, ValueError):
+        return 0
+
+
 # Send a simple metric reading to agent to forward to /api/v1/iotdata
 def sendMetricValue(metricName, metricValue):
     dataToSend = {"name": metricName, "value": metricValue, "msg_type": "datum"}
@@ -201,6 +219,16 @@ def registerCapability(capabilityName, capabilityDetails, capabilityFunctionToRu
     # when a message is received from the agent, via mqtt
     appCapabilityFunctions[capabilityName] = capabilityFunctionToRun
 
+# Announce several capabilities at once, as { capabilityName: (capabilityDetails, capabilityFunctionToRun) }
+# The agent registers the whole batch with a single config write and a single report to the server
+def registerCapabilities(capabilities):
+    global appCapabilityFunctions
+    log('registerCapabilities: announce application capabilities to agent: ' + str(list(capabilities.keys())))
+    sendMessageFromAppToAgent({"registerCapabilities": \
+        { capabilityName: capabilityDetails for capabilityName, (capabilityDetails, capabilityFunctionToRun) in capabilities.items() }})
+    for capabilityName, (capabilityDetails, capabilityFunctionToRun) in capabilities.items():
+        appCapabilityFunctions[capabilityName] = capabilityFunctionToRun
+
 # If the app wiches to receive a copy of all messages which are seen on the mqtt topic, 
 # it can nominate a callback function which will be called whenever any message is seen
 def listenToAllMessagesFromAgent(functionToCallForEachMessage):
@@ -2,18 +2,26 @@
 # Save the location of the Davra server to config.json for use by other programs
 # Optionally: Create this device on the Davra server
 #
+# This runs on every container start. A device already provisioned for the same server
+# with the same certificate skips straight to the agent (set DAVRA_FORCE_SETUP to run it all again).
+#
 import time, requests, os
 from requests.auth import HTTPBasicAuth
-import json 
+import json
 from pprint import pprint
 import sys
+import hashlib
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import davra_lib as comDavra
 
 
 configFilename = comDavra.agentConfigFile
+# Retries when the server cannot be reached, waiting 2, 4, 8 ... up to 60 seconds between attempts
+maxConnectAttempts = 8
+maxConnectBackoff = 60
 
-currentDirectory = comDavra.runCommandWithTimeout('pwd', 10)[1]
+currentDirectory = os.getcwd()
 print("Running setup of Davra Agent " + comDavra.davraAgentVersion)
 print("Received arguments: ")
 print(sys.argv)
@@ -24,43 +32,89 @@ print("Current directory: " + str(currentDirectory))
 comDavra.loadConfiguration()
 
 
+# The server asked for by the environment or the --server command line param
+def getRequestedServer():
+    requestedServer = os.environ.get("SERVER")
+    for index, arg in enumerate(sys.argv):
+        if arg in ['--server'] and len(sys.argv) > index + 1:
+            requestedServer = sys.argv[index + 1]
+            break
+    return requestedServer
+
+
+# Fingerprint of the device certificate, so a new certificate means provisioning again
+def getCertFingerprint():
+    try:
+        with open(comDavra.getCertForRequests()[0], 'rb') as certFile:
+            return hashlib.sha256(certFile.read()).hexdigest()
+    except Exception:
+        return ''
+
+
+# A device is already provisioned if its config is complete and was provisioned
+# for the same server with the same certificate
+def isAlreadyProvisioned():
+    if(os.environ.get("DAVRA_FORCE_SETUP")):
+        return False
+    requiredKeys = ['server', 'UUID', 'heartbeatInterval', 'scriptMaxTime', 'agentRepository', \
+        'mqttBrokerServerHost', 'mqttBrokerServerPort', 'mqttBrokerAgentHost', 'provisionedCertFingerprint']
+    if(any(key not in comDavra.conf for key in requiredKeys)):
+        return False
+    requestedServer = getRequestedServer()
+    if(requestedServer and requestedServer != comDavra.conf['server']):
+        return False
+    return comDavra.conf['provisionedCertFingerprint'] == getCertFingerprint()
+
+
+if(isAlreadyProvisioned()):
+    print("Device " + comDavra.conf['UUID'] + " already provisioned for " + comDavra.conf['server'] + ". Skipping setup.")
+    sys.exit(0)
+
+
+# Wait before the next attempt to reach the server, or give up after maxConnectAttempts
+def backoffBeforeRetry(attempt, reason):
+    if(attempt >= maxConnectAttempts):
+        print("Error: " + reason + ". Giving up after " + str(attempt) + " attempts.")
+        sys.exit(1)
+    delay = min(maxConnectBackoff, 2 ** attempt)
+    print(reason + ". Retrying in " + str(delay) + " seconds.")
+    time.sleep(delay)
+
+
 def configGetServer():
-    if('server' not in comDavra.conf):
-        userInput = os.environ.get("SERVER")
-        # No server known yet. Was it passed as a command line param?
-        for index, arg in enumerate(sys.argv):
-            if arg in ['--server'] and len(sys.argv) > index + 1:
-                userInput = sys.argv[index + 1]
-                #comDavra.conf['server'] = sys.argv[index + 1]
-                with open(configFilename, 'w') as outfile:
-                    json.dump(comDavra.conf, outfile, indent=4)
-                break
+    userInput = getRequestedServer()
+    if('server' not in comDavra.conf or (userInput and userInput != comDavra.conf['server'])):
         # No configuration info exists so get it from user and save
         if(not userInput):
             print("Error: SERVER environment variable not set.")
-            configGetServer()
-            return
+            sys.exit(1)
         if("http" not in userInput or "://" not in userInput):
             print("Ensure you specify http:// or https:// before the server name or IP")
-            configGetServer()
-            return
+            sys.exit(1)
         comDavra.conf['server'] = userInput
+        # A different server means a different device record
+        comDavra.conf.pop('UUID', None)
         with open(configFilename, 'w') as outfile:
             json.dump(comDavra.conf, outfile, indent=4)
-    # Confirm can reach server    
+    # Confirm can reach server
     print("Establishing connection to Davra server... ")
     # Confirm can reach the server
     headers = comDavra.getHeadersForRequests()
     cert = comDavra.getCertForRequests()
-    r = requests.get(comDavra.conf['server'], headers=headers, cert=cert)
-    if(r.status_code == 200):
-        #print(r.content)
-        print("Ok, can reach " + comDavra.conf['server'])
-    else:
-        print("Cannot reach server. " + comDavra.conf['server'] + ' Response: ' + str(r.status_code))
-        # Repeat until server is reachable
-        configGetServer()
-        return
+    attempt = 0
+    # Repeat until server is reachable
+    while True:
+        attempt += 1
+        try:
+            r = requests.get(comDavra.conf['server'], headers=headers, cert=cert, timeout=20)
+            if(r.status_code == 200):
+                #print(r.content)
+                print("Ok, can reach " + comDavra.conf['server'])
+                return
+            reason = "Cannot reach server. " + comDavra.conf['server'] + ' Response: ' + str(r.status_code)
+        except Exception as e:
+            reason = "Cannot reach server. " + comDavra.conf['server'] + ' Error: ' + str(e)
+        backoffBeforeRetry(attempt, reason)
 
 configGetServer()
 
@@ -71,62 +125,79 @@ def configGetUUIDOfDevice():
     print('Confirming device on server')
     headers = comDavra.getHeadersForRequests()
     cert = comDavra.getCertForRequests()
-    r = requests.get(comDavra.conf['server'] + '/user', headers=headers, cert=cert)
-    if(r.status_code == 200):
-        print(r.content)
-        responseContent = json.loads(r.content)
-        if("UUID" in responseContent and "type" in responseContent and responseContent["type"] == "DEVICE"):
-            comDavra.conf['UUID'] = json.loads(r.content)['UUID']
-            print("Device confirmed on server")
-            # Save device info to config file
-            with open(configFilename, 'w') as outfile:
-                json.dump(comDavra.conf, outfile, indent=4)
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            r = requests.get(comDavra.conf['server'] + '/user', headers=headers, cert=cert, timeout=20)
+        except Exception as e:
+            backoffBeforeRetry(attempt, "Cannot reach server. Cannot retrieve device information. " + str(e))
+            continue
+        if(r.status_code == 200):
+            print(r.content)
+            responseContent = json.loads(r.content)
+            if("UUID" in responseContent and "type" in responseContent and responseContent["type"] == "DEVICE"):
+                comDavra.conf['UUID'] = json.loads(r.content)['UUID']
+                print("Device confirmed on server")
+                # Save device info to config file
+                with open(configFilename, 'w') as outfile:
+                    json.dump(comDavra.conf, outfile, indent=4)
+                return
+            else:
+                backoffBeforeRetry(attempt, "ERROR: Issue with device UUID. It does not appear to be a valid certificate for a device")
         else:
-            print("ERROR: Issue with device UUID. It does not appear to be a valid certificate for a device.")
-            configGetUUIDOfDevice()
-            return
-    else:
-        print(r.content)
-        print("Cannot reach server. Cannot retrieve device information. Please confirm then retry. " + str(r.status_code))
-        sys.exit()
+            print(r.content)
+            print("Cannot reach server. Cannot retrieve device information. Please confirm then retry. " + str(r.status_code))
+            sys.exit()
 
 configGetUUIDOfDevice()
 
 
-# heartbeatInterval is how many seconds between calling home
-if('heartbeatInterval' not in comDavra.conf):
-    comDavra.upsertConfigurationItem('heartbeatInterval', 600)
-
+# Defaults for any configuration not already set, written to the config file (and reported) in one go
+defaultConfiguration = {
+    # heartbeatInterval is how many seconds between calling home
+    'heartbeatInterval': 600,
+    # hostMetricsInterval is how many seconds between samples of cpu, ram, disk, network and load.
+    # Samples are averaged and sent along with the PLC metrics every heartbeatInterval. 0 disables them.
+    'hostMetricsInterval': 60,
+    # scriptMaxTime is how many seconds between a script can run for before timing out
+    'scriptMaxTime': 600,
+    # agentRepository is where the artifacts for the agent are published
+    # should also have /build_version.txt to indicate the latest release version
+    'agentRepository': 'TBD',
+    # What is the port of the MQTT Broker on Davra Server
+    'mqttBrokerServerPort': 6883
+}
 
-# scriptMaxTime is how many seconds between a script can run for before timing out
-if('scriptMaxTime' not in comDavra.conf):
-    comDavra.upsertConfigurationItem('scriptMaxTime', 600)
 
+# What is the host of the MQTT Broker on Davra Server
+# No configuration exists for mqtt
+# Make assumptions for the cloud based scenarios
+if ('davra.com' in comDavra.conf['server']):
+    defaultConfiguration['mqttBrokerServerHost'] = 'mqtt.davra.com'
+elif ('eemlive.com' in comDavra.conf['server']):
+    defaultConfiguration['mqttBrokerServerHost'] = 'mqtt.eemlive.com'
+else:
+    # Assume the same IP as the Davra server but ignore http or port definition
+    mqttBroker = comDavra.conf['server'].replace("http://", "").replace("https://", "").split(":")[0]
+    print('Setting mqttBroker ' + str(mqttBroker))
+    defaultConfiguration['mqttBrokerServerHost'] = mqttBroker
 
-# agentRepository is where the artifacts for the agent are published
-# should also have /build_version.txt to indicate the latest release version
-if('agentRepository' not in comDavra.conf):
-    comDavra.upsertConfigurationItem('agentRepository', 'TBD')
 
+configurationItems = { key: value for key, value in defaultConfiguration.items() if key not in comDavra.conf }
 
-# What is the host of the MQTT Broker on Davra Server
-if('mqttBrokerServerHost' not in comDavra.conf):
-    # No configuration exists for mqtt
-    # Make assumptions for the cloud based scenarios
-    if ('davra.com' in comDavra.conf['server']):
-        comDavra.upsertConfigurationItem('mqttBrokerServerHost', 'mqtt.davra.com')
-    elif ('eemlive.com' in comDavra.conf['server']):
-        comDavra.upsertConfigurationItem('mqttBrokerServerHost', 'mqtt.eemlive.com')
-    else:
-        # Assume the same IP as the Davra server but ignore http or port definition
-        mqttBroker = comDavra.conf['server'].replace("http://", "").replace("https://", "").split(":")[0]
-        print('Setting mqttBroker ' + str(mqttBroker))
-        comDavra.upsertConfigurationItem('mqttBrokerServerHost', mqttBroker)
 
+# Confirm MQTT Broker on agent
+if(comDavra.checkIsAgentMqttBrokerInstalled() == False):
+    comDavra.logError('MQTT Broker not installed')
+    configurationItems["mqttBrokerAgentHost"] = ''
+else:
+    comDavra.log('MQTT Broker installed and running')
+    configurationItems["mqttBrokerAgentHost"] = '127.0.0.1'
+    # To enable basic security which is only localhost connections to mqtt
+    configurationItems["mqttRestrictions"] = 'localhost'
 
-# What is the port of the MQTT Broker on Davra Server
-if('mqttBrokerServerPort' not in comDavra.conf):
-    comDavra.upsertConfigurationItem('mqttBrokerServerPort', 6883)
+comDavra.upsertConfigurationItems(configurationItems)
 
 
 # Reload configuration inside library
@@ -134,24 +205,35 @@ print("comDavra.loadConfiguration()...")
 comDavra.loadConfiguration()
 
 
-# Create necessary metrics on server    
-comDavra.createMetricOnServer('cpu', '%', 'CPU usage')
-comDavra.createMetricOnServer('uptime', 's', 'Time since reboot')
-comDavra.createMetricOnServer('ram', '%', 'RAM usage')
+# Create necessary metrics on server, in one request
+def createMetricsOnServer():
+    comDavra.createMetricsOnServer([
+        ('cpu', '%', 'CPU usage'),
+        ('uptime', 's', 'Time since reboot'),
+        ('ram', '%', 'RAM usage'),
+        ('disk', '%', 'Disk usage'),
+        ('load', '', 'Load average (1 min)'),
+        ('network.rx', 'B/s', 'Network received'),
+        ('network.tx', 'B/s', 'Network transmitted')
+    ])
 
 
 def getWanIpAddress():
     # Returns the current WAN IP address, as calls to internet server perceive it
     r = comDavra.httpGet('http://whatismyip.akamai.com/')
     if (r.status_code == 200):
-        return r.content
+        return r.content.decode('utf8').strip()
     return ''
 
 
 # Estimate GPS
-def getLatLong():
-    # Use IP address to guess location from geoIp
-    wanIpAddress = getWanIpAddress()
+# The GeoIP result is cached in the config with the WAN IP it was found for,
+# so it is only looked up again when the WAN IP changes
+def getLatLong(wanIpAddress):
+    cachedLocation = comDavra.conf.get('geoIpLocation')
+    if(wanIpAddress and cachedLocation and cachedLocation.get('wanIpAddress') == wanIpAddress):
+        comDavra.log('Using cached Lat/Long estimate for ' + wanIpAddress)
+        return (cachedLocation['latitude'], cachedLocation['longitude'])
     # Make call to GeoIP server to find out location from WAN IP
     comDavra.log('Getting Lat/Long estimate ')
     r = comDavra.httpGet('http://ip-api.com/json')
@@ -159,28 +241,25 @@ def getLatLong():
         jsonContent = json.loads(r.content)
         latitude = jsonContent['lat']
         longitude = jsonContent['lon']
+        if(wanIpAddress):
+            comDavra.upsertConfigurationItem('geoIpLocation', \
+                { 'wanIpAddress': wanIpAddress, 'latitude': latitude, 'longitude': longitude })
         return (latitude, longitude)
     else:
         comDavra.logWarning("Cannot reach GeoIp server. " + str(r.status_code))
         return (0,0)
 
-(piLatitude, piLongitude) = getLatLong()
-comDavra.log('Latitude/Longitude estimated as ' + str(piLatitude) + ", " + str(piLongitude))
 
+# Metric creation and the location lookup do not depend on each other so run them concurrently
+with ThreadPoolExecutor(max_workers=2) as executor:
+    metricsCreated = executor.submit(createMetricsOnServer)
+    (piLatitude, piLongitude) = getLatLong(executor.submit(getWanIpAddress).result())
+    metricsCreated.result()
+comDavra.log('Latitude/Longitude estimated as ' + str(piLatitude) + ", " + str(piLongitude))
 
-# Confirm MQTT Broker on agent
-if(comDavra.checkIsAgentMqttBrokerInstalled() == False):
-    comDavra.logError('MQTT Broker not installed')
-    comDavra.upsertConfigurationItem("mqttBrokerAgentHost", '')
-else:
-    comDavra.log('MQTT Broker installed and running')
-    comDavra.upsertConfigurationItem("mqttBrokerAgentHost", '127.0.0.1')
-    # To enable basic security which is only localhost connections to mqtt
-    comDavra.upsertConfigurationItem("mqttRestrictions", 'localhost')
-    
 
 # Send an event to the server to inform it of the installation
-dataToSend = { 
+dataToSend = {
     "UUID": comDavra.conf['UUID'],
     "name": "davra.agent.installed",
     "value": {
@@ -196,4 +275,8 @@ comDavra.log(json.dumps(dataToSend, indent=4))
 comDavra.sendDataToServer(dataToSend)
 
 
+# Remember this certificate was provisioned so the next container start can skip setup
+comDavra.upsertConfigurationItem('provisionedCertFingerprint', getCertFingerprint())
+
+
 print("Finished setup.")
@@ -0,0 +1,240 @@
+# System information read directly from /proc
+# Nothing in here spawns a child process, so it is cheap enough for the agent's periodic work
+# on small devices where a fork/exec costs milliseconds and memory.
+#
+import os
+import socket
+import struct
+import threading
+import time
+
+
+procDir = "/proc"
+
+# Previous /proc/stat CPU counters, so CPU usage is a delta between two readings
+lastCpuTimes = None
+# Host metric samples aggregated between uploads as { name: [count, sum, min, max] }
+hostMetricsAggregate = {}
+hostMetricsLock = threading.Lock()
+# Previous network counters as (time, rxBytes, txBytes), so throughput is a delta between samples
+lastNetworkSample = None
+
+
+# Read a small file completely, returning '' if it is unavailable
+def readProcFile(relativePath):
+    try:
+        with open(os.path.join(procDir, relativePath)) as procFile:
+            return procFile.read()
+    except Exception:
+        return ''
+
+
+# Returns /proc/meminfo as { key: kilobytes }
+def getMemInfo():
+    memInfo = {}
+    for line in readProcFile('meminfo').splitlines():
+        parts = line.split()
+        if(len(parts) >= 2):
+            try:
+                memInfo[parts[0].rstrip(':')] = int(parts[1])
+            except ValueError:
+                pass
+    return memInfo
+
+
+# Returns a tuple (total ram, available ram) in megabytes
+def getRam():
+    memInfo = getMemInfo()
+    total = memInfo.get('MemTotal', 0)
+    # MemAvailable is missing on very old kernels
+    available = memInfo.get('MemAvailable', memInfo.get('MemFree', 0) + memInfo.get('Buffers', 0) + memInfo.get('Cached', 0))
+    return (total // 1024, available // 1024)
+
+
+# Returns RAM usage as a percentage
+def getRamPercent():
+    (total, available) = getRam()
+    if(total == 0):
+        return 0.0
+    return round(100.0 * (total - available) / total, 1)
+
+
+# Returns the aggregate CPU counters from /proc/stat as a tuple (idle, total) in jiffies
+def getCpuTimes():
+    for line in readProcFile('stat').splitlines():
+        if(line.startswith('cpu ')):
+            fields = [int(x) for x in line.split()[1:]]
+            # idle + iowait count as idle time
+            idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+            return (idle, sum(fields[:8]))
+    return (0, 0)
+
+
+# Returns CPU usage as a percentage since the previous call (first call is since boot)
+def getCpuPercent():
+    global lastCpuTimes
+    (idle, total) = getCpuTimes()
+    (lastIdle, lastTotal) = lastCpuTimes if lastCpuTimes is not None else (0, 0)
+    lastCpuTimes = (idle, total)
+    totalDelta = total - lastTotal
+    if(totalDelta <= 0):
+        return 0.0
+    return round(100.0 * (totalDelta - (idle - lastIdle)) / totalDelta, 1)
+
+
+# Returns a tuple (1 min, 5 min, 15 min) load average
+def getLoadAverage():
+    parts = readProcFile('loadavg').split()
+    try:
+        return (float(parts[0]), float(parts[1]), float(parts[2]))
+    except (IndexError, ValueError):
+        return (0.0, 0.0, 0.0)
+
+
+# Returns the number of processes
+def getProcessCount():
+    try:
+        return sum(1 for entry in os.listdir(procDir) if entry.isdigit())
+    except Exception:
+        return 0
+
+
+# Returns uptime in seconds
+def getUptimeSeconds():
+    try:
+        return int(float(readProcFile('uptime').split()[0]))
+    except (IndexError, ValueError):
+        return 0
+
+
+# Returns uptime formatted as the uptime command does, eg "3 days, 2:07" or "12 min"
+def getUptimeText():
+    uptimeSeconds = getUptimeSeconds()
+    days = uptimeSeconds // 86400
+    hours = (uptimeSeconds % 86400) // 3600
+    minutes = (uptimeSeconds % 3600) // 60
+    text = '%d:%02d' % (hours, minutes) if hours > 0 else '%d min' % minutes
+    if(days > 0):
+        text = '%d day%s, %s' % (days, '' if days == 1 else 's', text)
+    return text
+
+
+# Returns /proc/net/dev as { interface: (rxBytes, txBytes) }, ignoring loopback
+def getNetworkCounters():
+    counters = {}
+    for line in readProcFile('net/dev').splitlines()[2:]:
+        if(':' not in line):
+            continue
+        (interface, data) = line.split(':', 1)
+        interface = interface.strip()
+        fields = data.split()
+        if(interface == 'lo' or len(fields) < 9):
+            continue
+        counters[interface] = (int(fields[0]), int(fields[8]))
+    return counters
+
+
+# Returns the interface holding the default route, from /proc/net/route
+def getDefaultRouteInterface():
+    for line in readProcFile('net/route').splitlines()[1:]:
+        fields = line.split()
+        if(len(fields) > 3 and fields[1] == '00000000' and int(fields[3], 16) & 2):
+            return fields[0]
+    return None
+
+
+# Returns the IPv4 address of an interface, using the SIOCGIFADDR ioctl
+def getInterfaceIpAddress(interface):
+    import fcntl
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        packed = fcntl.ioctl(s.fileno(), 0x8915, struct.pack('256s', interface[:15].encode('utf8')))
+        return socket.inet_ntoa(packed[20:24])
+
+
+# Returns the current LAN IP address (source address of the default route)
+def getLanIpAddress():
+    interface = getDefaultRouteInterface()
+    if(interface is not None):
+        try:
+            return getInterfaceIpAddress(interface)
+        except Exception:
+            pass
+    # Connecting a UDP socket sends nothing but makes the kernel pick the source address
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(('10.255.255.255', 1))
+            return s.getsockname()[0]
+    except Exception:
+        return ''
+
+
+# Returns operating system detail, eg "Debian GNU/Linux 12 (bookworm)"
+def getOperatingSystem():
+    try:
+        with open('/etc/os-release') as osRelease:
+            for line in osRelease:
+                if(line.startswith('PRETTY_NAME=')):
+                    return line.split('=', 1)[1].strip().strip('"')
+    except Exception:
+        pass
+    return ' '.join(os.uname())
+
+
+# Returns disk usage of the filesystem holding path as a percentage
+def getDiskPercent(path = '/'):
+    try:
+        stats = os.statvfs(path)
+        total = stats.f_blocks * stats.f_frsize
+        used = (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+        return round(100.0 * used / total, 1) if total > 0 else 0.0
+    except Exception:
+        return 0.0
+
+
+# Returns total (rxBytes, txBytes) per second since the previous call, or None on the first call
+def getNetworkThroughput():
+    global lastNetworkSample
+    counters = getNetworkCounters().values()
+    sample = (time.monotonic(), sum(c[0] for c in counters), sum(c[1] for c in counters))
+    previous = lastNetworkSample
+    lastNetworkSample = sample
+    if(previous is None or sample[0] <= previous[0]):
+        return None
+    elapsed = sample[0] - previous[0]
+    # Counters go backwards when an interface is reset
+    return (max(0, sample[1] - previous[1]) / elapsed, max(0, sample[2] - previous[2]) / elapsed)
+
+
+# Take one sample of the host metrics and add it to the aggregate held until the next upload
+def sampleHostMetrics(diskPath = '/'):
+    values = {
+        'cpu': getCpuPercent(),
+        'ram': getRamPercent(),
+        'disk': getDiskPercent(diskPath),
+        'load': getLoadAverage()[0],
+        'uptime': getUptimeSeconds()
+    }
+    throughput = getNetworkThroughput()
+    if(throughput is not None):
+        values['network.rx'] = round(throughput[0], 1)
+        values['network.tx'] = round(throughput[1], 1)
+    with hostMetricsLock:
+        for name, value in values.items():
+            aggregate = hostMetricsAggregate.get(name)
+            if(aggregate is None):
+                hostMetricsAggregate[name] = [1, value, value, value]
+            else:
+                aggregate[0] += 1
+                aggregate[1] += value
+                aggregate[2] = min(aggregate[2], value)
+                aggregate[3] = max(aggregate[3], value)
+    return values
+
+
+# Return the host metrics aggregated since the last call as { name: (count, mean, min, max) } and start afresh
+def drainHostMetrics():
+    global hostMetricsAggregate
+    with hostMetricsLock:
+        drained = hostMetricsAggregate
+        hostMetricsAggregate = {}
+    return { name: (a[0], round(a[1] / a[0], 2), a[2], a[3]) for name, a in drained.items() }
@@ -0,0 +1,169 @@
+# Shared uplink for data going to the Davra server
+# Producers (eg one acquisition task per PLC) add datums and events, each carrying its own device UUID,
+# and a single flush sends them in batches of up to maxBatch per request.
+# Queued items are kept as compact Telemetry records (slots, with the UUID and metric name interned so
+# every datum of a device shares one string) and only turned into dicts for the request that sends them.
+# The queue is bounded, by count and by approximate bytes: when the server is unreachable for long,
+# the oldest data is dropped first. A batch whose content the server rejects (400, 413, 422) is not retried
+# as it is: it is split to find the items the server will not take, which are dropped, and the rest are sent.
+# Any other failure, including authentication (eg an expired certificate), keeps everything for later.
+#
+import collections
+import sys
+import threading
+import davra_metrics as davraMetrics
+
+
+# Approximate bytes held by one queued record with a number value and a timestamp, used for the queue's
+# memory cap. Values which are not numbers (eg event payloads) add the length of their text
+recordBaseSize = 160
+# Statuses meaning the server will never accept this payload (bad request, too large, unprocessable)
+rejectedPayloadStatuses = (400, 413, 422)
+
+
+class Telemetry(object):
+    __slots__ = ('uuid', 'name', 'value', 'msgType', 'timestamp', 'extra', 'size')
+
+    def __init__(self, datum):
+        self.uuid = sys.intern(str(datum.get('UUID', '')))
+        self.name = sys.intern(str(datum.get('name', '')))
+        self.value = datum.get('value')
+        self.msgType = sys.intern(str(datum.get('msg_type', 'datum')))
+        self.timestamp = datum.get('timestamp')
+        # Anything else (eg tags) is kept as given, most datums have none
+        self.extra = None
+        for key in datum:
+            if(key not in ('UUID', 'name', 'value', 'msg_type', 'timestamp')):
+                if(self.extra is None):
+                    self.extra = {}
+                self.extra[key] = datum[key]
+        self.size = recordBaseSize
+        if(type(self.value) not in (int, float, bool) and self.value is not None):
+            self.size += len(str(self.value))
+        if(self.extra is not None):
+            self.size += len(str(self.extra))
+
+    def toDict(self):
+        datum = { 'UUID': self.uuid, 'name': self.name, 'value': self.value, 'msg_type': self.msgType }
+        if(self.timestamp is not None):
+            datum['timestamp'] = self.timestamp
+        if(self.extra is not None):
+            datum.update(self.extra)
+        return datum
+
+
+class Uplink(object):
+    # sendFunction(listOfData) must return an object with a status_code, as davra_lib.sendDataToServer does
+    def __init__(self, sendFunction, maxBatch = 500, maxQueued = 20000, logFunction = print, maxQueuedBytes = 8000000):
+        self.sendFunction = sendFunction
+        self.maxBatch = maxBatch
+        self.log = logFunction
+        self.maxQueued = maxQueued
+        self.maxQueuedBytes = maxQueuedBytes
+        self.queue = collections.deque()
+        self.queuedBytes = 0
+        self.lock = threading.Lock()
+        # Only one flush at a time, so batches go out in order
+        self.flushLock = threading.Lock()
+        self.sentCount = 0
+        self.droppedCount = 0
+        self.rejectedCount = 0
+        self.failedRequests = 0
+
+    # Queue a datum or event, or a list of them
+    def add(self, dataToSend):
+        if(type(dataToSend) != list):
+            dataToSend = [dataToSend]
+        records = [Telemetry(datum) for datum in dataToSend]
+        with self.lock:
+            self.queue.extend(records)
+            self.queuedBytes += sum(record.size for record in records)
+            overflow = self.dropOverflow()
+        if(overflow > 0):
+            self.log('Uplink queue full, dropped ' + str(overflow) + ' oldest item(s)')
+
+    # Drop the oldest records until the queue is within its caps. Call with the lock held
+    def dropOverflow(self):
+        dropped = 0
+        while self.queue and (len(self.queue) > self.maxQueued or self.queuedBytes > self.maxQueuedBytes):
+            self.queuedBytes -= self.queue.popleft().size
+            dropped += 1
+        self.droppedCount += dropped
+        return dropped
+
+    def takeBatch(self):
+        with self.lock:
+            batch = [self.queue.popleft() for i in range(min(self.maxBatch, len(self.queue)))]
+            self.queuedBytes -= sum(record.size for record in batch)
+            return batch
+
+    # Put a batch which could not be sent back at the front of the queue.
+    # If the queue filled up meanwhile, the oldest records are the ones dropped
+    def returnBatch(self, batch):
+        with self.lock:
+            self.queue.extendleft(reversed(batch))
+            self.queuedBytes += sum(record.size for record in batch)
+            self.dropOverflow()
+
+    # Whether a request which failed with this status may succeed if sent again unchanged. Anything but the
+    # statuses which say the payload itself was refused: a 5xx, no response at all (500, see
+    # davra_lib.emptyRequestsObject), 401 or 403 until the credentials are fixed, 408, 429 and so on
+    def isRetryable(self, statusCode):
+        return statusCode not in rejectedPayloadStatuses
+
+    # Send a batch. If the server rejects it, the halves are sent separately, down to the single items it
+    # rejects, which are dropped. Returns (itemsSent, itemsToRetry, statusCode), itemsToRetry being what is
+    # left when a request failed in a way worth retrying
+    def sendBatch(self, batch):
+        statusCode = self.sendFunction([record.toDict() for record in batch]).status_code
+        if(statusCode == 200):
+            return (len(batch), [], statusCode)
+        if(self.isRetryable(statusCode)):
+            return (0, batch, statusCode)
+        if(len(batch) == 1):
+            self.rejectedCount += 1
+            davraMetrics.increment('davra_uplink_rejected_total', status=str(statusCode))
+            self.log('Uplink dropped ' + batch[0].msgType + ' ' + batch[0].name + ' of ' + batch[0].uuid \
+                + ', which the server rejected: ' + str(statusCode))
+            return (0, [], statusCode)
+        middle = len(batch) // 2
+        (sent, toRetry, statusCode) = self.sendBatch(batch[:middle])
+        if(len(toRetry) > 0):
+            return (sent, toRetry + batch[middle:], statusCode)
+        (secondSent, toRetry, statusCode) = self.sendBatch(batch[middle:])
+        return (sent + secondSent, toRetry, statusCode)
+
+    # Send everything queued, one request per maxBatch items. Stops at the first request which fails in a way
+    # worth retrying and keeps the rest for the next flush. Returns the number of items sent.
+    def flush(self):
+        if(self.flushLock.acquire(blocking=False) is False):
+            return 0
+        sent = 0
+        try:
+            while True:
+                batch = self.takeBatch()
+                if(len(batch) == 0):
+                    break
+                (batchSent, toRetry, statusCode) = self.sendBatch(batch)
+                sent += batchSent
+                if(len(toRetry) > 0):
+                    self.failedRequests += 1
+                    self.returnBatch(toRetry)
+                    davraMetrics.increment('davra_http_retries_total', source='uplink')
+                    self.log('Uplink could not send ' + str(len(toRetry)) + ' item(s) to server: ' + str(statusCode) \
+                        + '. ' + str(len(self.queue)) + ' queued for the next flush')
+                    break
+        finally:
+            self.flushLock.release()
+        self.sentCount += sent
+        return sent
+
+    def getStats(self):
+        return {
+            "queued": len(self.queue),
+            "queuedBytes": self.queuedBytes,
+            "sent": self.sentCount,
+            "dropped": self.droppedCount,
+            "rejected": self.rejectedCount,
+            "failedRequests": self.failedRequests
+        }
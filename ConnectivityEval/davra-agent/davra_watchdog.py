@@ -0,0 +1,141 @@
+# Stall detection for the Davra Agent
+# The scheduler loop, each scheduled task and each MQTT callback mark themselves busy while they run
+# (with watch(activity): ...), which costs a dict update per run. A watchdog thread checks every second
+# and when an activity has been busy for longer than stallThreshold seconds (eg a 20s HTTP timeout, a long
+# script in runCommandWithTimeout or a hanging RSC call) it captures that thread's stack, logs it and calls
+# onStall, at most once per eventInterval seconds. How long each stall lasted is kept when it ends.
+#
+import collections
+import sys
+import threading
+import time
+import traceback
+import davra_metrics as davraMetrics
+
+
+stallThreshold = 30.0
+eventInterval = 300.0
+checkInterval = 1.0
+onStall = None
+logFunction = print
+# What each thread is busy with as { threadId: [activity, startTime, stallReported, threadName] }
+# stallReported is None for an activity held up by a stall reported for an activity inside it
+busyThreads = {}
+busyLock = threading.Lock()
+# { activity: [stallCount, totalSeconds, maxSeconds] } for the stalls which ended
+stallStats = {}
+recentStalls = collections.deque(maxlen=10)
+lastEventTime = None
+suppressedEvents = 0
+watchdogThread = None
+
+
+class watch(object):
+    __slots__ = ('activity', 'threadId', 'previous')
+
+    def __init__(self, activity):
+        self.activity = activity
+
+    def __enter__(self):
+        self.threadId = threading.get_ident()
+        with busyLock:
+            # An activity inside another on the same thread (eg a task run by the scheduler loop) takes over until it ends
+            self.previous = busyThreads.get(self.threadId)
+            busyThreads[self.threadId] = [self.activity, time.monotonic(), False, threading.current_thread().name]
+        return self
+
+    def __exit__(self, excType, excValue, excTraceback):
+        with busyLock:
+            busyState = busyThreads.pop(self.threadId, None)
+            if(self.previous is not None):
+                # The outer activity was held up by this one's stall, which is already reported
+                if(busyState is not None and busyState[2] is True and self.previous[2] is False):
+                    self.previous[2] = None
+                busyThreads[self.threadId] = self.previous
+        if(busyState is not None and busyState[2] is True):
+            recordStallEnded(busyState[0], time.monotonic() - busyState[1])
+        return False
+
+
+def recordStallEnded(activity, seconds):
+    with busyLock:
+        stats = stallStats.setdefault(activity, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+    davraMetrics.observe('davra_stall_seconds', seconds, activity=activity)
+    logFunction('Watchdog: ' + activity + ' recovered after stalling for ' + str(round(seconds, 1)) + 's')
+
+
+def getThreadStack(threadId):
+    frame = sys._current_frames().get(threadId)
+    return traceback.format_stack(frame) if frame is not None else []
+
+
+# Find the activities busy for longer than stallThreshold which were not reported yet
+def checkForStalls():
+    global lastEventTime, suppressedEvents
+    now = time.monotonic()
+    stalled = []
+    with busyLock:
+        for threadId, busyState in busyThreads.items():
+            if(busyState[2] is False and now - busyState[1] > stallThreshold):
+                busyState[2] = True
+                stalled.append((threadId, busyState[0], now - busyState[1], busyState[3]))
+    for (threadId, activity, stalledSeconds, threadName) in stalled:
+        stack = getThreadStack(threadId)
+        stall = {
+            'activity': activity,
+            'thread': threadName,
+            'stalledSeconds': round(stalledSeconds, 1),
+            'time': int(time.time() * 1000),
+            'stack': stack
+        }
+        recentStalls.append(stall)
+        logFunction('Watchdog: ' + activity + ' on thread ' + threadName + ' has been busy for ' \
+            + str(round(stalledSeconds, 1)) + 's:\n' + ''.join(stack))
+        if(onStall is None):
+            continue
+        if(lastEventTime is not None and now - lastEventTime < eventInterval):
+            suppressedEvents += 1
+            continue
+        lastEventTime = now
+        stall['suppressedSinceLast'] = suppressedEvents
+        suppressedEvents = 0
+        # The callback may well call the server, so it must not hold up the watchdog
+        threading.Thread(target=onStall, args=(stall,), name='davra-stall-event', daemon=True).start()
+
+
+def runWatchdog():
+    while True:
+        time.sleep(checkInterval)
+        try:
+            checkForStalls()
+        except Exception as e:
+            logFunction('Watchdog: check failed: ' + str(e))
+
+
+# Start the watchdog thread. onStallFunction(stall) is called for stalls, no more than once per eventSeconds
+def start(thresholdSeconds = 30, eventSeconds = 300, onStallFunction = None, logFunctionToUse = print):
+    global stallThreshold, eventInterval, onStall, logFunction, watchdogThread
+    stallThreshold = float(thresholdSeconds)
+    eventInterval = float(eventSeconds)
+    onStall = onStallFunction
+    logFunction = logFunctionToUse
+    if(watchdogThread is None):
+        watchdogThread = threading.Thread(target=runWatchdog, name='davra-watchdog', daemon=True)
+        watchdogThread.start()
+
+
+def getStats():
+    now = time.monotonic()
+    with busyLock:
+        return {
+            'stallThreshold': stallThreshold,
+            'stalls': { activity: { 'count': count, 'totalSeconds': round(total, 3), 'maxSeconds': round(maximum, 3) } \
+                for activity, (count, total, maximum) in sorted(stallStats.items()) },
+            'stalledNow': [{ 'activity': busyState[0], 'thread': busyState[3], 'seconds': round(now - busyState[1], 1) } \
+                for busyState in busyThreads.values() if busyState[2] is True],
+            'suppressedEvents': suppressedEvents,
+            'recentStalls': [dict(stall, stack=stall['stack'][-3:]) for stall in recentStalls]
+        }
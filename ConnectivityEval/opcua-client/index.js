@@ -169,23 +169,50 @@ async function subscribeToVariables() {
   console.log("[SUBSCRIBE] Subscribed to configured variables.");
 }
 
+/**
+ * Resubscribe if the variables in config.json differ from those currently monitored.
+ */
+async function reloadConfigIfChanged(source) {
+  if (!fs.existsSync(CONFIG_PATH)) return;
+
+  let updatedVars;
+  try {
+    updatedVars = JSON.parse(fs.readFileSync(CONFIG_PATH)).opcVarsToMonitor || [];
+  } catch (err) {
+    // The agent replaces the file atomically, but a hand edit may be caught half written
+    console.warn(`[${source}] Could not read configuration:`, err.message);
+    return;
+  }
+  const newVarsStringified = JSON.stringify(updatedVars);
+
+  if (newVarsStringified !== CURRENT_VARS_STRINGIFIED) {
+    console.log(`[${source}] Configuration changed. Resubscribing...`);
+    OPCUA_VARS_TO_MONITOR = updatedVars;
+    CURRENT_VARS_STRINGIFIED = newVarsStringified;
+    await subscribeToVariables();
+  }
+}
+
 /**
  * Monitor for config.json changes and resubscribe if necessary.
+ * The data directory is watched (the agent replaces config.json by renaming a new file over it)
+ * so changes apply within a second. Polling every 2 minutes stays as a fallback for
+ * filesystems where fs.watch does not report events, eg some bind mounts.
  */
 async function monitorConfigFileChanges() {
-  setInterval(async () => {
-    if (!fs.existsSync(CONFIG_PATH)) return;
-
-    const rawData = fs.readFileSync(CONFIG_PATH);
-    const updatedVars = JSON.parse(rawData).opcVarsToMonitor || [];
-    const newVarsStringified = JSON.stringify(updatedVars);
+  let debounceTimer = null;
+  try {
+    fs.watch(path.dirname(CONFIG_PATH), (eventType, filename) => {
+      if (filename && filename !== path.basename(CONFIG_PATH)) return;
+      clearTimeout(debounceTimer);
+      debounceTimer = setTimeout(() => reloadConfigIfChanged("CONFIG WATCHER"), 500);
+    });
+    console.log("[CONFIG WATCHER] Watching for configuration changes.");
+  } catch (err) {
+    console.warn("[CONFIG WATCHER] Cannot watch configuration, polling only:", err.message);
+  }
 
-    if (newVarsStringified !== CURRENT_VARS_STRINGIFIED) {
-      console.log("[CONFIG WATCHER] Configuration changed. Resubscribing...");
-      OPCUA_VARS_TO_MONITOR = updatedVars;
-      await subscribeToVariables();
-    }
-  }, 2 * 60 * 1000); // Every 2 minutes
+  setInterval(() => reloadConfigIfChanged("CONFIG POLL"), 2 * 60 * 1000); // Every 2 minutes
 }
 
 /**